@@ -0,0 +1,2 @@
+# Benchmarks for the crawler. Run them from the directory containing
+# scrapy.cfg, e.g. `python -m benchmarks.bench_embedding_assignment`.
@@ -0,0 +1,189 @@
+# End-to-end crawl benchmark: UbereatsSpider and the item pipeline against
+# the local mock site, writing to a local mongod (or mongomock).
+#
+#   python -m benchmarks.bench_crawl --cities 4 --items 100 \
+#       --mongo mongodb://localhost:27017 --output results.json
+#
+# Reports requests/s, stores/s, embedded items/s, p50/p99 item latency (from
+# the getStoreV1 response arriving to the item leaving the pipeline) and peak
+# RSS. Results are written as JSON so runs of different versions can be
+# compared.
+#
+# --record PATH keeps the responses in an HTTP cache file; --replay PATH
+# crawls from that file alone, without a mock server, e.g. to time parsing
+# and enrichment at disk speed.
+#
+# --workdir PATH keeps the crawl state (frontier, yields, category cache)
+# there instead of in a new directory, to benchmark consecutive runs, e.g.
+# the category feeds saved once the overlap of categories is known:
+#
+#   python -m benchmarks.bench_crawl --mongo dry-run --nested-categories 0.5 \
+#       --workdir /tmp/crawl-state --set FRONTIER_PATH=
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from .mock_server import add_site_arguments, config_from_args, start_in_subprocess
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class LatencyRecorder:
+
+    def __init__(self, crawler):
+        from scrapy import signals
+        self._received = {}
+        self.latencies = []
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(self.item_done, signal=signal)
+
+    def response_received(self, response, request, spider):
+        self._received[request] = time.perf_counter()
+
+    def item_done(self, response, **kwargs):
+        start = self._received.pop(getattr(response, 'request', None), None)
+        if start is not None:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def run(args):
+    site = config_from_args(args)
+    if args.replay:
+        server, url_root = None, 'http://replay.invalid'
+    elif args.url_root:
+        server, url_root = None, args.url_root
+    else:
+        server, url_root = start_in_subprocess(site)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_crawl_')
+    os.makedirs(workdir, exist_ok=True)
+    cities_file = os.path.join(workdir, 'cities.json')
+    with open(cities_file, 'w') as f:
+        json.dump(site.city_slugs(), f)
+
+    if args.mongo == 'dry-run':
+        os.environ.pop('MONGODB_URI', None)
+    elif args.mongo == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        os.environ['MONGODB_URI'] = 'mongodb://mongomock'
+    else:
+        os.environ['MONGODB_URI'] = args.mongo
+    os.environ['MONGODB_DB'] = args.db
+    os.environ['MONGODB_COLLECTION'] = f'bench_{int(time.time())}'
+    os.environ.setdefault('ARZUE_MAPS_API_KEY', 'benchmark')
+
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    settings.setdict({
+        'UBEREATS_URL_ROOT': url_root,
+        'CITIES_FILE': cities_file,
+        'CITIES_PER_RUN': site.cities,
+        'ROBOTSTXT_OBEY': False,
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': args.log_level,
+        'CONCURRENT_REQUESTS': args.concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+        'GEOCODER_ENDPOINT': f'{url_root}/geocode',
+        'GEOCODER_CACHE_PATH': os.path.join(workdir, 'geocodes.sqlite3'),
+        'FRONTIER_PATH': os.path.join(workdir, 'frontier.sqlite3'),
+        'YIELD_PATH': os.path.join(workdir, 'yield.sqlite3'),
+        'CATEGORY_CACHE_PATH': os.path.join(workdir, 'categories.sqlite3'),
+        'EMBEDDING_CACHE_PATH': os.path.join(workdir, 'embeddings.sqlite3') if args.embedding_cache else '',
+    }, priority='cmdline')
+    if args.record or args.replay:
+        settings.setdict({
+            'HTTPCACHE_ENABLED': True,
+            'HTTPCACHE_PATH': args.record or args.replay,
+            'HTTPCACHE_REPLAY': bool(args.replay),
+            'HTTPCACHE_IGNORE_MISSING': bool(args.replay),
+        }, priority='cmdline')
+    for override in args.set:
+        name, _, value = override.partition('=')
+        settings.set(name, value, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler('ubereats')
+    recorder = LatencyRecorder(crawler)
+    start = time.perf_counter()
+    process.crawl(crawler)
+    process.start()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.terminate()
+
+    stats = crawler.stats.get_stats()
+    stores = stats.get('item_scraped_count', 0)
+    result = {
+        'version': args.label,
+        'python': platform.python_version(),
+        'site': site.to_dict(),
+        'elapsed_seconds': elapsed,
+        'requests_per_second': stats.get('downloader/request_count', 0) / elapsed,
+        'stores_per_second': stores / elapsed,
+        'items_embedded_per_second': stats.get('embedding/items', 0) / elapsed,
+        'category_feeds_requested': stats.get('categories/feeds_requested', 0),
+        'category_feeds_skipped': stats.get('categories/skipped_overlap', 0),
+        'city_pages_cached': stats.get('categories/list_cache_hits', 0),
+        'item_latency_p50_seconds': percentile(recorder.latencies, 50),
+        'item_latency_p99_seconds': percentile(recorder.latencies, 99),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stats': {key: value for key, value in stats.items()
+                  if isinstance(value, (int, float, str))},
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a full crawl against a local mock site.')
+    add_site_arguments(parser)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017',
+                        help='Mongo URI, "mongomock" for an in-process mock, or "dry-run" '
+                             'to run the pipeline without Mongo')
+    parser.add_argument('--db', default='ubereats_benchmark')
+    parser.add_argument('--url-root',
+                        help='crawl an already running mock server instead of starting one')
+    parser.add_argument('--record', metavar='PATH', help='keep the responses in this HTTP cache file')
+    parser.add_argument('--replay', metavar='PATH', help='crawl from this HTTP cache file only')
+    parser.add_argument('--workdir', help='keep the crawl state in this directory across runs')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--embedding-cache', action='store_true',
+                        help='keep the on-disk embedding cache enabled')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a Scrapy setting')
+    parser.add_argument('--label', default=os.environ.get('BENCH_LABEL', 'dev'),
+                        help='version label stored with the results')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Distributed crawl with several local worker processes sharing one work
+# queue, against the local mock site.
+#
+#   python -m benchmarks.bench_distributed --workers 4 --cities 8 --items 50
+#
+# Each worker is a bench_crawl process. By default they share an
+# SQLiteWorkQueue; with --queue mongo they share a MongoWorkQueue in the
+# --mongo database instead (this needs a real mongod). --kill-after kills the
+# first worker mid-crawl to check that the others take over its leased tasks
+# once the lease expires. --malformed-rate makes some category feeds and
+# stores answer with bodies the spider fails to parse: their tasks must
+# still complete, or the workers never drain the queue and exit (workers
+# still running after --timeout seconds are killed and reported as hung).
+# Reports the wall time, stores crawled per worker, and whether every store
+# of the site was crawled exactly once.
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from .mock_server import add_site_arguments, config_from_args, start_in_subprocess
+
+
+def expected_stores(site):
+    # the stores of malformed feeds are never found
+    stores = set()
+    for slug in site.city_slugs():
+        for category, path in enumerate(site.category_paths(slug)):
+            if not site.malformed(path):
+                stores.update(site.category_stores(slug, category))
+    return stores
+
+
+def site_arguments(args):
+    return ['--cities', str(args.cities), '--categories', str(args.categories),
+            '--stores-per-city', str(args.stores_per_city),
+            '--stores-per-category', str(args.stores_per_category),
+            '--items', str(args.items), '--failure-rate', str(args.failure_rate),
+            '--missing-location-rate', str(args.missing_location_rate),
+            '--nested-categories', str(args.nested_categories),
+            '--malformed-rate', str(args.malformed_rate),
+            '--seed', str(args.seed)]
+
+
+def run(args):
+    site = config_from_args(args)
+    server, url_root = start_in_subprocess(site)
+    workdir = tempfile.mkdtemp(prefix='bench_distributed_')
+    queue_name = f'bench_queue_{int(time.time())}'
+    queue_settings = [
+        f'WORK_QUEUE_LEASE_TIMEOUT={args.lease_timeout}',
+        f'WORK_QUEUE_PREFETCH={args.prefetch}',
+    ]
+    if args.queue == 'mongo':
+        queue_settings += ['WORK_QUEUE_BACKEND=ubereats_crawler.workqueue.MongoWorkQueue',
+                           f'WORK_QUEUE_NAME={queue_name}']
+    else:
+        queue_settings += ['WORK_QUEUE_BACKEND=ubereats_crawler.workqueue.SQLiteWorkQueue',
+                           f'WORK_QUEUE_PATH={os.path.join(workdir, "queue.sqlite3")}']
+
+    workers = []
+    start = time.perf_counter()
+    for i in range(args.workers):
+        output = os.path.join(workdir, f'worker{i}.json')
+        command = [sys.executable, '-m', 'benchmarks.bench_crawl', '--url-root', url_root,
+                   '--mongo', args.mongo, '--db', args.db, '--concurrency', str(args.concurrency),
+                   '--output', output, '--label', f'worker{i}'] + site_arguments(args)
+        for setting in queue_settings:
+            command += ['--set', setting]
+        workers.append((subprocess.Popen(command, stdout=subprocess.DEVNULL), output))
+
+    killed = None
+    if args.kill_after is not None:
+        time.sleep(args.kill_after)
+        killed = workers[0][0]
+        killed.send_signal(signal.SIGKILL)
+
+    results = []
+    hung = 0
+    for process, output in workers:
+        try:
+            process.wait(max(1, args.timeout - (time.perf_counter() - start)))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            hung += 1
+            continue
+        if process is not killed and os.path.exists(output):
+            with open(output) as f:
+                results.append(json.load(f))
+    elapsed = time.perf_counter() - start
+    server.terminate()
+
+    expected = expected_stores(site)
+    if args.queue == 'mongo':
+        import pymongo
+        queue = pymongo.MongoClient(args.mongo)[args.db][queue_name]
+        done = {doc['key'] for doc in queue.find({'kind': 'store', 'status': 'done'}, {'key': 1})}
+    else:
+        import sqlite3
+        conn = sqlite3.connect(os.path.join(workdir, 'queue.sqlite3'))
+        done = {key for key, in conn.execute(
+            "SELECT key FROM tasks WHERE kind = 'store' AND status = 'done'")}
+    scraped = sum(result['stats'].get('item_scraped_count', 0) for result in results)
+    return {
+        'workers': args.workers,
+        'killed_worker': killed is not None,
+        'workers_hung': hung,
+        'site': site.to_dict(),
+        'elapsed_seconds': elapsed,
+        'stores_per_second': len(done) / elapsed,
+        'stores_expected': len(expected),
+        'stores_done': len(done),
+        'all_stores_done': done == expected,
+        'items_scraped_by_survivors': scraped,
+        'items_per_worker': [result['stats'].get('item_scraped_count', 0) for result in results],
+        'duplicate_stores_skipped': sum(result['stats'].get('workqueue/duplicate_stores', 0)
+                                        for result in results),
+        'callback_errors': sum(result['stats'].get('tasks/callback_errors', 0) for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark several crawl workers sharing a work queue.')
+    add_site_arguments(parser)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue', choices=['sqlite', 'mongo'], default='sqlite')
+    parser.add_argument('--mongo', default='mongomock',
+                        help='Mongo URI for the items (and the queue with --queue mongo)')
+    parser.add_argument('--db', default='ubereats_benchmark')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--prefetch', type=int, default=64)
+    parser.add_argument('--lease-timeout', type=float, default=30)
+    parser.add_argument('--kill-after', type=float,
+                        help='kill the first worker after this many seconds')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds after which workers still running are killed as hung')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
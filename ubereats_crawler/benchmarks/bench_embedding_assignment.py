@@ -0,0 +1,62 @@
+# Per-store latency of matching menu items with their embeddings, as a
+# function of menu size: the previous DataFrame based lookup against the
+# positional assignment used by the pipeline.
+#
+#   python -m benchmarks.bench_embedding_assignment --sizes 10 100 500 1000
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ubereats_crawler.pipelines import RestaurantItemFlattenTransformer
+
+from .synthetic import make_store
+
+DIM = 512
+
+
+def assign_dataframe(data, embeddings):
+    # the lookup process_item used to do: one boolean scan per item
+    result = RestaurantItemFlattenTransformer([data,])
+    restaurants_df = pd.DataFrame(data=result, columns=result.cols())
+    restaurants_df['text_embeddings'] = embeddings.tolist()
+    for item in RestaurantItemFlattenTransformer.catalog_items(data):
+        series = restaurants_df.loc[restaurants_df['item_id'] == item['uuid'], 'text_embeddings']
+        item['text_embedding'] = list(series)[0]
+
+
+def assign_positional(data, embeddings):
+    items = list(RestaurantItemFlattenTransformer.catalog_items(data))
+    for item, embedding in zip(items, embeddings):
+        item['text_embedding'] = embedding.tolist()
+
+
+def measure(fn, data, embeddings, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(data, embeddings)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 250, 500, 1000, 2000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'items':>8} {'dataframe ms':>14} {'positional ms':>14} {'speedup':>9}")
+    for size in args.sizes:
+        data = make_store(size, seed=size)
+        n = sum(1 for _ in RestaurantItemFlattenTransformer.catalog_items(data))
+        embeddings = np.random.default_rng(size).standard_normal((n, DIM), dtype=np.float32)
+        old = measure(assign_dataframe, data, embeddings, args.repeat)
+        new = measure(assign_positional, data, embeddings, args.repeat)
+        print(f'{n:>8} {old * 1e3:>14.2f} {new * 1e3:>14.2f} {old / new:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Time and peak memory of exporting the item table of a collection: the
+# previous analyst path (RestaurantItemFlattenTransformer over every
+# document into a pandas DataFrame) against export.export to Parquet.
+#
+#   python -m benchmarks.bench_export --stores 200 800 3200 --items 100 \
+#       --mongo mongodb://localhost:27017
+#
+# For each size a fresh collection of synthetic embedded stores over 32
+# cities is written, then both paths read it back. Peak memory is the
+# tracemalloc peak of the Python heap plus the peak of Arrow's memory pool.
+# mongomock runs the export's aggregation in Python, an order of magnitude
+# slower than mongod, and materializes its results: use it to try the
+# benchmark out, not for numbers.
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from ubereats_crawler.codec import decode_embedding, encode_embedding
+from ubereats_crawler.export import SORT_INDEX, export
+from ubereats_crawler.pipelines import RestaurantItemFlattenTransformer
+
+from .synthetic import make_store
+
+CITIES = [f'city{i}-{state}' for i, state in enumerate(['ca', 'tx', 'ny', 'wa'] * 8)]
+
+
+def populate(collection, n_stores, n_items, dim=512):
+    rng = np.random.default_rng(0)
+    collection.drop()
+    # built here so that export() doesn't build it while being timed
+    collection.create_index(SORT_INDEX)
+    batch = []
+    for i in range(n_stores):
+        city = CITIES[i % len(CITIES)]
+        data = make_store(n_items, seed=i, city=city)
+        data.update(_id=data['uuid'], name=data['title'], label=city)
+        for item in RestaurantItemFlattenTransformer.catalog_items(data):
+            item['text_embedding'] = encode_embedding(rng.standard_normal(dim), 'float16')
+        batch.append(data)
+        if len(batch) == 100:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def flatten_to_pandas(collection):
+    # what the analysts did: every document and row in Python, then pandas
+    docs = list(collection.find())
+    rows = RestaurantItemFlattenTransformer(docs)
+    df = pd.DataFrame(data=list(rows), columns=rows.cols())
+    df['text_embedding'] = [decode_embedding(item['text_embedding']).astype(np.float32).tolist()
+                            for doc in docs for item in rows.catalog_items(doc)]
+    return len(df)
+
+
+def measure(fn):
+    pool = pa.default_memory_pool()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed,
+            'peak_memory_bytes': peak + pool.max_memory()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark exporting the item table.')
+    parser.add_argument('--stores', type=int, nargs='+', default=[200, 800])
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017',
+                        help='Mongo URI, or "mongomock" for an in-process mock')
+    parser.add_argument('--db', default='ubereats_benchmark')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.mongo == 'mongomock':
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo)
+    collection = client[args.db][f'bench_export_{int(time.time())}']
+
+    results = []
+    for n_stores in args.stores:
+        populate(collection, n_stores, args.items)
+        workdir = tempfile.mkdtemp(prefix='bench_export_')
+        for name, fn in [('pandas', lambda: flatten_to_pandas(collection)),
+                         ('parquet', lambda: export(collection, f'{workdir}/items'))]:
+            result = {'stores': n_stores, 'path': name, **measure(fn)}
+            print(json.dumps(result))
+            results.append(result)
+        shutil.rmtree(workdir)
+    collection.drop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
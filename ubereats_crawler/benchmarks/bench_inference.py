@@ -0,0 +1,109 @@
+# Throughput of the CLIP text encoder backends of ubereats_crawler.inference
+# on synthetic menu item texts.
+#
+#   python -m benchmarks.bench_inference --texts 5000 --processes 1 2 4 --threads 1 2
+#
+# Every configuration encodes the same texts and is compared with the plain
+# torch model, run in process and padded to the full context as
+# EmbeddingsGenerator does: texts/s and the largest cosine distance of an
+# embedding from the reference. The pool is timed for every --processes x
+# --threads pair, after a warm-up call that loads the models.
+
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from ubereats_crawler.inference import (
+    OnnxTextModel, ProcessPoolTextEncoder, TextEncoder, TorchTextModel, tokenize)
+from ubereats_crawler.pipelines import catalog_item_text
+
+from .synthetic import make_store
+
+
+def synthetic_texts(n, items_per_store=100):
+    texts = []
+    for seed in itertools.count():
+        data = make_store(items_per_store, seed=seed)
+        for menu in data['catalogSectionsMap'].values():
+            for section in menu:
+                for item in section['payload']['standardItemsPayload']['catalogItems']:
+                    texts.append(catalog_item_text(item))
+        if len(texts) >= n:
+            return texts[:n]
+
+
+class PaddedTextEncoder(TextEncoder):
+    # batches of batch_size texts in order, at the full context length
+
+    def __call__(self, texts):
+        tokens = tokenize(texts)
+        embeddings = np.concatenate([self._model(tokens[start:start + self._batch_size])
+                                     for start in range(0, len(tokens), self._batch_size)])
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+def measure(name, encoder, texts, reference=None):
+    encoder(texts[:encoder._batch_size])
+    start = time.perf_counter()
+    embeddings = encoder(texts)
+    elapsed = time.perf_counter() - start
+    result = {'backend': name, 'texts_per_second': len(texts) / elapsed}
+    if reference is not None:
+        result['max_cosine_distance'] = float(1 - (embeddings * reference).sum(axis=1).min())
+    print(json.dumps(result))
+    encoder.close()
+    return result, embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CLIP text encoder backends.')
+    parser.add_argument('--texts', type=int, default=5000)
+    parser.add_argument('--model', default='ViT-B/32')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--backend', nargs='+', default=['torch', 'int8', 'onnx'],
+                        choices=['torch', 'int8', 'onnx'],
+                        help='in-process backends to time besides the reference')
+    parser.add_argument('--processes', type=int, nargs='*', default=[os.cpu_count() // 2 or 1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--onnx-path', default='.cache/clip-text.onnx')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    texts = synthetic_texts(args.texts)
+    lengths = (tokenize(texts).argmax(axis=1) + 1)
+    print(f'{len(texts)} texts, {lengths.mean():.1f} tokens on average')
+
+    model = TorchTextModel(args.model)
+    result, reference = measure('torch padded', PaddedTextEncoder(model, args.batch_size), texts)
+    results = [result]
+    backends = {
+        'torch': lambda threads: TorchTextModel(args.model, threads),
+        'int8': lambda threads: TorchTextModel(args.model, threads, quantize=True),
+        'onnx': lambda threads: OnnxTextModel(args.model, args.onnx_path, threads),
+    }
+    for name in args.backend:
+        encoder = TextEncoder(model if name == 'torch' else backends[name](0), args.batch_size)
+        results.append(measure(name, encoder, texts, reference)[0])
+
+    for name, processes, threads in itertools.product(args.backend, args.processes, args.threads):
+        if name == 'onnx':
+            backend, options = 'ubereats_crawler.inference.OnnxTextModel', {
+                'model_name': args.model, 'path': args.onnx_path, 'threads': threads}
+        else:
+            backend, options = 'ubereats_crawler.inference.TorchTextModel', {
+                'model_name': args.model, 'threads': threads, 'quantize': name == 'int8'}
+        encoder = ProcessPoolTextEncoder(backend, options, processes, args.batch_size)
+        results.append(measure(f'{name} {processes}x{threads}', encoder, texts, reference)[0])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
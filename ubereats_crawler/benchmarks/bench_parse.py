@@ -0,0 +1,75 @@
+# Parse time and peak memory per getStoreV1 response, for the previous
+# parsing path (decode the body to str, json.loads, decode metaJson right
+# away) and the current one (parse the raw bytes, keep the item fields,
+# leave metaJson for later).
+#
+#   python -m benchmarks.bench_parse --sizes 50 200 1000
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from ubereats_crawler import parsing
+
+from .synthetic import make_store
+
+
+def parse_legacy(body):
+    data = json.loads(body.decode('utf-8'))['data']
+    meta = json.loads(data['metaJson'])
+    return {field: data[field] for field in parsing.STORE_INFO_FIELDS}, meta.get('@id')
+
+
+def parse_current(body):
+    return parsing.extract_store_info(parsing.loads(body)['data'])
+
+
+def measure(fn, body, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(body)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    result = fn(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return min(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 500, 1000, 2000],
+                        help='menu items per store')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    print(f'parser: {"orjson" if parsing.orjson is not None else "json"}')
+    print(f"{'items':>6} {'body KB':>9} {'legacy ms':>10} {'current ms':>11} "
+          f"{'legacy peak KB':>15} {'current peak KB':>16}")
+    results = []
+    for size in args.sizes:
+        body = json.dumps({'status': 'success', 'data': make_store(size, seed=size)}).encode()
+        legacy_time, legacy_peak = measure(parse_legacy, body, args.repeat)
+        current_time, current_peak = measure(parse_current, body, args.repeat)
+        results.append({
+            'items': size,
+            'body_bytes': len(body),
+            'legacy_seconds': legacy_time,
+            'current_seconds': current_time,
+            'legacy_peak_bytes': legacy_peak,
+            'current_peak_bytes': current_peak,
+        })
+        print(f'{size:>6} {len(body) / 1024:>9.0f} {legacy_time * 1e3:>10.2f} {current_time * 1e3:>11.2f} '
+              f'{legacy_peak / 1024:>15.0f} {current_peak / 1024:>16.0f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'parser': 'orjson' if parsing.orjson is not None else 'json',
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# Fresh stores per request of the spider's scheduling policies, on a
+# simulated site over many runs.
+#
+#   python -m benchmarks.bench_scheduling --runs 30 --budget 3000
+#
+# Cities differ in size and in how fast new stores open; their categories
+# overlap and differ in size. A store is due for a crawl when it is new or
+# was last crawled more than --max-age runs ago, like with
+# FRESHNESS_MAX_AGE. Each run follows the spider: CITIES_PER_RUN cities,
+# their city page, every category feed, then the due stores of each feed
+# that were not seen before in the run, all served in priority order (FIFO
+# within a priority, like Scrapy's memory queues) until --budget requests
+# are spent. The "random" policy shuffles the cities and leaves every
+# priority at 0; "yield" uses scheduling.YieldTracker as the spider does.
+# Reported: due stores fetched per request, after --warmup runs.
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import zlib
+
+from ubereats_crawler.scheduling import YieldTracker
+
+
+class SimulatedSite:
+
+    def __init__(self, cities, seed=0):
+        rng = random.Random(seed)
+        self.rng = rng
+        self.cities = {}
+        for i in range(cities):
+            size = int(min(3000, rng.lognormvariate(5, 1)) + 10)
+            categories = []
+            for k in range(rng.randint(8, 40)):
+                share = rng.choice([0.02, 0.05, 0.1, 0.3, 0.6])
+                categories.append((f'/category/city{i}/cat-{k}', share))
+            self.cities[f'city{i}-ca'] = {
+                'stores': list(range(size)),
+                'categories': categories,
+                # new stores per run, as a fraction of the city
+                'growth': rng.choice([0.0, 0.005, 0.02, 0.08]),
+            }
+        self._next_store = itertools.count(10 ** 6)
+
+    def grow(self):
+        for city in self.cities.values():
+            new = int(len(city['stores']) * city['growth'] + self.rng.random())
+            city['stores'].extend(next(self._next_store) for _ in range(new))
+
+    def feed(self, city, category):
+        # a stable sample of the city's stores, new stores included
+        share = dict(self.cities[city]['categories'])[category]
+        return [store for store in self.cities[city]['stores']
+                if zlib.crc32(f'{category}/{store}'.encode()) < share * 2 ** 32]
+
+
+def simulate(site, policy, runs, budget, cities_per_run, max_age, warmup, path, seed):
+    tracker = YieldTracker(path, seed=seed) if policy == 'yield' else None
+    rng = random.Random(seed)
+    crawled = {}
+    fetched_total = requests_total = 0
+    for run in range(runs):
+        site.grow()
+        cities = list(site.cities)
+        rng.shuffle(cities)
+        cities = tracker.choose_cities(cities, cities_per_run) if tracker else cities[:cities_per_run]
+        order = itertools.count()
+        queue = []
+
+        def push(priority, request):
+            heapq.heappush(queue, (-priority, next(order), request))
+
+        for city in cities:
+            push(tracker.city_priority(city) if tracker else 0, ('city', city, None))
+        seen, requests, fetched = set(), 0, 0
+        while queue and requests < budget:
+            negated, _, (kind, city, key) = heapq.heappop(queue)
+            requests += 1
+            if kind == 'city':
+                if tracker:
+                    tracker.city_requested(city)
+                for category, _ in site.cities[city]['categories']:
+                    push(tracker.category_priority(category, city) if tracker else 0,
+                         ('category', city, category))
+            elif kind == 'category':
+                scheduled = []
+                for store in site.feed(city, key):
+                    if (city, store) in seen:
+                        continue
+                    seen.add((city, store))
+                    if run - crawled.get((city, store), -max_age - 1) > max_age:
+                        scheduled.append(store)
+                if tracker:
+                    tracker.category_crawled(key, city, len(scheduled))
+                for store in scheduled:
+                    push(-negated, ('store', city, store))
+            else:
+                crawled[(city, key)] = run
+                fetched += 1
+        if tracker:
+            tracker.save()
+        if run >= warmup:
+            fetched_total += fetched
+            requests_total += requests
+    if tracker:
+        tracker.close()
+    return {'policy': policy, 'stores_per_request': fetched_total / requests_total,
+            'stores_fetched': fetched_total, 'requests': requests_total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the spider scheduling policies.')
+    parser.add_argument('--cities', type=int, default=400)
+    parser.add_argument('--cities-per-run', type=int, default=32)
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--budget', type=int, default=3000, help='requests per run')
+    parser.add_argument('--max-age', type=int, default=7, help='runs a crawled store stays fresh')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_scheduling_')
+    results = []
+    try:
+        for policy in ['random', 'yield']:
+            site = SimulatedSite(args.cities, args.seed)
+            result = simulate(site, policy, args.runs, args.budget, args.cities_per_run,
+                              args.max_age, args.warmup, os.path.join(workdir, f'{policy}.sqlite3'),
+                              args.seed)
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
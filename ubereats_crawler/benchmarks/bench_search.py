@@ -0,0 +1,116 @@
+# Query latency of search.VectorIndex over a synthetic snapshot.
+#
+#   python -m benchmarks.bench_search --items 1000000 --dtype float32
+#
+# Builds a snapshot of clustered random unit vectors (stored the way the
+# pipeline stores embeddings) in a temporary directory, then times top-k
+# queries with precomputed query vectors, so the numbers exclude the CLIP
+# text encoder. Exact search is compared with the inverted file index
+# (trained with --lists, sqrt(items) by default) for each --nprobe, with the
+# recall of the exact top k.
+
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from ubereats_crawler.codec import encode_embedding
+from ubereats_crawler.search import VectorIndex
+
+
+def synthetic_stores(n_items, dim, items_per_store, topics=2000, seed=0):
+    # dishes cluster around a few thousand topics, like real menus do
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    for store in range(0, n_items, items_per_store):
+        count = min(items_per_store, n_items - store)
+        vectors = centers[rng.integers(topics, size=count)]
+        vectors = vectors + 0.7 * rng.standard_normal((count, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        items = [{'uuid': f'{store}-{i}', 'title': f'item {store + i}',
+                  'text_embedding': encode_embedding(vector, 'int8')}
+                 for i, vector in enumerate(vectors)]
+        yield {'_id': f'store-{store}', 'catalogSectionsMap': {
+            'menu': [{'payload': {'standardItemsPayload': {'catalogItems': items}}}]}}
+
+
+def measure(index, queries, k, nprobe):
+    index.search_vectors(queries[0], k, nprobe=nprobe)
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, rows = index.search_vectors(query, k, nprobe=nprobe)
+        latencies.append(time.perf_counter() - start)
+        found.append(rows[0])
+    latencies.sort()
+    return found, {
+        'query_p50_ms': 1000 * statistics.median(latencies),
+        'query_p99_ms': 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VectorIndex queries.')
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--items-per-store', type=int, default=100)
+    parser.add_argument('--dtype', choices=['float32', 'int8'], default='float32')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--lists', type=int, help='inverted file lists, sqrt(items) by default')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='bench_search_')
+    try:
+        index = VectorIndex(path, dtype=args.dtype)
+        start = time.perf_counter()
+        batch = []
+        for doc in synthetic_stores(args.items, args.dim, args.items_per_store):
+            batch.append(doc)
+            if len(batch) == 100:
+                index.upsert_stores(batch)
+                batch = []
+        index.upsert_stores(batch)
+        build_seconds = time.perf_counter() - start
+
+        # queries near stored items, like a text query near matching dishes
+        vectors, scales = index._matrix()
+        rng = np.random.default_rng(1)
+        rows = rng.choice(len(index), args.queries, replace=False)
+        queries = index._rows_as_float(vectors, scales, np.sort(rows))
+        queries += 0.5 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(args.dim)
+
+        result = {
+            'items': len(index),
+            'dim': args.dim,
+            'dtype': args.dtype,
+            'k': args.k,
+            'build_seconds': build_seconds,
+        }
+        exact, result['exact'] = measure(index, queries, args.k, nprobe=0)
+        start = time.perf_counter()
+        index.train(args.lists)
+        result['train_seconds'] = time.perf_counter() - start
+        for nprobe in args.nprobe:
+            found, result[f'ivf_nprobe_{nprobe}'] = measure(index, queries, args.k, nprobe)
+            result[f'ivf_nprobe_{nprobe}']['recall'] = float(np.mean(
+                [len(set(a) & set(b)) / len(a) for a, b in zip(exact, found)]))
+        index.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
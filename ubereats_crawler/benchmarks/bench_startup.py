@@ -0,0 +1,89 @@
+# Cold-start benchmark: how long a fresh crawler process takes, and how much
+# memory it holds, before its first request goes out.
+#
+#   python -m benchmarks.bench_startup --repeat 3 --output startup.json
+#
+# Measures, each in a new Python process:
+#   - importing ubereats_crawler.pipelines (time and peak RSS)
+#   - a one-city crawl of the local mock site in several modes: dry run,
+#     deferred enrichment, inline enrichment with the model loaded lazily and
+#     with CLIP_WARMUP; reporting the startup/* stats of the StartupStats
+#     extension and the pipeline (seconds to spider open and to the first
+#     response, RSS at both points, model load time).
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+IMPORT_SCRIPT = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import ubereats_crawler.pipelines
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"seconds": elapsed,
+                  "peak_rss_bytes": peak if sys.platform == "darwin" else peak * 1024,
+                  "torch_imported": "torch" in sys.modules}))
+'''
+
+MODES = {
+    'dry-run': ['--mongo', 'dry-run'],
+    'deferred': ['--mongo', 'mongomock', '--set', 'ENRICHMENT_MODE=deferred'],
+    'inline-lazy': ['--mongo', 'mongomock'],
+    'inline-warmup': ['--mongo', 'mongomock', '--set', 'CLIP_WARMUP=True'],
+}
+
+
+def measure_import():
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_crawl(mode, args, workdir):
+    output = os.path.join(workdir, f'{mode}.json')
+    command = [sys.executable, '-m', 'benchmarks.bench_crawl', '--cities', '1',
+               '--stores-per-city', str(args.stores), '--stores-per-category', str(args.stores),
+               '--categories', '1', '--items', str(args.items),
+               '--output', output] + MODES[mode]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        result = json.load(f)
+    stats = {key: value for key, value in result['stats'].items() if key.startswith('startup/')}
+    stats['peak_rss_bytes'] = result['peak_rss_bytes']
+    stats['elapsed_seconds'] = result['elapsed_seconds']
+    return stats
+
+
+def summarize(runs):
+    keys = sorted({key for run in runs for key in run})
+    return {key: statistics.median(run[key] for run in runs if key in run) for key in keys}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark crawler cold start.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stores', type=int, default=5, help='stores in the crawled city')
+    parser.add_argument('--items', type=int, default=20, help='menu items per store')
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    result = {'import_pipelines': summarize([measure_import() for _ in range(args.repeat)])}
+    for mode in args.modes:
+        result[mode] = summarize([measure_crawl(mode, args, workdir) for _ in range(args.repeat)])
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Local stand-in for the parts of www.ubereats.com the spider talks to:
+#
+#   GET  /city/<city>          city page listing the category paths
+#   POST /api/getSeoFeedV1     stores of a category, {"pathname": ...}
+#   POST /api/getStoreV1       store info and menus, {"storeUuid": ...}
+#   GET  /geocode              Azure Maps style address search
+#
+# Everything is generated deterministically from the configuration, so two
+# runs with the same configuration crawl exactly the same site. Store uuids
+# encode the city and store index they belong to. With --capacity, API calls
+# beyond that many in flight are answered with "status: failure", like an
+# overloaded API; --latency adds a fixed service time to every API call.
+#
+#   python -m benchmarks.mock_server --port 8080 --cities 4 --items 100
+
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid as uuidlib
+import zlib
+
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from .synthetic import make_store
+
+
+class MockSiteConfig:
+
+    def __init__(self, cities=4, categories=8, stores_per_city=100,
+                 stores_per_category=30, items=100, failure_rate=0.0,
+                 missing_location_rate=0.05, capacity=0, latency=0.0, seed=0,
+                 nested_categories=0.0, malformed_rate=0.0):
+        self.cities = cities
+        self.categories = categories
+        self.stores_per_city = stores_per_city
+        self.stores_per_category = min(stores_per_category, stores_per_city)
+        self.items = items
+        self.failure_rate = failure_rate
+        self.missing_location_rate = missing_location_rate
+        self.capacity = capacity
+        self.latency = latency
+        self.seed = seed
+        self.nested_categories = nested_categories
+        self.malformed_rate = malformed_rate
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def city_slugs(self):
+        return [f'city{i}-ca' for i in range(self.cities)]
+
+    def city_index(self, slug):
+        match = re.fullmatch(r'city(\d+)-ca', slug)
+        return int(match.group(1)) if match else None
+
+    def category_paths(self, slug):
+        return [f'/category/{slug}/cat-{k}' for k in range(self.categories)]
+
+    def store_uuid(self, city, store):
+        return str(uuidlib.UUID(int=(self.seed << 96) | (city << 32) | store))
+
+    def category_stores(self, slug, category):
+        # categories of a city overlap, like "burgers" and "fast-food" do
+        city = self.city_index(slug)
+        return [self.store_uuid(city, store) for store in self._category_picks(city, category)]
+
+    def _category_picks(self, city, category):
+        rng = random.Random(hash((self.seed, city, category)))
+        nested = random.Random(hash((self.seed, city, category, 1))).random() < self.nested_categories
+        if category and nested:
+            # half of the stores of a broader category, like "burgers" of
+            # "fast-food"
+            broader = self._category_picks(city, rng.randrange(category))
+            return rng.sample(broader, max(1, len(broader) // 2))
+        return rng.sample(range(self.stores_per_city), self.stores_per_category)
+
+    def malformed(self, key):
+        # the same category feeds and stores are malformed on every request,
+        # so retrying them never helps
+        return zlib.crc32(f'{self.seed}/{key}'.encode()) < self.malformed_rate * 2 ** 32
+
+    def store(self, store_uuid):
+        value = uuidlib.UUID(store_uuid).int
+        city, store = (value >> 32) & 0xffffffff, value & 0xffffffff
+        data = make_store(self.items, seed=value, store_uuid=store_uuid,
+                          city=f'city{city}-ca')
+        if random.Random(value).random() < self.missing_location_rate:
+            del data['location']['latitude'], data['location']['longitude']
+        return data
+
+
+def make_handler(config):
+    failures = random.Random(config.seed)
+    in_flight = [0]
+    lock = threading.Lock()
+
+    @lru_cache(maxsize=4096)
+    def store_body(store_uuid):
+        return json.dumps({'status': 'success', 'data': config.store(store_uuid)}).encode()
+
+    def city_page(slug):
+        links = ''.join(f'<a href="{path}">{path.rsplit("/", 1)[-1]}</a>'
+                        for path in [f'/city/{slug}'] + config.category_paths(slug))
+        return (f'<html><body><main id="main-content"><div></div><div></div><div></div>'
+                f'<div>{links}</div></main></body></html>').encode()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, content_type='application/json', status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _failed(self):
+            return config.failure_rate and failures.random() < config.failure_rate
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path.startswith('/city/'):
+                slug = path[len('/city/'):]
+                if config.city_index(slug) is None:
+                    return self._send(b'not found', 'text/plain', 404)
+                return self._send(city_page(slug), 'text/html; charset=utf-8')
+            if path == '/geocode':
+                body = {'summary': {'totalResults': 1},
+                        'results': [{'position': {'lat': 37.87, 'lon': -122.27}}]}
+                return self._send(json.dumps(body).encode())
+            return self._send(b'not found', 'text/plain', 404)
+
+        def do_POST(self):
+            with lock:
+                in_flight[0] += 1
+                overloaded = config.capacity and in_flight[0] > config.capacity
+            try:
+                if config.latency:
+                    time.sleep(config.latency)
+                if overloaded:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    return self._send(b'{"status": "failure", "data": {}}')
+                return self._post()
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        def _post(self):
+            path = urlparse(self.path).path
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self._failed():
+                return self._send(b'{"status": "failure", "data": {}}')
+            if path == '/api/getSeoFeedV1':
+                if config.malformed(body['pathname']):
+                    # a "success" answer without the feed element
+                    return self._send(b'{"status": "success", "data": {"elements": []}}')
+                _, _, slug, category = body['pathname'].split('/')
+                stores = config.category_stores(slug, int(category.rsplit('-', 1)[-1]))
+                feed = {'status': 'success', 'data': {'elements': [
+                    {}, {}, {}, {}, {'feedItems': [{'uuid': uuid} for uuid in stores]}]}}
+                return self._send(json.dumps(feed).encode())
+            if path == '/api/getStoreV1':
+                if config.malformed(body['storeUuid']):
+                    return self._send(b'{"status": "success", "data": {}}')
+                return self._send(store_body(body['storeUuid']))
+            return self._send(b'not found', 'text/plain', 404)
+
+    return Handler
+
+
+def serve(config, port=0, ready=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(config))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+def start_in_subprocess(config):
+    '''
+    Serve `config` from a child process; returns (process, base url).
+    '''
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(config, 0, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, f'http://127.0.0.1:{port}'
+
+
+def add_site_arguments(parser):
+    parser.add_argument('--cities', type=int, default=4)
+    parser.add_argument('--categories', type=int, default=8, help='categories per city')
+    parser.add_argument('--stores-per-city', type=int, default=100)
+    parser.add_argument('--stores-per-category', type=int, default=30)
+    parser.add_argument('--items', type=int, default=100, help='menu items per store')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='share of API calls answered with status: failure')
+    parser.add_argument('--missing-location-rate', type=float, default=0.05,
+                        help='share of stores without coordinates, which need geocoding')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='API calls in flight beyond which the API fails, unlimited when 0')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every API call takes')
+    parser.add_argument('--nested-categories', type=float, default=0.0,
+                        help='share of categories listing only stores of a broader category')
+    parser.add_argument('--malformed-rate', type=float, default=0.0,
+                        help='share of category feeds and stores always answered with a '
+                             'malformed "success" body')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return MockSiteConfig(
+        cities=args.cities,
+        categories=args.categories,
+        stores_per_city=args.stores_per_city,
+        stores_per_category=args.stores_per_category,
+        items=args.items,
+        failure_rate=args.failure_rate,
+        missing_location_rate=args.missing_location_rate,
+        capacity=args.capacity,
+        latency=args.latency,
+        seed=args.seed,
+        nested_categories=args.nested_categories,
+        malformed_rate=args.malformed_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic Uber Eats site.')
+    parser.add_argument('--port', type=int, default=8080)
+    add_site_arguments(parser)
+    args = parser.parse_args()
+    print(f'Serving on http://127.0.0.1:{args.port}')
+    serve(config_from_args(args), args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Synthetic Uber Eats payloads shaped like the real getStoreV1 responses.
+
+import json
+import random
+import uuid as uuidlib
+
+WORDS = (
+    "chicken beef pork tofu spicy crispy grilled fried garlic cheese burger "
+    "salad sandwich rice noodle soup taco burrito pizza sauce fresh house "
+    "classic double large small combo meal side drink sweet sour lemon"
+).split()
+
+
+def _words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def make_catalog_item(rng):
+    return {
+        'uuid': str(uuidlib.UUID(int=rng.getrandbits(128))),
+        'title': _words(rng, rng.randint(1, 4)).title(),
+        'itemDescription': _words(rng, rng.randint(0, 25)) or None,
+        'imageUrl': f'https://example.com/{rng.getrandbits(64):x}.jpg',
+        'price': rng.randint(100, 3000),
+        'priceTagline': {'text': '', 'accessibilityText': ''},
+        'isSoldOut': False,
+        'hasCustomizations': rng.random() < 0.3,
+        'isAvailable': True,
+        'numAlcoholicItems': 0,
+        'subsectionUuid': str(uuidlib.UUID(int=rng.getrandbits(128))),
+        'sectionUuid': str(uuidlib.UUID(int=rng.getrandbits(128))),
+    }
+
+
+def make_store(n_items, seed=0, store_uuid=None, city='berkeley-ca', duplicate_ratio=0.05):
+    '''
+    Build the `data` object of a getStoreV1 response with `n_items` menu
+    items. A fraction of the items is listed in a second section as well,
+    like popular items are on the real site.
+    '''
+    rng = random.Random(seed)
+    store_uuid = store_uuid or str(uuidlib.UUID(int=rng.getrandbits(128)))
+    items = [make_catalog_item(rng) for _ in range(n_items)]
+    sections = []
+    per_section = 25
+    for start in range(0, n_items, per_section):
+        sections.append({
+            'uuid': str(uuidlib.UUID(int=rng.getrandbits(128))),
+            'type': 'HORIZONTAL_GRID',
+            'payload': {
+                'type': 'standardItemsPayload',
+                'standardItemsPayload': {
+                    'title': {'text': _words(rng, 2).title()},
+                    'catalogItems': items[start:start + per_section],
+                },
+            },
+        })
+    popular = [dict(item) for item in items if rng.random() < duplicate_ratio]
+    if popular:
+        sections.insert(0, {
+            'uuid': str(uuidlib.UUID(int=rng.getrandbits(128))),
+            'type': 'HORIZONTAL_GRID',
+            'payload': {'standardItemsPayload': {'title': {'text': 'Popular'},
+                                                 'catalogItems': popular}},
+        })
+    menu_uuid = str(uuidlib.UUID(int=rng.getrandbits(128)))
+    title = _words(rng, 2).title()
+    return {
+        'uuid': store_uuid,
+        'title': title,
+        'slug': title.lower().replace(' ', '-'),
+        'location': {
+            'address': f'{rng.randint(1, 9999)} Main St, {city}',
+            'streetAddress': f'{rng.randint(1, 9999)} Main St',
+            'city': city,
+            'country': 'US',
+            'postalCode': f'{rng.randint(10000, 99999)}',
+            'latitude': rng.uniform(25, 48),
+            'longitude': rng.uniform(-124, -70),
+        },
+        'hours': [{'dayRange': 'Every day',
+                   'sectionHours': [{'startTime': 600, 'endTime': 1320,
+                                     'sectionTitle': 'Menu'}]}],
+        'categories': [_words(rng, 1) for _ in range(3)],
+        'sections': [{'uuid': menu_uuid, 'title': 'Menu', 'subtitle': '',
+                      'isTop': True, 'isOnSale': True,
+                      'subsectionUuids': [s['uuid'] for s in sections]}],
+        'storeReviews': [{'eaterName': _words(rng, 1).title(),
+                          'reviewText': _words(rng, 20),
+                          'rating': rng.randint(1, 5),
+                          'timeSinceReview': '2 weeks ago',
+                          'tags': []} for _ in range(rng.randint(0, 10))],
+        'catalogSectionsMap': {menu_uuid: sections},
+        'metaJson': json.dumps({'@context': 'https://schema.org',
+                                '@type': 'Restaurant',
+                                '@id': f'https://www.ubereats.com/store/{store_uuid}',
+                                'name': title}),
+    }
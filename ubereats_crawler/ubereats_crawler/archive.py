@@ -0,0 +1,38 @@
+# Opt-in archive of raw API responses.
+#
+# With the item projection enabled only whitelisted fields reach the
+# pipeline. Set RAW_ARCHIVE_PATH to also keep every raw getStoreV1 body, one
+# JSON document per line in a gzip file, e.g. to backfill a field later.
+
+import gzip
+import logging
+import os
+import time
+
+
+class RawArchive:
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._file = gzip.open(path, 'ab', compresslevel=5)
+        self.count = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('RAW_ARCHIVE_PATH')
+        if not path:
+            return None
+        # one file per run, e.g. "archive/stores-%(time)s.jsonl.gz"
+        return cls(path % {'time': time.strftime('%Y%m%dT%H%M%S')})
+
+    def write(self, body):
+        self._file.write(body.replace(b'\n', b' '))
+        self._file.write(b'\n')
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+        logging.info(f'RawArchive: {self.count} responses archived to {self.path}')
@@ -0,0 +1,186 @@
+# Cross-store batching of embedding work.
+#
+# The pipeline submits the texts of every menu item of a store and gets a
+# Deferred back. Texts of many stores are packed together into batches of up
+# to `max_batch_size` texts which are encoded on a worker thread pool, so the
+# reactor keeps downloading while the CPU is busy encoding.
+
+import logging
+import time
+
+import numpy as np
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from .instrumentation import observe
+
+
+class _EmbeddingRequest:
+
+    __slots__ = ('texts', 'deferred', 'parts', 'taken', 'remaining')
+
+    def __init__(self, texts, deferred):
+        self.texts = texts
+        self.deferred = deferred
+        self.parts = []
+        # texts handed to a batch so far / texts still waiting for a result
+        self.taken = 0
+        self.remaining = len(texts)
+
+
+class EmbeddingBatcher:
+    '''
+    Encode texts in large cross-store batches on a worker thread pool.
+
+    `encode` is called from a worker thread with a list of texts and must
+    return an array-like of shape (len(texts), dim). `submit` returns a
+    Deferred firing with a float32 numpy array holding one row per text,
+    in the order the texts were submitted.
+
+    A batch is flushed as soon as `max_batch_size` texts are queued, or
+    `max_wait` seconds after the first text of a partial batch was queued.
+    '''
+
+    def __init__(self, encode, max_batch_size=1000, max_wait=0.5, workers=1,
+                 stats=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._encode = encode
+        self._max_batch_size = max(1, int(max_batch_size))
+        self._max_wait = max_wait
+        self._stats = stats
+
+        self._queue = []
+        self._queued = 0
+        self._timer = None
+        self._in_flight = set()
+
+        self._pool = ThreadPool(minthreads=1, maxthreads=max(1, int(workers)),
+                                name='EmbeddingBatcher')
+        self._pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._pool.stop)
+
+    @classmethod
+    def from_settings(cls, encode, settings, stats=None):
+        return cls(
+            encode,
+            max_batch_size=settings.getint('EMBEDDING_BATCH_SIZE', 1000),
+            max_wait=settings.getfloat('EMBEDDING_MAX_WAIT', 0.5),
+            workers=settings.getint('EMBEDDING_WORKERS', 1),
+            stats=stats,
+        )
+
+    def submit(self, texts):
+        '''
+        Queue `texts` for encoding and return a Deferred with their embeddings.
+        '''
+        d = defer.Deferred()
+        if not texts:
+            d.callback(np.empty((0, 0), dtype=np.float32))
+            return d
+
+        self._queue.append(_EmbeddingRequest(list(texts), d))
+        self._queued += len(texts)
+        while self._queued >= self._max_batch_size:
+            self._flush(self._max_batch_size)
+        if self._queue and self._timer is None:
+            self._timer = self._reactor.callLater(self._max_wait, self._on_timeout)
+        return d
+
+    def flush(self):
+        '''
+        Send everything queued so far to the workers.
+        '''
+        while self._queue:
+            self._flush(self._max_batch_size)
+
+    def close(self):
+        '''
+        Flush the queue and return a Deferred firing once every batch is done.
+        '''
+        self.flush()
+        d = defer.DeferredList(list(self._in_flight), consumeErrors=True)
+
+        def _stop(_):
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._pool.stop()
+
+        d.addBoth(_stop)
+        return d
+
+    def _on_timeout(self):
+        self._timer = None
+        self.flush()
+
+    def _flush(self, limit):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        # take up to `limit` texts from the head of the queue, splitting the
+        # last request if it does not fit into this batch entirely
+        chunks = []
+        texts = []
+        while self._queue and len(texts) < limit:
+            request = self._queue[0]
+            start = request.taken
+            take = min(limit - len(texts), len(request.texts) - start)
+            request.taken += take
+            chunks.append((request, start, start + take))
+            texts.extend(request.texts[start:start + take])
+            if request.taken == len(request.texts):
+                self._queue.pop(0)
+        self._queued -= len(texts)
+        if not texts:
+            return
+
+        if self._stats:
+            self._stats.inc_value('embedding/batches')
+            self._stats.inc_value('embedding/items', len(texts))
+            self._stats.max_value('embedding/max_batch_size', len(texts))
+
+        d = threads.deferToThreadPool(self._reactor, self._pool, self._encode_timed, texts)
+        self._in_flight.add(d)
+        d.addBoth(self._batch_done, d)
+        d.addCallbacks(self._deliver, self._fail, callbackArgs=(chunks,), errbackArgs=(chunks,))
+
+    def _encode_timed(self, texts):
+        # runs in a worker thread
+        start = time.perf_counter()
+        embeddings = self._encode(texts)
+        if self._stats:
+            self._reactor.callFromThread(observe, self._stats, 'encode', time.perf_counter() - start)
+        return embeddings
+
+    def _batch_done(self, result, d):
+        self._in_flight.discard(d)
+        return result
+
+    def _deliver(self, embeddings, chunks):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        offset = 0
+        for request, start, end in chunks:
+            n = end - start
+            if request.deferred.called:
+                # another part of this request already failed
+                offset += n
+                continue
+            # batches may finish out of order when there are several workers
+            request.parts.append((start, embeddings[offset:offset + n]))
+            offset += n
+            request.remaining -= n
+            if request.remaining == 0:
+                parts = [part for _, part in sorted(request.parts, key=lambda p: p[0])]
+                request.parts = []
+                request.deferred.callback(parts[0] if len(parts) == 1 else np.concatenate(parts))
+
+    def _fail(self, failure, chunks):
+        logging.error(f'EmbeddingBatcher: batch of {sum(e - s for _, s, e in chunks)} texts failed: {failure.value}')
+        if self._stats:
+            self._stats.inc_value('embedding/failed_batches')
+        for request, _, _ in chunks:
+            if not request.deferred.called:
+                request.deferred.errback(failure)
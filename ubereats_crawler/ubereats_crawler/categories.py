@@ -0,0 +1,128 @@
+# Category lists and category overlap, remembered across runs.
+#
+# A city page lists a few dozen category paths, and the getSeoFeedV1 feeds
+# of those categories overlap heavily: a store of "burgers" is usually in
+# "fast-food" and "late-night" too. CategoryIndex keeps in a small SQLite
+# file
+#   - the category paths of each city page, for CATEGORY_LIST_TTL seconds,
+#     so the city page is not downloaded and parsed again every run
+#   - the stores each category feed listed the last time it was fetched
+#
+# With the latter, `plan` picks which feeds of a city to request: largest
+# first, a category is skipped when every store it listed is also listed
+# by a category already picked, as long as both lists are at most
+# CATEGORY_OVERLAP_MAX_AGE seconds old. Categories never fetched, or whose
+# list is older, are always requested, which refreshes their list. A store
+# that only appears in a skipped category since it was last fetched is
+# found once that list expires.
+
+import json
+import logging
+import time
+
+from .localstore import chunked, connect_sqlite
+
+
+class CategoryIndex:
+    '''
+    Cached category lists of cities, and the stores of category feeds.
+    '''
+
+    def __init__(self, path, list_ttl=3 * 24 * 3600, overlap_max_age=7 * 24 * 3600):
+        self.path = path
+        self.list_ttl = list_ttl
+        self.overlap_max_age = overlap_max_age
+        self._conn = connect_sqlite(path)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS city_categories (
+                city TEXT PRIMARY KEY,
+                paths TEXT NOT NULL,
+                fetched REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS category_stores (
+                path TEXT PRIMARY KEY,
+                city TEXT NOT NULL,
+                stores TEXT NOT NULL,
+                fetched REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS category_stores_city ON category_stores (city);
+        ''')
+        # feeds fetched by this run, written by `save`
+        self._feeds = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('CATEGORY_CACHE_PATH')
+        if not path:
+            return None
+        return cls(path,
+                   list_ttl=settings.getfloat('CATEGORY_LIST_TTL', 3 * 24 * 3600),
+                   overlap_max_age=settings.getfloat('CATEGORY_OVERLAP_MAX_AGE', 7 * 24 * 3600))
+
+    def close(self):
+        self.save()
+        self._conn.close()
+
+    # category lists of city pages
+
+    def categories(self, city):
+        '''
+        The category paths of `city` if its page was parsed less than
+        `list_ttl` seconds ago, else None.
+        '''
+        row = self._conn.execute(
+            'SELECT paths, fetched FROM city_categories WHERE city = ?', (city,)).fetchone()
+        if row is None or time.time() - row[1] > self.list_ttl:
+            return None
+        return json.loads(row[0])
+
+    def put_categories(self, city, paths):
+        if not paths:
+            # most likely a page that failed to render, try again next run
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO city_categories (city, paths, fetched) VALUES (?, ?, ?)',
+            (city, json.dumps(paths), time.time()))
+
+    # category feeds
+
+    def feed_fetched(self, category, city, uuids):
+        '''
+        Record that the feed of `category` in `city` listed `uuids`.
+        '''
+        self._feeds[category] = (city, sorted(set(uuids)))
+
+    def plan(self, city, paths):
+        '''
+        Split the category paths of `city` into the ones to request and the
+        ones whose stores the requested ones are known to list, in the order
+        of `paths`.
+        '''
+        known = self._known_stores(city)
+        # categories with an unknown feed are requested, but cover nothing
+        covered, skip = set(), set()
+        for path in sorted((path for path in paths if path in known),
+                           key=lambda path: len(known[path]), reverse=True):
+            if known[path] <= covered:
+                skip.add(path)
+            else:
+                covered |= known[path]
+        return ([path for path in paths if path not in skip],
+                [path for path in paths if path in skip])
+
+    def _known_stores(self, city):
+        oldest = time.time() - self.overlap_max_age
+        return {path: set(json.loads(stores)) for path, stores in self._conn.execute(
+            'SELECT path, stores FROM category_stores WHERE city = ? AND fetched >= ?',
+            (city, oldest))}
+
+    def save(self):
+        if not self._feeds:
+            return
+        now = time.time()
+        self._conn.execute('BEGIN')
+        for chunk in chunked(list(self._feeds.items())):
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO category_stores (path, city, stores, fetched) VALUES (?, ?, ?, ?)',
+                [(path, city, json.dumps(uuids), now) for path, (city, uuids) in chunk])
+        self._conn.execute('COMMIT')
+        logging.info(f'CategoryIndex: stores of {len(self._feeds)} category feeds saved to {self.path}')
+        self._feeds.clear()
@@ -0,0 +1,113 @@
+# Binary storage format of menu item embeddings.
+#
+# An encoded embedding is a 12 byte header followed by the raw vector:
+#
+#   magic   2s   b'UE'
+#   version B    format version, currently 1
+#   dtype   B    1 = float32, 2 = float16, 3 = int8
+#   dim     H    number of components
+#   -       H    reserved, keeps the payload 4-byte aligned
+#   scale   f    int8 only: component = stored value * scale
+#
+# All fields are little endian. Embeddings written before this format
+# existed are zlib compressed pickles of a list of floats; they are still
+# decoded transparently.
+
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+from bson.binary import Binary
+
+MAGIC = b'UE'
+VERSION = 1
+HEADER = struct.Struct('<2sBBHHf')
+
+# BSON binary subtype for user defined formats
+BINARY_SUBTYPE = 0x80
+
+DTYPES = {
+    'float32': (1, np.dtype('<f4')),
+    'float16': (2, np.dtype('<f2')),
+    'int8': (3, np.dtype('i1')),
+}
+_DTYPE_BY_CODE = {code: dtype for code, dtype in DTYPES.values()}
+
+# storage dtype of new embeddings; lossy int8 is opt-in
+DEFAULT_DTYPE = 'float16'
+
+
+def encode_embedding(vector, dtype=DEFAULT_DTYPE):
+    '''
+    Encode a 1-d vector into a BSON Binary in the given storage dtype.
+    '''
+    try:
+        code, np_dtype = DTYPES[dtype]
+    except KeyError:
+        raise ValueError(f'Unknown embedding dtype {dtype!r}, expected one of {sorted(DTYPES)}.')
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    scale = 1.0
+    if code == DTYPES['int8'][0]:
+        # symmetric scalar quantization
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        payload = np.clip(np.rint(vector / scale), -127, 127).astype(np_dtype)
+    else:
+        payload = vector.astype(np_dtype)
+    header = HEADER.pack(MAGIC, VERSION, code, vector.size, 0, scale)
+    return Binary(header + payload.tobytes(), BINARY_SUBTYPE)
+
+
+def is_legacy_embedding(blob):
+    return bytes(blob[:2]) != MAGIC
+
+
+def decode_embedding(blob):
+    '''
+    Decode a single embedding.
+
+    float32 and float16 embeddings are returned as a read-only view of
+    `blob` in their storage dtype; int8 and legacy pickled embeddings are
+    returned as a new float32 array.
+    '''
+    if is_legacy_embedding(blob):
+        return np.asarray(pickle.loads(zlib.decompress(blob)), dtype=np.float32)
+    _, version, code, dim, _, scale = HEADER.unpack_from(blob)
+    if version != VERSION:
+        raise ValueError(f'Unsupported embedding format version {version}.')
+    vector = np.frombuffer(blob, dtype=_DTYPE_BY_CODE[code], count=dim, offset=HEADER.size)
+    if code == DTYPES['int8'][0]:
+        return vector.astype(np.float32) * np.float32(scale)
+    return vector
+
+
+def decode_embeddings(blobs):
+    '''
+    Decode many embeddings into a single (len(blobs), dim) float32 matrix.
+
+    When every blob uses the current format with the same dtype and size,
+    which is the common case for a collection, the whole batch is decoded
+    with one structured `frombuffer` call.
+    '''
+    blobs = list(blobs)
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    first = blobs[0]
+    if not is_legacy_embedding(first):
+        size = len(first)
+        _, version, code, dim, _, _ = HEADER.unpack_from(first)
+        prefix = bytes(first[:HEADER.size - 4])
+        if version == VERSION and all(len(b) == size and bytes(b[:HEADER.size - 4]) == prefix for b in blobs):
+            record = np.dtype([
+                ('header', 'V8'),
+                ('scale', '<f4'),
+                ('vector', _DTYPE_BY_CODE[code], (dim,)),
+            ])
+            records = np.frombuffer(b''.join(blobs), dtype=record)
+            matrix = records['vector'].astype(np.float32)
+            if code == DTYPES['int8'][0]:
+                matrix *= records['scale'][:, None]
+            return matrix
+    return np.stack([np.asarray(decode_embedding(b), dtype=np.float32) for b in blobs])
@@ -0,0 +1,156 @@
+# Persistent, content addressed cache of text embeddings.
+#
+# Chain restaurants share most of their menu, so the same item texts are
+# encoded over and over again across stores and recrawls. Embeddings are
+# stored in a local SQLite file keyed by a hash of the model name and the
+# normalized item text, and the least recently used rows are evicted once
+# the cache grows past its size limit.
+
+import hashlib
+import logging
+import threading
+import time
+
+import numpy as np
+
+from .localstore import chunked, connect_sqlite
+
+
+def normalize_text(text):
+    # CLIP's tokenizer lower-cases and collapses whitespace itself, so texts
+    # that only differ in those respects share an embedding.
+    return ' '.join(text.split()).lower()
+
+
+def embedding_cache_key(text, model_name):
+    return hashlib.sha1(f'{model_name}\0{normalize_text(text)}'.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    '''
+    SQLite backed mapping of (model name, item text) to a float32 vector.
+
+    Safe to share between threads. `max_items` bounds the number of rows;
+    when it is exceeded the least recently used tenth of the cache is evicted.
+    '''
+
+    def __init__(self, path, model_name, max_items=500000):
+        self.model_name = model_name
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' key BLOB PRIMARY KEY,'
+            ' vector BLOB NOT NULL,'
+            ' last_used REAL NOT NULL)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._size = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('EMBEDDING_CACHE_PATH')
+        if not path:
+            return None
+        return cls(path, settings.get('CLIP_MODEL', 'ViT-B/32'),
+                   max_items=settings.getint('EMBEDDING_CACHE_MAX_ITEMS', 500000))
+
+    def __len__(self):
+        return self._size
+
+    def key(self, text):
+        return embedding_cache_key(text, self.model_name)
+
+    def get_many(self, keys):
+        '''
+        Return a dict with the cached vector of every key that is present.
+        '''
+        found = {}
+        now = time.time()
+        with self._lock:
+            for chunk in chunked(keys):
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({marks})', chunk)
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                self._conn.execute('BEGIN')
+                for chunk in chunked(found):
+                    marks = ','.join('?' * len(chunk))
+                    self._conn.execute(
+                        f'UPDATE embeddings SET last_used = ? WHERE key IN ({marks})',
+                        [now] + chunk)
+                self._conn.execute('COMMIT')
+        return found
+
+    def put_many(self, items):
+        '''
+        Store (key, vector) pairs, evicting old rows if the cache is full.
+        '''
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute('BEGIN')
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows)
+            self._size += self._conn.total_changes - before
+            self._conn.execute('COMMIT')
+            if self._size > self.max_items:
+                self._evict(self._size - self.max_items + self.max_items // 10)
+
+    def _evict(self, count):
+        self._conn.execute(
+            'DELETE FROM embeddings WHERE key IN '
+            '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)', (count,))
+        self._size = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        logging.info(f'EmbeddingCache: evicted {count} embeddings, {self._size} left.')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEncoder:
+    '''
+    Wrap an `encode(texts)` callable so that only texts missing from the
+    cache are sent to the model. Duplicate texts within a call are encoded
+    once. Hit and miss counts are reported to the Scrapy stats collector
+    from the reactor thread.
+    '''
+
+    def __init__(self, encode, cache, stats=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._encode = encode
+        self._cache = cache
+        self._stats = stats
+        self._reactor = reactor
+
+    def __call__(self, texts):
+        keys = [self._cache.key(text) for text in texts]
+        vectors = self._cache.get_many(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        if missing:
+            encoded = np.asarray(self._encode(list(missing.values())), dtype=np.float32)
+            fresh = dict(zip(missing, encoded))
+            self._cache.put_many(fresh.items())
+            vectors.update(fresh)
+
+        self._report(len(texts) - len(missing), len(missing))
+        return np.stack([vectors[key] for key in keys])
+
+    def _report(self, hits, misses):
+        if self._stats is None:
+            return
+        self._reactor.callFromThread(self._stats.inc_value, 'embedding_cache/hits', hits)
+        self._reactor.callFromThread(self._stats.inc_value, 'embedding_cache/misses', misses)
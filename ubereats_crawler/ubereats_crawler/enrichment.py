@@ -0,0 +1,232 @@
+# Offline enrichment of crawled stores.
+#
+# With ENRICHMENT_MODE = "deferred" the crawler stores documents as they are
+# crawled and lists the enrichment stages they still need in
+# `pendingEnrichment`: "embedding" (CLIP embeddings of the menu items) and,
+# for stores without coordinates, "geocode". Workers started with
+#
+#   python -m ubereats_crawler.enrichment embedding --processes 2
+#   python -m ubereats_crawler.enrichment geocode --follow
+#
+# from the project directory claim pending documents in batches, run one
+# stage on them and write the results back. Claims are leases: documents of
+# a worker that died are claimed again once ENRICHMENT_LEASE_TIMEOUT has
+# passed. Stages are independent, so each one runs with as many processes as
+# it needs.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+from pymongo import UpdateOne
+
+from .codec import DEFAULT_DTYPE
+
+EMBEDDING = 'embedding'
+GEOCODE = 'geocode'
+
+
+class EmbeddingStage:
+    '''
+    Embed the menu items of a batch of stores with one model call. Items
+    that kept their embedding from an earlier crawl are left as they are.
+    '''
+
+    name = EMBEDDING
+    fields = ['catalogSectionsMap']
+
+    def __init__(self, encode, dtype=DEFAULT_DTYPE, model_name='ViT-B/32'):
+        self._encode = encode
+        self._dtype = dtype
+        self._model_name = model_name
+
+    @classmethod
+    def from_settings(cls, settings):
+        from .embedding_cache import CachedEncoder, EmbeddingCache
+        from .inference import text_encoder_from_settings
+
+        encode = text_encoder_from_settings(settings)
+        cache = EmbeddingCache.from_settings(settings)
+        if cache is not None:
+            encode = CachedEncoder(encode, cache)
+        return cls(encode, settings.get('EMBEDDING_STORAGE_DTYPE', DEFAULT_DTYPE),
+                   settings.get('CLIP_MODEL', 'ViT-B/32'))
+
+    def __call__(self, docs):
+        from .incremental import text_hash
+        from .pipelines import RestaurantItemFlattenTransformer, catalog_item_text, compress_embedding_weights
+
+        items = []
+        for doc in docs:
+            for item in RestaurantItemFlattenTransformer.catalog_items(doc):
+                item_hash = text_hash(catalog_item_text(item), self._model_name)
+                if 'text_embedding' not in item or item.get('text_hash') != item_hash:
+                    item['text_hash'] = item_hash
+                    items.append(item)
+        if items:
+            embeddings = self._encode([catalog_item_text(item) for item in items])
+            for item, embedding in zip(items, embeddings):
+                item['text_embedding'] = compress_embedding_weights(embedding, self._dtype)
+        now = time.time()
+        return {doc['_id']: {'catalogSectionsMap': doc.get('catalogSectionsMap', {}),
+                             'embeddingTime': now}
+                for doc in docs}
+
+
+class GeocodeStage:
+    '''
+    Geocode the addresses of stores without coordinates, `concurrency`
+    lookups at a time.
+    '''
+
+    name = GEOCODE
+    fields = ['name', 'location']
+
+    def __init__(self, geocoder, concurrency=4):
+        self._geocoder = geocoder
+        self._executor = ThreadPoolExecutor(max(1, int(concurrency)))
+
+    @classmethod
+    def from_settings(cls, settings):
+        from scrapy.utils.misc import load_object
+        from .geocoding import ArzueGeoEncoder, GeocodeCache
+
+        backend_cls = load_object(settings.get('GEOCODER_BACKEND', 'ubereats_crawler.geocoding.ArzueMapsBackend'))
+        geocoder = ArzueGeoEncoder(backend_cls.from_settings(settings),
+                                   cache=GeocodeCache.from_settings(settings),
+                                   timeout=settings.getfloat('GEOCODER_TIMEOUT', 10))
+        return cls(geocoder, settings.getint('GEOCODER_CONCURRENCY', 4))
+
+    def __call__(self, docs):
+        addresses = [doc.get('location', {}).get('address') for doc in docs]
+        results = self._executor.map(
+            lambda address: self._geocoder(address) if address else None, addresses)
+        updates = {}
+        for doc, address, coordinates in zip(docs, addresses, results):
+            if coordinates is None:
+                logging.warning(f'Could not geocode {doc.get("name")} @ {address}')
+                updates[doc['_id']] = {}
+                continue
+            lat, lon = coordinates
+            updates[doc['_id']] = {'geo': {'type': 'Point', 'coordinates': [lon, lat]}}
+        return updates
+
+
+STAGES = {stage.name: stage for stage in (EmbeddingStage, GeocodeStage)}
+
+
+class EnrichmentWorker:
+    '''
+    Claim documents pending `stage` from `collection`, `batch_size` at a
+    time, and write back what the stage returns.
+
+    A claimed document is leased for `lease_timeout` seconds. Results are
+    only written if the document was not crawled again in the meantime;
+    a newer crawl is pending enrichment again anyway.
+    '''
+
+    def __init__(self, collection, stage, batch_size=32, lease_timeout=600):
+        self._collection = collection
+        self._stage = stage
+        self._batch_size = max(1, int(batch_size))
+        self._lease_timeout = lease_timeout
+        self._lease_field = f'enrichmentLease.{stage.name}'
+        self._collection.create_index([('pendingEnrichment', pymongo.ASCENDING)])
+
+    def claim(self):
+        now = time.time()
+        available = {'pendingEnrichment': self._stage.name,
+                     '$or': [{self._lease_field: {'$exists': False}},
+                             {f'{self._lease_field}.until': {'$lt': now}}]}
+        ids = [doc['_id'] for doc in self._collection.find(
+            available, {'_id': 1}, limit=self._batch_size)]
+        if not ids:
+            return []
+        lease_id = uuid.uuid4().hex
+        self._collection.update_many(
+            {'_id': {'$in': ids}, **available},
+            {'$set': {self._lease_field: {'until': now + self._lease_timeout, 'id': lease_id}}})
+        projection = dict.fromkeys(self._stage.fields + ['crawlTime'], 1)
+        return list(self._collection.find(
+            {'_id': {'$in': ids}, f'{self._lease_field}.id': lease_id}, projection))
+
+    def run_once(self):
+        '''
+        Enrich one batch; returns the number of documents claimed.
+        '''
+        docs = self.claim()
+        if not docs:
+            return 0
+        start = time.time()
+        updates = self._stage(docs)
+        ops = []
+        for doc in docs:
+            update = {'$pull': {'pendingEnrichment': self._stage.name},
+                      '$unset': {self._lease_field: ''}}
+            if updates[doc['_id']]:
+                update['$set'] = updates[doc['_id']]
+            ops.append(UpdateOne({'_id': doc['_id'], 'crawlTime': doc.get('crawlTime')}, update))
+        result = self._collection.bulk_write(ops, ordered=False)
+        logging.info(f'EnrichmentWorker: {self._stage.name} of {len(docs)} stores in '
+                     f'{time.time() - start:.2f} seconds, {len(docs) - result.matched_count} crawled again meanwhile')
+        return len(docs)
+
+    def run(self, follow=False, poll_interval=10):
+        '''
+        Enrich until nothing is pending; with `follow`, keep polling for new
+        documents instead of returning.
+        '''
+        total = 0
+        while True:
+            claimed = self.run_once()
+            total += claimed
+            if claimed:
+                continue
+            if not follow:
+                return total
+            time.sleep(poll_interval)
+
+
+def run_worker(stage_name, follow=False):
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    configure_logging(settings)
+    collection = pymongo.MongoClient(os.environ.get('MONGODB_URI'))[
+        os.environ.get('MONGODB_DB')][os.environ.get('MONGODB_COLLECTION')]
+    stage = STAGES[stage_name].from_settings(settings)
+    worker = EnrichmentWorker(collection, stage,
+                              batch_size=settings.getint('ENRICHMENT_BATCH_SIZE', 32),
+                              lease_timeout=settings.getfloat('ENRICHMENT_LEASE_TIMEOUT', 600))
+    total = worker.run(follow, settings.getfloat('ENRICHMENT_POLL_INTERVAL', 10))
+    logging.info(f'EnrichmentWorker: {stage_name} done, {total} stores enriched')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrich stores crawled with ENRICHMENT_MODE = "deferred".')
+    parser.add_argument('stage', choices=sorted(STAGES))
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--follow', action='store_true',
+                        help='keep waiting for new stores instead of exiting when none are pending')
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        return run_worker(args.stage, args.follow)
+    processes = [multiprocessing.Process(target=run_worker, args=(args.stage, args.follow))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Low-overhead logging of per-store events.
+#
+# Busy crawls log several events per store. EventLogger logs them as
+# structured "event key=value ..." records that are only formatted when a
+# handler writes them, and thins them out per event name before a record is
+# even created:
+#   - LOG_EVENT_SAMPLING keeps 1 in 1/rate events of a name
+#   - LOG_EVENT_RATE_LIMITS keeps at most that many events of a name per
+#     second (with bursts of as many)
+# The next record of a name that is kept says how many were left out.
+# Fields that cost something to compute can be passed as Lazy(function),
+# which is only called for the events that are kept.
+#
+# QueueLogging puts the stream and file handlers of the root logger behind
+# a bounded queue, so the reactor thread only enqueues records; a listener
+# thread formats and writes them. Records are dropped and counted, rather
+# than blocking the reactor, when the queue is full.
+#
+# SummaryLogFormatter logs items Scrapy reports as dropped or failed by
+# their store summary instead of the whole multi-MB document.
+
+import logging
+import logging.handlers
+import queue
+import time
+
+from scrapy.logformatter import LogFormatter
+
+
+def _logfmt(value):
+    if isinstance(value, float):
+        return f'{value:.6g}'
+    text = str(value)
+    if not text or any(c in text for c in ' ="'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+
+class Lazy:
+    '''
+    Event field computed by calling `function` if the event is kept.
+    '''
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+
+class Event:
+    '''
+    Log message of an event, formatted when it is written.
+    '''
+
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + [f'{key}={_logfmt(value)}' for key, value in self.fields.items()])
+
+
+def count_items(data):
+    return sum(len(section.get('payload', {}).get('standardItemsPayload', {}).get('catalogItems', []))
+               for menu in (data.get('catalogSectionsMap') or {}).values() for section in menu)
+
+
+class StoreSummary:
+    '''
+    Short description of a store document or spider item, formatted when
+    it is written.
+    '''
+
+    __slots__ = ('item',)
+
+    def __init__(self, item):
+        self.item = item
+
+    def __str__(self):
+        item = self.item
+        try:
+            label = None
+            if 'data' in item and 'label' in item:
+                label, item = item['label'], item['data']
+            fields = {'uuid': item.get('uuid'), 'name': item.get('name'),
+                      'label': label or item.get('label'), 'items': count_items(item)}
+        except (AttributeError, TypeError):
+            return repr(item)[:200]
+        return str(Event('store', {key: value for key, value in fields.items() if value is not None}))
+
+
+class EventLogger:
+    '''
+    Log events through `logger`, sampled and rate limited per event name.
+    Meant for the reactor thread.
+    '''
+
+    def __init__(self, logger=None, sampling=None, rate_limits=None, stats=None, clock=time.monotonic):
+        self._logger = logger or logging.getLogger('ubereats_crawler')
+        # keep every n-th event of a name
+        self._every = {name: max(1, round(1 / rate)) for name, rate in (sampling or {}).items() if rate > 0}
+        self._never = {name for name, rate in (sampling or {}).items() if rate <= 0}
+        self._rate_limits = {name: float(limit) for name, limit in (rate_limits or {}).items() if limit}
+        self._stats = stats
+        self._clock = clock
+        self._seen = {}
+        self._buckets = {}
+        self._suppressed = {}
+
+    @classmethod
+    def from_settings(cls, settings, logger=None, stats=None):
+        return cls(
+            logger,
+            sampling=settings.getdict('LOG_EVENT_SAMPLING'),
+            rate_limits=settings.getdict('LOG_EVENT_RATE_LIMITS'),
+            stats=stats,
+        )
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def log(self, level, event, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        if not self._keep(event):
+            self._suppressed[event] = self._suppressed.get(event, 0) + 1
+            if self._stats is not None:
+                self._stats.inc_value(f'log/suppressed/{event}')
+            return
+        for key, value in fields.items():
+            if isinstance(value, Lazy):
+                fields[key] = value.function()
+        suppressed = self._suppressed.pop(event, 0)
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self._logger.log(level, '%s', Event(event, fields))
+
+    def _keep(self, event):
+        if event in self._never:
+            return False
+        every = self._every.get(event)
+        if every is not None:
+            seen = self._seen[event] = self._seen.get(event, 0) + 1
+            if (seen - 1) % every:
+                return False
+        limit = self._rate_limits.get(event)
+        if limit is not None:
+            # token bucket holding up to `limit` events, at least one
+            now = self._clock()
+            tokens, last = self._buckets.get(event, (max(1, limit), now))
+            tokens = min(max(1, limit), tokens + (now - last) * limit)
+            if tokens < 1:
+                self._buckets[event] = (tokens, now)
+                return False
+            self._buckets[event] = (tokens - 1, now)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # leaves formatting to the listener thread, and drops records instead
+    # of blocking when the queue is full
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # waits for room in a full queue instead of failing
+        self.queue.put(self._sentinel)
+
+
+class QueueLogging:
+    '''
+    Move the stream and file handlers of the root logger behind a queue of
+    at most `size` records, written by a listener thread.
+    '''
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._handlers = []
+        self._handler = None
+        self._listener = None
+
+    @property
+    def dropped(self):
+        return self._handler.dropped if self._handler is not None else 0
+
+    def install(self):
+        root = logging.getLogger()
+        self._handlers = [h for h in root.handlers if isinstance(h, logging.StreamHandler)]
+        if not self._handlers:
+            return False
+        records = queue.Queue(self.size)
+        self._handler = _QueueHandler(records)
+        # records none of the handlers would write are not queued
+        self._handler.setLevel(min(h.level for h in self._handlers))
+        self._listener = _QueueListener(records, *self._handlers, respect_handler_level=True)
+        for handler in self._handlers:
+            root.removeHandler(handler)
+        self._listener.start()
+        root.addHandler(self._handler)
+        return True
+
+    def uninstall(self):
+        if self._listener is None:
+            return
+        root = logging.getLogger()
+        root.removeHandler(self._handler)
+        # writes everything still queued
+        self._listener.stop()
+        self._listener = None
+        for handler in self._handlers:
+            root.addHandler(handler)
+
+
+class SummaryLogFormatter(LogFormatter):
+    '''
+    LogFormatter logging dropped and failed items as a store summary.
+    '''
+
+    def dropped(self, item, exception, response, spider):
+        result = super().dropped(item, exception, response, spider)
+        result['args']['item'] = StoreSummary(item)
+        return result
+
+    def item_error(self, item, exception, response, spider):
+        result = super().item_error(item, exception, response, spider)
+        result['args']['item'] = StoreSummary(item)
+        return result
@@ -0,0 +1,232 @@
+# Columnar export of the menu items of the store collection.
+#
+# The rows are those of RestaurantItemFlattenTransformer, one per catalog
+# item listing, plus the stored text embedding as a fixed size list of
+# float32. They are written as Parquet, partitioned by state and city label:
+#
+#   <output>/state=CA/city=berkeley-ca/part-0.parquet
+#
+# Stores are read with an aggregation that sorts them by label and unwinds
+# their catalog on the server, so only the exported fields of one item per
+# document cross the wire, and each city arrives in one run. One Parquet
+# file is open at a time, and rows are written as Arrow record batches of
+# --batch-rows rows, so memory stays flat however large the collection is.
+# The $sort comes first, ahead of any computed field, so the server serves
+# it from the {label: 1, _id: 1} index export() creates and streams stores
+# in index order instead of running a blocking sort over whole store
+# documents.
+#
+#   python -m ubereats_crawler.export exports/items [--no-embeddings]
+#
+# The result reads back with e.g. pandas.read_parquet or pyarrow.dataset,
+# filtering on state and city without opening the other partitions.
+
+import argparse
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .codec import decode_embeddings
+
+ITEMS = '$menus.v.payload.standardItemsPayload.catalogItems'
+
+SORT_INDEX = [('label', 1), ('_id', 1)]
+
+# one document per catalog item listing, sorted by store label
+CATALOG_ITEM_ROWS = [
+    {'$sort': dict(SORT_INDEX)},
+    {'$project': {
+        'name': 1, 'label': 1, 'categories': 1,
+        'address': '$location.address',
+        'latitude': '$location.latitude',
+        'longitude': '$location.longitude',
+        'menus': {'$objectToArray': '$catalogSectionsMap'},
+    }},
+    {'$unwind': '$menus'},
+    {'$unwind': '$menus.v'},
+    {'$unwind': ITEMS},
+    {'$project': {
+        'name': 1, 'label': 1, 'categories': 1, 'address': 1, 'latitude': 1, 'longitude': 1,
+        'uuid': f'{ITEMS}.uuid',
+        'title': f'{ITEMS}.title',
+        'description': f'{ITEMS}.itemDescription',
+        'imageUrl': f'{ITEMS}.imageUrl',
+        'embedding': f'{ITEMS}.text_embedding',
+    }},
+]
+
+SCHEMA = pa.schema([
+    ('restaurant_id', pa.string()),
+    ('restaurant_name', pa.string()),
+    ('restaurant_address', pa.string()),
+    ('restaurant_lat', pa.float64()),
+    ('restaurant_lon', pa.float64()),
+    ('restaurant_category', pa.list_(pa.string())),
+    ('item_id', pa.string()),
+    ('item_name', pa.string()),
+    ('item_description', pa.string()),
+    ('item_image_url', pa.string()),
+])
+
+
+def partition_of(label):
+    '''
+    (state, city) partition of a city label such as "berkeley-ca".
+    '''
+    label = label or 'unknown'
+    return label.rsplit('-', 1)[-1].upper(), label
+
+
+def embedding_array(blobs, dim):
+    '''
+    Fixed size list array of float32 from encoded embeddings, null where an
+    item has none.
+    '''
+    missing = np.array([blob is None for blob in blobs])
+    matrix = np.zeros((len(blobs), dim), dtype=np.float32)
+    if not missing.all():
+        matrix[~missing] = decode_embeddings([blob for blob in blobs if blob is not None])
+    values = pa.array(matrix.ravel(), type=pa.float32())
+    return pa.FixedSizeListArray.from_arrays(
+        values, dim, mask=pa.array(missing) if missing.any() else None)
+
+
+class PartitionWriter:
+    '''
+    Buffer the rows of one partition column by column and write them as
+    record batches of `batch_rows` rows to its Parquet file.
+    '''
+
+    def __init__(self, path, schema, embedding_dim, batch_rows, compression):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.rows = 0
+        self._schema = schema
+        self._embedding_dim = embedding_dim
+        self._batch_rows = batch_rows
+        self._columns = {name: [] for name in schema.names}
+        self._writer = pq.ParquetWriter(path, schema, compression=compression)
+
+    def append(self, row):
+        for name, column in self._columns.items():
+            column.append(row.get(name))
+        if len(self._columns['item_id']) >= self._batch_rows:
+            self.flush()
+
+    def flush(self):
+        n = len(self._columns['item_id'])
+        if not n:
+            return
+        arrays = []
+        for field in self._schema:
+            values = self._columns[field.name]
+            if field.name == 'text_embedding':
+                arrays.append(embedding_array(values, self._embedding_dim))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+            values.clear()
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+        self.rows += n
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def store_rows(cursor):
+    '''
+    Yield export rows, as dicts of column values, from the documents of
+    CATALOG_ITEM_ROWS.
+    '''
+    for doc in cursor:
+        categories = doc.get('categories')
+        yield {
+            'label': doc.get('label'),
+            'restaurant_id': doc.get('_id'),
+            'restaurant_name': doc.get('name'),
+            'restaurant_address': doc.get('address'),
+            'restaurant_lat': doc.get('latitude'),
+            'restaurant_lon': doc.get('longitude'),
+            'restaurant_category': [str(c) for c in categories] if isinstance(categories, list) else None,
+            'item_id': doc.get('uuid'),
+            'item_name': doc.get('title'),
+            'item_description': doc.get('description'),
+            'item_image_url': doc.get('imageUrl'),
+            'text_embedding': doc.get('embedding'),
+        }
+
+
+def embedding_dim(collection):
+    # size of the stored embeddings, from the first embedded item
+    # (without the $sort, which the first item doesn't need)
+    pipeline = [stage for stage in CATALOG_ITEM_ROWS if '$sort' not in stage] + [{'$match': {'embedding': {'$ne': None}}}, {'$limit': 1}]
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        return decode_embeddings([doc['embedding']]).shape[1]
+    return None
+
+
+def export(collection, output, embeddings=True, batch_rows=65536, cursor_batch_size=5000,
+           compression='zstd'):
+    '''
+    Export the catalog items of `collection` to Parquet files under
+    `output`, replacing a previous export there. Returns the number of rows
+    written.
+    '''
+    schema = SCHEMA
+    dim = embedding_dim(collection) if embeddings else None
+    if dim:
+        schema = schema.append(pa.field('text_embedding', pa.list_(pa.float32(), dim)))
+    elif embeddings:
+        logging.warning('Export: no embedded items, exporting without embeddings')
+
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    start = time.time()
+    collection.create_index(SORT_INDEX)
+    cursor = collection.aggregate(CATALOG_ITEM_ROWS, allowDiskUse=True, batchSize=cursor_batch_size)
+    writer, label, rows, partitions = None, None, 0, 0
+    for row in store_rows(cursor):
+        if writer is None or row['label'] != label:
+            if writer is not None:
+                writer.close()
+                rows += writer.rows
+            label = row['label']
+            state, city = partition_of(label)
+            path = os.path.join(output, f'state={state}', f'city={city}', 'part-0.parquet')
+            writer = PartitionWriter(path, schema, dim, batch_rows, compression)
+            partitions += 1
+        writer.append(row)
+    if writer is not None:
+        writer.close()
+        rows += writer.rows
+    logging.info(f'Export: {rows} items of {partitions} cities written to {output} '
+                 f'in {time.time() - start:.1f} seconds')
+    return rows
+
+
+def main():
+    import pymongo
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+
+    parser = argparse.ArgumentParser(description='Export the menu items of the store collection to Parquet.')
+    parser.add_argument('output', help='directory of the partitioned Parquet dataset')
+    parser.add_argument('--no-embeddings', dest='embeddings', action='store_false',
+                        help='leave out the text embeddings')
+    parser.add_argument('--batch-rows', type=int, default=65536, help='rows per record batch')
+    parser.add_argument('--compression', default='zstd')
+    args = parser.parse_args()
+
+    configure_logging(get_project_settings())
+    collection = pymongo.MongoClient(os.environ.get('MONGODB_URI'))[
+        os.environ.get('MONGODB_DB')][os.environ.get('MONGODB_COLLECTION')]
+    export(collection, args.output, args.embeddings, args.batch_rows, compression=args.compression)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import logging
+import os
+import resource
+import sys
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from .eventlog import QueueLogging
+from .instrumentation import StackSampler, add_quantiles, render_prometheus
+
+
+def process_age():
+    '''
+    Seconds since the current process started, or None where /proc is not
+    available.
+    '''
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name may contain spaces; fields after it are fixed
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def rss_bytes():
+    '''
+    Resident set size of the current process; its peak where the current
+    size is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StartupStats:
+    '''
+    Record how long the process took to open the spider and to receive its
+    first response, and its RSS at both points, as startup/* stats.
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._first_response = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler.stats)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        return ext
+
+    def spider_opened(self, spider):
+        self._record('open')
+
+    def response_received(self, response, request, spider):
+        if not self._first_response:
+            self._first_response = True
+            self._record('first_response')
+
+    def _record(self, event):
+        age = process_age()
+        if age is not None:
+            self.stats.set_value(f'startup/seconds_to_{event}', age)
+        self.stats.set_value(f'startup/rss_bytes_at_{event}', rss_bytes())
+
+
+class StageTimingStats:
+    '''
+    Add p50/p90/p99 estimates of the timing/* stage histograms (see
+    instrumentation) to the stats when the spider closes.
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler.stats)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_closed(self, spider):
+        add_quantiles(self.stats)
+
+
+class PrometheusExporter:
+    '''
+    Serve the crawl stats in the Prometheus text format on
+    http://PROMETHEUS_HOST:PROMETHEUS_PORT/metrics while the spider runs.
+    '''
+
+    def __init__(self, stats, host, port):
+        self.stats = stats
+        self.host = host
+        self.port = port
+        self._listener = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        port = crawler.settings.getint('PROMETHEUS_PORT', 0)
+        if not port:
+            raise NotConfigured
+        ext = cls(crawler.stats, crawler.settings.get('PROMETHEUS_HOST', '127.0.0.1'), port)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        from twisted.internet import reactor
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+
+        stats = self.stats
+
+        class Metrics(Resource):
+            isLeaf = True
+
+            def render_GET(self, request):
+                request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+                return render_prometheus(stats.get_stats()).encode('utf-8')
+
+        self._listener = reactor.listenTCP(self.port, Site(Metrics()), interface=self.host)
+        logging.info(f'PrometheusExporter: serving metrics on http://{self.host}:{self.port}/metrics')
+
+    def spider_closed(self, spider):
+        if self._listener is not None:
+            self._listener.stopListening()
+
+
+class SamplingProfiler:
+    '''
+    Sample the stacks of all threads every PROFILE_INTERVAL seconds while
+    the spider runs, and write them as collapsed stacks to PROFILE_PATH,
+    e.g. for flamegraph.pl or speedscope.
+    '''
+
+    def __init__(self, path, interval):
+        self.path = path
+        self._sampler = StackSampler(interval)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('PROFILE_PATH')
+        if not path:
+            raise NotConfigured
+        # one file per run, e.g. "profiles/crawl-%(time)s.folded"
+        ext = cls(path % {'time': time.strftime('%Y%m%dT%H%M%S')},
+                  crawler.settings.getfloat('PROFILE_INTERVAL', 0.01))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self._sampler.start()
+
+    def spider_closed(self, spider):
+        self._sampler.stop()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._sampler.write(self.path)
+        logging.info(f'SamplingProfiler: {self._sampler.samples} samples written to {self.path}')
+
+
+class QueueLoggingExtension:
+    '''
+    Write the log through a queue and a listener thread while the crawler
+    runs (see eventlog.QueueLogging).
+    '''
+
+    def __init__(self, stats, size):
+        self.stats = stats
+        self._logging = QueueLogging(size)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('LOG_QUEUE_ENABLED', False):
+            raise NotConfigured
+        ext = cls(crawler.stats, crawler.settings.getint('LOG_QUEUE_SIZE', 10000))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.engine_stopped, signal=signals.engine_stopped)
+        return ext
+
+    def spider_opened(self, spider):
+        # the crawler replaces the root handler until the crawl starts
+        self._logging.install()
+
+    def spider_closed(self, spider):
+        self.stats.set_value('log/queue_dropped', self._logging.dropped)
+
+    def engine_stopped(self):
+        self._logging.uninstall()
@@ -0,0 +1,209 @@
+# Durable crawl frontier.
+#
+# Crawls work through the whole city list in a fixed order, a few cities per
+# run, and record in a local SQLite file which cities and categories have
+# been expanded and which stores have been scheduled or completed. A run
+# that crashes or is stopped is resumed by the next one: stores and
+# categories that were scheduled but never completed are requested again
+# before any new city is expanded.
+#
+# One sweep over all cities is a "pass". Everything is recorded with the
+# pass it belongs to, so once every city has been crawled the next run
+# starts the next pass from the first city again.
+
+import logging
+
+from .localstore import chunked, connect_sqlite
+from .storage import uuid_key
+
+PENDING = 0
+EXPANDED = 1
+DONE = 2
+
+
+class CrawlFrontier:
+    '''
+    SQLite backed record of crawl progress.
+
+    Store uuids are kept as 16 byte blobs. Lookups of whether a store was
+    already seen in the current pass go through a small in-memory set of the
+    stores seen by this run, then the database, so memory does not grow with
+    the number of stores crawled in earlier runs.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = connect_sqlite(path)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS cities (
+                city TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                pass INTEGER NOT NULL DEFAULT 0,
+                status INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS categories (
+                path TEXT PRIMARY KEY,
+                city TEXT NOT NULL,
+                pass INTEGER NOT NULL,
+                status INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS categories_city ON categories (city);
+            CREATE TABLE IF NOT EXISTS stores (
+                uuid BLOB PRIMARY KEY,
+                store_uuid TEXT NOT NULL,
+                label TEXT NOT NULL,
+                pass INTEGER NOT NULL,
+                status INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS stores_pass_status ON stores (pass, status);
+        ''')
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'pass'").fetchone()
+        self.current_pass = row[0] if row else 1
+        self._seen = set()
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('FRONTIER_PATH')
+        if not path:
+            return None
+        return cls(path)
+
+    def close(self):
+        self._conn.close()
+
+    # cities
+
+    def sync_cities(self, cities):
+        '''
+        Record the city list; the order of `cities` is the crawl order.
+        '''
+        self._conn.execute('BEGIN')
+        self._conn.executemany(
+            'INSERT INTO cities (city, position) VALUES (?, ?) '
+            'ON CONFLICT (city) DO UPDATE SET position = excluded.position',
+            [(city, position) for position, city in enumerate(cities)])
+        self._conn.execute('COMMIT')
+
+    def next_cities(self, limit, key=None):
+        '''
+        Return up to `limit` cities not expanded yet in this pass, in order,
+        or the ones with the highest `key(city)` first if given. Starts the
+        next pass when every city of the current one is done.
+        '''
+        cities = self._pending_cities(limit, key)
+        if not cities and not self._unfinished():
+            self._set_pass(self.current_pass + 1)
+            cities = self._pending_cities(limit, key)
+        return cities
+
+    def _pending_cities(self, limit, key=None):
+        rows = self._conn.execute(
+            'SELECT city FROM cities WHERE pass < ? OR status = ? '
+            'ORDER BY position LIMIT ?', (self.current_pass, PENDING, -1 if key else limit))
+        cities = [city for city, in rows]
+        if key is not None:
+            cities = sorted(cities, key=key, reverse=True)[:limit]
+        return cities
+
+    def _unfinished(self):
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM cities WHERE pass = ? AND status != ?',
+            (self.current_pass, DONE)).fetchone()[0]
+
+    def _set_pass(self, value):
+        self.current_pass = value
+        self._seen.clear()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('pass', ?)", (value,))
+        logging.info(f'CrawlFrontier: starting pass {value}')
+
+    def city_expanded(self, city, category_paths):
+        '''
+        Record the categories of a city; the city is done once they are.
+        '''
+        self._conn.execute('BEGIN')
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO categories (path, city, pass, status) VALUES (?, ?, ?, ?)',
+            [(path, city, self.current_pass, PENDING) for path in category_paths])
+        self._conn.execute(
+            'UPDATE cities SET pass = ?, status = ? WHERE city = ?',
+            (self.current_pass, EXPANDED, city))
+        self._conn.execute('COMMIT')
+        self._maybe_city_done(city)
+
+    def _maybe_city_done(self, city):
+        remaining = self._conn.execute(
+            'SELECT COUNT(*) FROM categories WHERE city = ? AND pass = ? AND status != ?',
+            (city, self.current_pass, DONE)).fetchone()[0]
+        if not remaining:
+            self._conn.execute(
+                'UPDATE cities SET status = ? WHERE city = ? AND pass = ?',
+                (DONE, city, self.current_pass))
+
+    # categories
+
+    def pending_categories(self):
+        '''
+        Categories of this pass that were scheduled but never completed, as
+        (path, city) pairs.
+        '''
+        return self._conn.execute(
+            'SELECT path, city FROM categories WHERE pass = ? AND status = ?',
+            (self.current_pass, PENDING)).fetchall()
+
+    def category_done(self, path, city):
+        self._conn.execute(
+            'UPDATE categories SET status = ? WHERE path = ? AND pass = ?',
+            (DONE, path, self.current_pass))
+        self._maybe_city_done(city)
+
+    # stores
+
+    def unseen_stores(self, store_uuids):
+        '''
+        Return the uuids of `store_uuids` not yet seen in this pass.
+        '''
+        candidates = {}
+        for store_uuid in store_uuids:
+            key = uuid_key(store_uuid)
+            if key not in self._seen and key not in candidates:
+                candidates[key] = store_uuid
+        for chunk in chunked(candidates):
+            marks = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                f'SELECT uuid FROM stores WHERE pass = ? AND uuid IN ({marks})',
+                [self.current_pass] + chunk)
+            for key, in rows:
+                self._seen.add(key)
+                del candidates[key]
+        return list(candidates.values())
+
+    def add_stores(self, store_uuids, label, done=False):
+        '''
+        Record stores as seen in this pass, either scheduled or already done
+        (e.g. skipped because they are fresh).
+        '''
+        rows = []
+        for store_uuid in store_uuids:
+            key = uuid_key(store_uuid)
+            self._seen.add(key)
+            rows.append((key, store_uuid, label, self.current_pass, DONE if done else PENDING))
+        if rows:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO stores (uuid, store_uuid, label, pass, status) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.execute('COMMIT')
+
+    def pending_stores(self):
+        '''
+        Stores of this pass that were scheduled but never completed, as
+        (uuid, label) pairs.
+        '''
+        return self._conn.execute(
+            'SELECT store_uuid, label FROM stores WHERE pass = ? AND status = ?',
+            (self.current_pass, PENDING)).fetchall()
+
+    def store_done(self, store_uuid):
+        self._conn.execute(
+            'UPDATE stores SET status = ? WHERE uuid = ?', (DONE, uuid_key(store_uuid)))
@@ -0,0 +1,316 @@
+# Geocoding of store addresses that come without coordinates.
+#
+# Lookups go through a persistent address -> coordinate cache, which also
+# remembers addresses the backend could not resolve for a shorter time.
+# GeocodingService sends the remaining lookups through the reactor with a
+# bounded number of concurrent requests, and requests for an address that
+# is already being resolved wait for that lookup instead of sending another.
+# Backends only know how to build a request URL and parse its response, so
+# the same backend serves the blocking ArzueGeoEncoder and the service.
+
+import json
+import logging
+import os
+import threading
+import time
+
+from urllib.parse import urlencode
+
+import requests
+
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, protocol, threads
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http_headers import Headers
+
+from .localstore import connect_sqlite
+
+
+class ArzueMapsBackend:
+    '''
+    Azure Maps address search. The endpoint can be overridden, e.g. to point
+    at a local stub server.
+    '''
+
+    name = 'azure-maps'
+    default_endpoint = "https://atlas.microsoft.com/search/address/json"
+
+    def __init__(self, api_key=None, endpoint=None):
+        self._api_key = api_key or os.environ.get('ARZUE_MAPS_API_KEY')
+        assert self._api_key, 'ArzueMapsBackend: No API key provided.'
+        self.endpoint = endpoint or self.default_endpoint
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(endpoint=settings.get('GEOCODER_ENDPOINT'))
+
+    def request_url(self, address, country="US"):
+        param = {
+            "api-version": "1.0",
+            "query": address,
+            "countrySet": country,
+            "subscription-key": self._api_key,
+        }
+        return f'{self.endpoint}?{urlencode(param)}'
+
+    def parse(self, data):
+        '''
+        Return (lat, lon) of the best match, or None if there is none.
+        '''
+        if data['summary']['totalResults'] == 0:
+            return None
+        position = data['results'][0]['position']
+        return position['lat'], position['lon']
+
+
+class _BodyReader(protocol.Protocol):
+    # like twisted's readBody, but cancelling it (on a timeout) drops the
+    # connection without failing the Deferred a second time when the
+    # connection is then lost
+
+    def __init__(self):
+        self.deferred = defer.Deferred(self._cancel)
+        self._chunks = []
+
+    def _cancel(self, _):
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        self._chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            return
+        if reason.check(ResponseDone):
+            self.deferred.callback(b''.join(self._chunks))
+        else:
+            self.deferred.errback(reason)
+
+
+def read_body(response):
+    reader = _BodyReader()
+    response.deliverBody(reader)
+    return reader.deferred
+
+
+class GeocodeCache:
+    '''
+    SQLite cache of geocoding results keyed by normalized address.
+
+    Resolved addresses are kept for `ttl` seconds, addresses without a
+    result for `negative_ttl` seconds.
+    '''
+
+    MISS = object()
+
+    def __init__(self, path, ttl=180 * 24 * 60 * 60, negative_ttl=24 * 60 * 60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS geocodes ('
+            ' key TEXT PRIMARY KEY,'
+            ' lat REAL,'
+            ' lon REAL,'
+            ' expires REAL NOT NULL)')
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('GEOCODER_CACHE_PATH')
+        if not path:
+            return None
+        return cls(path,
+                   ttl=settings.getfloat('GEOCODER_CACHE_TTL', 180 * 24 * 60 * 60),
+                   negative_ttl=settings.getfloat('GEOCODER_NEGATIVE_TTL', 24 * 60 * 60))
+
+    @staticmethod
+    def key(address, country="US"):
+        return f"{country}|{' '.join(address.split()).lower()}"
+
+    def get(self, address, country="US"):
+        '''
+        Return the cached (lat, lon), None for a cached negative result, or
+        GeocodeCache.MISS.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT lat, lon, expires FROM geocodes WHERE key = ?',
+                (self.key(address, country),)).fetchone()
+        if row is None or row[2] < time.time():
+            return self.MISS
+        if row[0] is None:
+            return None
+        return row[0], row[1]
+
+    def put(self, address, coordinates, country="US"):
+        lat, lon = coordinates if coordinates else (None, None)
+        ttl = self.ttl if coordinates else self.negative_ttl
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO geocodes (key, lat, lon, expires) VALUES (?, ?, ?, ?)',
+                (self.key(address, country), lat, lon, time.time() + ttl))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ArzueGeoEncoder:
+    '''
+    Blocking geocoder for use outside the reactor. Returns (lat, lon), or
+    None if the address could not be resolved.
+    '''
+
+    def __init__(self, backend=None, cache=None, timeout=10):
+        self._session = requests.Session()
+        self._backend = backend or ArzueMapsBackend()
+        self._cache = cache
+        self._timeout = timeout
+
+    def __call__(self, address, country="US"):
+        if self._cache is not None:
+            cached = self._cache.get(address, country)
+            if cached is not GeocodeCache.MISS:
+                return cached
+        try:
+            response = self._session.get(self._backend.request_url(address, country),
+                                         timeout=self._timeout)
+            response.raise_for_status()
+            coordinates = self._backend.parse(response.json())
+        except Exception as e:
+            logging.error(f'ArzueGeoEncoder: {e}')
+            return None
+        if coordinates is None:
+            logging.warning(f'ArzueGeoEncoder: No results found for {address}')
+        if self._cache is not None:
+            self._cache.put(address, coordinates, country)
+        return coordinates
+
+
+class GeocodingService:
+    '''
+    Non-blocking geocoder running on the reactor.
+
+    `geocode` returns a Deferred firing with (lat, lon) or None; it never
+    fails. At most `concurrency` requests are sent at a time, each with a
+    `timeout` in seconds for the whole response. The cache is read and
+    written from the reactor's thread pool.
+    '''
+
+    def __init__(self, backend, cache=None, concurrency=4, timeout=10,
+                 stats=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._backend = backend
+        self._cache = cache
+        self._timeout = timeout
+        self._stats = stats
+        self._semaphore = defer.DeferredSemaphore(max(1, int(concurrency)))
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max(1, int(concurrency))
+        self._agent = Agent(reactor, pool=self._pool)
+        # cache key -> Deferreds waiting for the lookup in progress
+        self._in_flight = {}
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        backend_cls = load_object(settings.get('GEOCODER_BACKEND', 'ubereats_crawler.geocoding.ArzueMapsBackend'))
+        backend = backend_cls.from_settings(settings)
+        return cls(
+            backend,
+            cache=GeocodeCache.from_settings(settings),
+            concurrency=settings.getint('GEOCODER_CONCURRENCY', 4),
+            timeout=settings.getfloat('GEOCODER_TIMEOUT', 10),
+            stats=stats,
+        )
+
+    def geocode(self, address, country="US"):
+        if not address:
+            return defer.succeed(None)
+        key = GeocodeCache.key(address, country)
+        d = defer.Deferred()
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            self._inc('geocoder/deduplicated')
+            waiting.append(d)
+            return d
+        self._in_flight[key] = [d]
+
+        if self._cache is not None:
+            lookup = self._in_thread(self._cache.get, address, country)
+            lookup.addCallback(self._cached, address, country)
+        else:
+            lookup = self._lookup(address, country)
+        lookup.addBoth(self._resolved, key, address)
+        return d
+
+    def close(self):
+        if self._stats is not None:
+            hits = self._stats.get_value('geocoder/cache_hits', 0)
+            lookups = hits + self._stats.get_value('geocoder/cache_misses', 0)
+            if lookups:
+                self._stats.set_value('geocoder/cache_hit_rate', hits / lookups)
+        d = self._pool.closeCachedConnections()
+        if self._cache is not None:
+            d.addBoth(lambda _: self._cache.close())
+        return d
+
+    def _in_thread(self, f, *args):
+        return threads.deferToThreadPool(self._reactor, self._reactor.getThreadPool(), f, *args)
+
+    def _cached(self, cached, address, country):
+        if cached is not GeocodeCache.MISS:
+            self._inc('geocoder/cache_hits')
+            return cached
+        self._inc('geocoder/cache_misses')
+        return self._lookup(address, country)
+
+    def _lookup(self, address, country):
+        d = self._semaphore.run(self._request, address, country)
+        d.addCallback(self._found, address, country)
+        return d
+
+    def _request(self, address, country):
+        # the timeout covers the body too: a server stalling mid-body would
+        # otherwise hold this lookup, and every caller waiting on it, forever
+        d = self._fetch(address, country)
+        d.addTimeout(self._timeout, self._reactor)
+        return d
+
+    @defer.inlineCallbacks
+    def _fetch(self, address, country):
+        self._inc('geocoder/requests')
+        url = self._backend.request_url(address, country)
+        response = yield self._agent.request(b'GET', url.encode('ascii'),
+                                             Headers({b'Accept': [b'application/json']}))
+        body = yield read_body(response)
+        if response.code != 200:
+            raise IOError(f'HTTP {response.code} from {self._backend.name}')
+        return self._backend.parse(json.loads(body))
+
+    def _found(self, result, address, country):
+        # transient errors never get here, they are not cached
+        if result is None:
+            logging.warning(f'GeocodingService: No results found for {address}')
+        if self._cache is None:
+            return result
+        d = self._in_thread(self._cache.put, address, result, country)
+        d.addErrback(lambda failure: logging.error(f'GeocodingService: cache: {failure.getErrorMessage()}'))
+        d.addCallback(lambda _: result)
+        return d
+
+    def _resolved(self, result, key, address):
+        if isinstance(result, Failure):
+            self._inc('geocoder/errors')
+            logging.error(f'GeocodingService: {address}: {result.getErrorMessage()}')
+            result = None
+        for d in self._in_flight.pop(key):
+            d.callback(result)
+
+    def _inc(self, key):
+        if self._stats is not None:
+            self._stats.inc_value(key)
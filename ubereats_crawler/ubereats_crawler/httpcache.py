@@ -0,0 +1,141 @@
+# HTTP cache storage for the Uber Eats API.
+#
+# getSeoFeedV1 and getStoreV1 are POSTs that only differ in their JSON body
+# (`pathname`, `storeUuid`), so responses are keyed by the endpoint and the
+# canonical form of the body rather than by URL. All responses live in one
+# SQLite file, zlib compressed unless the server already compressed them.
+# How long an answer stays fresh depends on its endpoint: a store's menu
+# changes less often than the stores listed in a category feed.
+#
+# With HTTPCACHE_REPLAY, answers are used whatever their age; together with
+# HTTPCACHE_IGNORE_MISSING this reruns a recorded crawl offline, e.g. to try
+# parsing or enrichment changes at disk speed:
+#
+#   scrapy crawl ubereats -s HTTPCACHE_ENABLED=True \
+#       -s HTTPCACHE_REPLAY=True -s HTTPCACHE_IGNORE_MISSING=True
+
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+from scrapy.http.headers import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from .localstore import connect_sqlite
+from .middlewares import body_prefix, endpoint_name, failure_answer
+
+
+def canonical_body(body):
+    '''
+    JSON bodies with their keys sorted and without whitespace; other bodies
+    as they are.
+    '''
+    if not body:
+        return b''
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        return body
+
+
+def request_cache_key(request):
+    # the host is left out, so that a crawl recorded against one URL root
+    # replays against another
+    url = urlparse_cached(request)
+    return hashlib.sha1(b'\0'.join([request.method.encode('ascii'),
+                                    url.path.encode('utf-8'),
+                                    url.query.encode('utf-8'),
+                                    canonical_body(request.body)])).digest()
+
+
+class SQLiteCacheStorage:
+    '''
+    Scrapy HTTPCACHE_STORAGE keeping every response in the HTTPCACHE_PATH
+    SQLite file. HTTPCACHE_ENDPOINT_TTLS maps endpoints to their expiration
+    in seconds, other endpoints expire after HTTPCACHE_EXPIRATION_SECS (0:
+    never). API "status: failure" answers are not stored.
+    '''
+
+    # responses stored between two commits
+    commit_every = 100
+
+    def __init__(self, settings):
+        self.path = settings.get('HTTPCACHE_PATH', '.cache/http.sqlite3')
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.endpoint_ttls = settings.getdict('HTTPCACHE_ENDPOINT_TTLS')
+        self.replay = settings.getbool('HTTPCACHE_REPLAY')
+        self._conn = None
+        self._pending = 0
+
+    def open_spider(self, spider):
+        self._conn = connect_sqlite(self.path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' key BLOB PRIMARY KEY,'
+            ' endpoint TEXT NOT NULL,'
+            ' url TEXT NOT NULL,'
+            ' status INTEGER NOT NULL,'
+            ' headers BLOB NOT NULL,'
+            ' body BLOB NOT NULL,'
+            ' compressed INTEGER NOT NULL,'
+            ' time REAL NOT NULL)')
+        logging.info(f'SQLiteCacheStorage: using {self.path}'
+                     f'{" in replay mode" if self.replay else ""}')
+
+    def close_spider(self, spider):
+        if self._pending:
+            self._conn.execute('COMMIT')
+            self._pending = 0
+        self._conn.close()
+
+    def ttl(self, endpoint):
+        if self.replay:
+            return 0
+        return self.endpoint_ttls.get(endpoint, self.expiration_secs)
+
+    def retrieve_response(self, spider, request):
+        row = self._conn.execute(
+            'SELECT endpoint, url, status, headers, body, compressed, time'
+            ' FROM responses WHERE key = ?', (request_cache_key(request),)).fetchone()
+        if row is None:
+            return None
+        endpoint, url, status, headers, body, compressed, stored = row
+        ttl = self.ttl(endpoint)
+        if 0 < ttl < time.time() - stored:
+            return None
+        if compressed:
+            body = zlib.decompress(body)
+        headers = Headers(headers_raw_to_dict(headers))
+        request.meta['cache_timestamp'] = stored
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        prefix = body_prefix(response)
+        if prefix is None:
+            # can't tell whether it is a failure answer, don't replay it
+            encoding = response.headers.get('Content-Encoding', b'').decode('latin-1')
+            logging.warning(f'SQLiteCacheStorage: not caching {response.url}, '
+                            f'its {encoding} body could not be decoded')
+            return
+        if failure_answer(prefix):
+            return
+        body = response.body
+        # leave bodies the server compressed as they are
+        compressed = b'Content-Encoding' not in response.headers
+        if compressed:
+            body = zlib.compress(body)
+        if not self._pending:
+            self._conn.execute('BEGIN')
+        self._conn.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (request_cache_key(request), endpoint_name(request), response.url, response.status,
+             headers_dict_to_raw(response.headers), body, int(compressed), time.time()))
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.execute('COMMIT')
+            self._pending = 0
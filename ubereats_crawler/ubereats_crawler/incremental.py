@@ -0,0 +1,134 @@
+# Incremental recrawls of stores that are already stored.
+#
+# Every embedded menu item keeps `text_hash`, a hash of the model name and
+# the text it was embedded from. When a store is crawled again, items whose
+# hash did not change take their embedding from the stored document, so only
+# new or edited items reach the encoder. The update then only $sets the
+# parts of the document that changed, down to single catalog items when the
+# layout of a menu section is unchanged, instead of the whole document.
+
+import hashlib
+
+CATALOG = 'catalogSectionsMap'
+ITEMS_PATH = ('payload', 'standardItemsPayload', 'catalogItems')
+
+
+def text_hash(text, model_name):
+    return hashlib.blake2b(f'{model_name}\0{text}'.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def section_items(section):
+    items = section
+    for key in ITEMS_PATH:
+        items = items.get(key, {}) if isinstance(items, dict) else {}
+    return items if isinstance(items, list) else []
+
+
+def catalog_items(doc):
+    for menu in (doc or {}).get(CATALOG, {}).values():
+        for section in menu:
+            yield from section_items(section)
+
+
+def reuse_embeddings(items, previous, model_name, text_of):
+    '''
+    Set `text_hash` on every item of `items`, and copy the stored embedding
+    of the items whose text is the same as in the `previous` document.
+    Returns the items that still need an embedding.
+
+    `text_of(item)` is the text an item is embedded from. Items stored
+    before hashes were kept are compared by their stored text.
+    '''
+    stored = {}
+    for item in catalog_items(previous):
+        embedding = item.get('text_embedding')
+        if embedding is None:
+            continue
+        stored[item.get('text_hash') or text_hash(text_of(item), model_name)] = embedding
+
+    changed = []
+    for item in items:
+        item['text_hash'] = text_hash(text_of(item), model_name)
+        embedding = stored.get(item['text_hash'])
+        if embedding is None:
+            changed.append(item)
+        else:
+            item['text_embedding'] = embedding
+    return changed
+
+
+def _field_path(*parts):
+    return '.'.join(str(part) for part in parts)
+
+
+def _plain_key(key):
+    # usable as a component of a dotted update path
+    return isinstance(key, str) and key and '.' not in key and not key.startswith('$')
+
+
+def _without_items(section):
+    # shallow copy of a section down to its items, without them
+    try:
+        payload = section['payload']['standardItemsPayload']
+    except (KeyError, TypeError):
+        return section
+    rest = {key: value for key, value in payload.items() if key != ITEMS_PATH[-1]}
+    return {**section, 'payload': {**section['payload'], 'standardItemsPayload': rest}}
+
+
+def _diff_section(path, old, new, updates):
+    old_items, new_items = section_items(old), section_items(new)
+    same_layout = [item.get('uuid') for item in old_items] == [item.get('uuid') for item in new_items] \
+        and _without_items(old) == _without_items(new)
+    if not same_layout:
+        updates[path] = new
+        return
+    for i, (old_item, new_item) in enumerate(zip(old_items, new_items)):
+        if old_item != new_item:
+            updates[_field_path(path, *ITEMS_PATH, i)] = new_item
+
+
+def _diff_catalog(old, new, updates, removed):
+    if not isinstance(old, dict) or not all(_plain_key(key) for key in list(old) + list(new)):
+        updates[CATALOG] = new
+        return
+    for key, menu in new.items():
+        old_menu = old.get(key)
+        if old_menu == menu:
+            continue
+        if not isinstance(old_menu, list) or len(old_menu) != len(menu):
+            updates[_field_path(CATALOG, key)] = menu
+            continue
+        for i, (old_section, section) in enumerate(zip(old_menu, menu)):
+            if old_section != section:
+                _diff_section(_field_path(CATALOG, key, i), old_section, section, updates)
+    for key in old:
+        if key not in new:
+            removed[_field_path(CATALOG, key)] = ''
+
+
+def diff_update(previous, data):
+    '''
+    Update turning the stored document `previous` into `data`: fields of
+    `data` that changed are $set, menus that are gone are $unset. Other
+    fields of `previous` are left alone, as a full $set would.
+    '''
+    updates, removed = {}, {}
+    for key, value in data.items():
+        if key == '_id':
+            continue
+        if key == CATALOG:
+            _diff_catalog(previous.get(CATALOG), value, updates, removed)
+        elif previous.get(key) != value:
+            updates[key] = value
+    update = {}
+    if updates:
+        update['$set'] = updates
+    if removed:
+        update['$unset'] = removed
+    return update
+
+
+def catalog_changed(update):
+    return any(path.split('.', 1)[0] == CATALOG
+               for fields in update.values() for path in fields)
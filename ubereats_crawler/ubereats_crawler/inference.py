@@ -0,0 +1,299 @@
+# CPU inference backends for the CLIP text encoder.
+#
+# Texts are tokenized in the calling process, sorted by token length and cut
+# into batches of EMBEDDING_MODEL_BATCH_SIZE texts of similar length. CLIP's
+# text transformer is causal, so each batch is cut to its longest text
+# instead of the full 77 token context without changing the result; short
+# menu item names then cost a fraction of a full context.
+#
+# The batches are encoded by an EMBEDDING_BACKEND model:
+#   - TorchTextModel: the CLIP model, optionally with dynamic int8
+#     quantization of its linear layers (EMBEDDING_QUANTIZE)
+#   - OnnxTextModel: the text tower exported to ONNX and run with ONNX
+#     Runtime's CPU execution provider
+# either in the calling process or, with EMBEDDING_PROCESSES > 0, in a pool
+# of worker processes that each hold their own copy of the model and use
+# EMBEDDING_THREADS_PER_PROCESS intra-op threads.
+#
+# Quantized and ONNX models are checked against the plain torch model on a
+# few texts when they are loaded. If their embeddings are further than
+# EMBEDDING_MIN_COSINE from the reference, the plain model is used instead.
+
+import logging
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from scrapy.utils.misc import load_object
+
+CALIBRATION_TEXTS = [
+    'Cheeseburger',
+    'Spicy Tuna Roll made by tuna, cucumber, spicy mayo',
+    'Large Pepperoni Pizza',
+    'Pad Thai made by rice noodles, egg, tofu, bean sprouts, peanuts',
+    'Iced Caramel Macchiato',
+    'Chicken Tikka Masala made by marinated chicken in a creamy tomato sauce served with basmati rice',
+    'Garden Salad',
+    'Coke',
+]
+
+
+def tokenize(texts):
+    import clip
+    return clip.tokenize(list(texts), truncate=True).numpy().astype(np.int64)
+
+
+def token_lengths(tokens):
+    # CLIP's end of text token has the largest id, and ends the text
+    return tokens.argmax(axis=1) + 1
+
+
+def length_batches(tokens, batch_size):
+    '''
+    Split the rows of `tokens` into batches of at most `batch_size` rows of
+    similar length, longest first. Returns (row indices, tokens cut to the
+    longest row) pairs.
+    '''
+    lengths = token_lengths(tokens)
+    order = np.argsort(-lengths, kind='stable')
+    batches = []
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        batches.append((rows, tokens[rows, :lengths[rows[0]]]))
+    return batches
+
+
+def set_threads(threads):
+    if not threads:
+        return
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # only possible before the first parallel operation
+        pass
+
+
+def encode_text_trimmed(model, tokens):
+    '''
+    CLIP's encode_text for `tokens` of any length up to the context length:
+    the positional embeddings and causal mask are cut to the batch.
+    '''
+    import torch
+
+    n = tokens.shape[1]
+    x = model.token_embedding(tokens).type(model.dtype)
+    x = x + model.positional_embedding[:n].type(model.dtype)
+    x = x.permute(1, 0, 2)
+    mask = model.transformer.resblocks[0].attn_mask
+    mask = mask[:n, :n].to(dtype=x.dtype) if mask is not None else None
+    for block in model.transformer.resblocks:
+        y = block.ln_1(x)
+        x = x + block.attn(y, y, y, need_weights=False, attn_mask=mask)[0]
+        x = x + block.mlp(block.ln_2(x))
+    x = model.ln_final(x.permute(1, 0, 2)).type(model.dtype)
+    return x[torch.arange(x.shape[0]), tokens.argmax(dim=-1)] @ model.text_projection
+
+
+class TorchTextModel:
+    '''
+    CLIP text encoder with torch, on the GPU if there is one. On the CPU,
+    its linear layers are quantized to int8 if `quantize`.
+    '''
+
+    def __init__(self, model_name='ViT-B/32', threads=0, quantize=False):
+        import clip
+        import torch
+
+        set_threads(threads)
+        self.model_name = model_name
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, _ = clip.load(model_name, device=self.device)
+        if self.device == "cpu":
+            model = model.float()
+            if quantize:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._model = model.eval()
+
+    @classmethod
+    def options(cls, settings):
+        return {'model_name': settings.get('CLIP_MODEL', 'ViT-B/32'),
+                'threads': settings.getint('EMBEDDING_THREADS_PER_PROCESS', 0),
+                'quantize': settings.getbool('EMBEDDING_QUANTIZE', False)}
+
+    def __call__(self, tokens):
+        import torch
+        with torch.no_grad():
+            tokens = torch.from_numpy(tokens).to(self.device)
+            return encode_text_trimmed(self._model, tokens).float().cpu().numpy()
+
+
+class OnnxTextModel:
+    '''
+    CLIP text encoder exported to ONNX at `path` (on first use) and run
+    with ONNX Runtime on the CPU.
+    '''
+
+    def __init__(self, model_name='ViT-B/32', path='.cache/clip-text.onnx', threads=0):
+        import onnxruntime
+
+        self.model_name = model_name
+        if not os.path.exists(path):
+            self.export(model_name, path)
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(
+            path, options, providers=['CPUExecutionProvider'])
+
+    @classmethod
+    def options(cls, settings):
+        return {'model_name': settings.get('CLIP_MODEL', 'ViT-B/32'),
+                'path': settings.get('EMBEDDING_ONNX_PATH', '.cache/clip-text.onnx'),
+                'threads': settings.getint('EMBEDDING_THREADS_PER_PROCESS', 0)}
+
+    @staticmethod
+    def export(model_name, path):
+        import clip
+        import torch
+
+        model, _ = clip.load(model_name, device='cpu')
+        model = model.float().eval()
+
+        class TextTower(torch.nn.Module):
+
+            def __init__(self):
+                super().__init__()
+                self.clip = model
+
+            def forward(self, tokens):
+                return encode_text_trimmed(self.clip, tokens)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tokens = torch.from_numpy(tokenize(CALIBRATION_TEXTS))
+        torch.onnx.export(TextTower(), (tokens[:, :16],), path,
+                          input_names=['tokens'], output_names=['embeddings'],
+                          dynamic_axes={'tokens': {0: 'batch', 1: 'length'},
+                                        'embeddings': {0: 'batch'}},
+                          opset_version=17)
+        logging.info(f'OnnxTextModel: exported {model_name} to {path}')
+
+    def __call__(self, tokens):
+        return self._session.run(None, {'tokens': tokens.astype(np.int64)})[0].astype(np.float32)
+
+
+def max_cosine_distance(model, reference, texts=CALIBRATION_TEXTS):
+    tokens = tokenize(texts)
+    a, b = model(tokens), reference(tokens)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    return float(1 - (a * b).sum(axis=1).min())
+
+
+# the model of a worker process of ProcessPoolTextEncoder
+_worker_model = None
+
+
+def _init_worker(backend, options):
+    global _worker_model
+    _worker_model = load_object(backend)(**options)
+
+
+def _encode_in_worker(tokens):
+    return _worker_model(tokens)
+
+
+class TextEncoder:
+    '''
+    Encode texts into normalized float32 embeddings with `model`, in
+    batches of `batch_size` texts of similar length.
+    '''
+
+    def __init__(self, model, batch_size=64):
+        self._model = model
+        self._batch_size = max(1, int(batch_size))
+
+    def __call__(self, texts):
+        tokens = tokenize(texts)
+        batches = length_batches(tokens, self._batch_size)
+        embeddings = None
+        results = self._encode_batches([batch for _, batch in batches])
+        for (rows, _), result in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(tokens), result.shape[1]), dtype=np.float32)
+            embeddings[rows] = result
+        if embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+    def _encode_batches(self, batches):
+        return map(self._model, batches)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolTextEncoder(TextEncoder):
+    '''
+    TextEncoder whose batches are encoded by `processes` worker processes,
+    each with its own `backend(**options)` model. Safe to call from several
+    threads; their batches share the pool.
+    '''
+
+    def __init__(self, backend, options, processes=2, batch_size=64):
+        super().__init__(None, batch_size)
+        # torch does not survive fork once its thread pools are started
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(backend, options))
+
+    def _encode_batches(self, batches):
+        return self._executor.map(_encode_in_worker, batches)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def text_encoder_from_settings(settings):
+    '''
+    The TextEncoder configured by the EMBEDDING_* settings. Quantized or
+    ONNX models whose embeddings are not within EMBEDDING_MIN_COSINE of the
+    plain torch model are replaced by it.
+    '''
+    backend = settings.get('EMBEDDING_BACKEND', 'ubereats_crawler.inference.TorchTextModel')
+    backend_cls = load_object(backend)
+    options = backend_cls.options(settings)
+    processes = settings.getint('EMBEDDING_PROCESSES', 0)
+    batch_size = settings.getint('EMBEDDING_MODEL_BATCH_SIZE', 64)
+
+    approximate = backend_cls is not TorchTextModel or options.get('quantize')
+    model = None
+    if approximate:
+        model = backend_cls(**options)
+        reference = TorchTextModel(options['model_name'], options.get('threads', 0))
+        distance = max_cosine_distance(model, reference)
+        min_cosine = settings.getfloat('EMBEDDING_MIN_COSINE', 0.99)
+        if distance > 1 - min_cosine:
+            logging.error(f'{backend} {options} is {distance:.4f} away from the torch model, '
+                          f'more than EMBEDDING_MIN_COSINE allows; using the torch model')
+            backend, backend_cls = 'ubereats_crawler.inference.TorchTextModel', TorchTextModel
+            options = TorchTextModel.options(settings)
+            options['quantize'] = False
+            model = reference
+        else:
+            logging.info(f'{backend} {options} is within {distance:.4f} of the torch model')
+            del reference
+
+    if processes > 0:
+        del model
+        logging.info(f'Encoding texts with {backend} in {processes} processes')
+        return ProcessPoolTextEncoder(backend, options, processes, batch_size)
+    return TextEncoder(model if model is not None else backend_cls(**options), batch_size)
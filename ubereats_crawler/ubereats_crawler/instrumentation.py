@@ -0,0 +1,206 @@
+# Timing of the stages of the crawl hot path.
+#
+# Each stage records how long it took into a histogram kept in the Scrapy
+# stats, next to the other stats of the crawl:
+#
+#   timing/<stage>/count           observations
+#   timing/<stage>/seconds         total time
+#   timing/<stage>/max_seconds     slowest observation
+#   timing/<stage>/bucket_<bound>  observations that took at most <bound>
+#                                  seconds and more than the previous bound
+#
+# Stages are timed where their work runs, e.g. the model call in an
+# EmbeddingBatcher thread; observations from other threads are handed to the
+# reactor thread, which owns the stats. When the spider closes, p50/p90/p99
+# estimates are added as timing/<stage>/p<q>_seconds.
+#
+# render_prometheus turns the stats into the Prometheus text format, with
+# the histograms as ubereats_stage_seconds{stage=...} (see
+# extensions.PrometheusExporter). StackSampler is a sampling profiler of all
+# threads writing collapsed stacks, the input of flamegraph.pl, speedscope
+# and similar tools (see extensions.SamplingProfiler).
+
+import collections
+import math
+import re
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+def bucket_key(bound):
+    return f'bucket_{bound:g}'
+
+
+def observe(stats, stage, seconds):
+    '''
+    Record that `stage` took `seconds`. Call from the reactor thread.
+    '''
+    if stats is None:
+        return
+    prefix = f'timing/{stage}'
+    stats.inc_value(f'{prefix}/count')
+    stats.inc_value(f'{prefix}/seconds', seconds)
+    stats.max_value(f'{prefix}/max_seconds', seconds)
+    for bound in BUCKETS:
+        if seconds <= bound:
+            stats.inc_value(f'{prefix}/{bucket_key(bound)}')
+            break
+
+
+@contextmanager
+def timed(stats, stage):
+    '''
+    Time the body of a `with` block on the reactor thread as `stage`.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stats, stage, time.perf_counter() - start)
+
+
+def observe_deferred(stats, stage, deferred):
+    '''
+    Time `deferred` as `stage`, from now until it fires.
+    '''
+    start = time.perf_counter()
+
+    def _done(result):
+        observe(stats, stage, time.perf_counter() - start)
+        return result
+
+    return deferred.addBoth(_done)
+
+
+def histograms(stats):
+    '''
+    {stage: {'count', 'seconds', 'buckets': [(bound, cumulative count)]}}
+    from a dict of stats.
+    '''
+    found = {}
+    for key, value in stats.items():
+        if key.startswith('timing/') and key.endswith('/count'):
+            found[key[len('timing/'):-len('/count')]] = value
+    result = {}
+    for stage, count in found.items():
+        cumulative, buckets = 0, []
+        for bound in BUCKETS:
+            cumulative += stats.get(f'timing/{stage}/{bucket_key(bound)}', 0)
+            buckets.append((bound, cumulative))
+        result[stage] = {'count': count, 'seconds': stats.get(f'timing/{stage}/seconds', 0),
+                         'buckets': buckets}
+    return result
+
+
+def quantile(buckets, q):
+    '''
+    Estimate quantile `q` from cumulative (bound, count) buckets by linear
+    interpolation within the bucket, like Prometheus' histogram_quantile.
+    '''
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if math.isinf(bound):
+                return lower
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 1)
+        lower, below = bound, cumulative
+    return lower
+
+
+def add_quantiles(stats, quantiles=(0.5, 0.9, 0.99)):
+    '''
+    Set timing/<stage>/p<q>_seconds estimates of every stage.
+    '''
+    for stage, histogram in histograms(stats.get_stats()).items():
+        for q in quantiles:
+            value = quantile(histogram['buckets'], q)
+            if value is not None:
+                stats.set_value(f'timing/{stage}/p{q * 100:g}_seconds', value)
+
+
+def _metric_name(key):
+    return 'ubereats_' + re.sub(r'[^a-zA-Z0-9_]', '_', key).strip('_')
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def render_prometheus(stats):
+    '''
+    The numeric stats of a stats dict in the Prometheus text exposition
+    format: stage timings as one histogram, everything else as gauges.
+    '''
+    lines = ['# TYPE ubereats_stage_seconds histogram']
+    for stage, histogram in sorted(histograms(stats).items()):
+        for bound, count in histogram['buckets']:
+            lines.append(f'ubereats_stage_seconds_bucket{{stage="{stage}",le="{_format_value(bound)}"}} {count}')
+        lines.append(f'ubereats_stage_seconds_sum{{stage="{stage}"}} {_format_value(histogram["seconds"])}')
+        lines.append(f'ubereats_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+    for key, value in sorted(stats.items()):
+        if key.startswith('timing/') or isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = _metric_name(key)
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class StackSampler:
+    '''
+    Sample the stacks of every thread (but its own) `interval` seconds
+    apart from a background thread, and count them as collapsed stacks:
+    "thread;module:function;module:function ..." from the outermost frame.
+    '''
+
+    def __init__(self, interval=0.01, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.counts = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.counts[self._collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def _collapse(self, thread_name, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f'{frame.f_globals.get("__name__", code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        stack.append(thread_name.replace(';', ':').replace(' ', '_'))
+        return ';'.join(reversed(stack))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
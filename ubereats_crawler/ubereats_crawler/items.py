@@ -25,5 +25,8 @@ class UbereatsCrawlerItem(scrapy.Item):
     catalogSectionsMap = scrapy.Field()
     # Store url
     storeURL = scrapy.Field()
+    # raw metaJson of the store, decoded into storeURL only when it is used
+    # (see parsing.resolve_store_url)
+    metaJson = scrapy.Field()
     # crwal time
     crawlTime = scrapy.Field()
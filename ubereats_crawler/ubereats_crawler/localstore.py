@@ -0,0 +1,30 @@
+# Helpers for the small SQLite databases the crawler keeps on local disk.
+
+import os
+import sqlite3
+
+
+def connect_sqlite(path, check_same_thread=False):
+    '''
+    Open (and create if needed) an SQLite database tuned for a single
+    writer process: WAL journal so readers never block the writer, and
+    relaxed fsync since everything stored here can be rebuilt.
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread,
+                           isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def chunked(seq, size=500):
+    '''
+    Split `seq` into lists of at most `size` elements, e.g. to stay below
+    SQLite's limit on the number of bound parameters.
+    '''
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
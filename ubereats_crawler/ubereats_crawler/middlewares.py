@@ -3,7 +3,30 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import io
+import random
+import re
+import sys
+import time
+import zlib
+
+from collections import deque
+
+# the decoders Scrapy's HttpCompressionMiddleware uses for the "br" and
+# "zstd" encodings it asks for
+try:
+    import brotli
+except ImportError:
+    import brotlicffi as brotli
+if sys.version_info >= (3, 14):
+    from compression import zstd
+else:
+    from backports import zstd
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.httpobj import urlparse_cached
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -56,48 +79,247 @@ class UbereatsCrawlerSpiderMiddleware:
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
+# getSeoFeedV1 and getStoreV1 answers are {"status": "success" | "failure",
+# "data": ...}, with the status first or among the first few keys; checking
+# the first "status" key of the first bytes avoids parsing the body twice.
+STATUS_FIELD = re.compile(rb'"status"\s*:\s*"([^"]*)"')
+
+
+def endpoint_name(request):
+    '''
+    The API endpoint a request goes to: /api/getStoreV1 -> getStoreV1,
+    /city/<slug> -> city.
+    '''
+    parts = [part for part in urlparse_cached(request).path.split('/') if part]
+    if parts[:1] == ['api']:
+        return parts[-1]
+    return parts[0] if parts else ''
+
+
+def _decoded_prefix(encoding, data, size):
+    if encoding in (b'gzip', b'x-gzip', b'deflate'):
+        try:
+            return zlib.decompressobj(zlib.MAX_WBITS | 32).decompress(data, size)
+        except zlib.error:
+            if encoding != b'deflate':
+                raise
+            # raw deflate, as some servers send it
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, size)
+    if encoding == b'br':
+        return brotli.Decompressor().process(data, output_buffer_limit=size)
+    if encoding == b'zstd':
+        return zstd.ZstdFile(io.BytesIO(data)).read(size)
+    if encoding == b'identity':
+        return data[:size]
+    raise ValueError(f'unsupported Content-Encoding {encoding!r}')
+
+
+def body_prefix(response, size=256):
+    '''
+    The first `size` bytes of the body, decompressing only as much of it as
+    needed. None if it can't be decompressed.
+
+    Downloader middlewares running before HttpCompressionMiddleware see the
+    body as the server sent it.
+    '''
+    header = response.headers.get('Content-Encoding', b'')
+    encodings = [encoding.strip().lower() for encoding in header.split(b',') if encoding.strip()]
+    data = response.body
+    try:
+        # the last encoding listed was applied last
+        for i, encoding in enumerate(reversed(encodings)):
+            # inner layers need more than `size` bytes of their input
+            data = _decoded_prefix(encoding, data, size if i == len(encodings) - 1 else 64 * size)
+    except (ValueError, EOFError, zlib.error, brotli.error, zstd.ZstdError):
+        return None
+    return data[:size]
+
+
+def failure_answer(prefix):
+    '''
+    True if a body starting with `prefix` is an API "status: failure" answer.
+    '''
+    match = STATUS_FIELD.search(prefix or b'')
+    return match is not None and match.group(1) == b'failure'
+
+
+class EndpointController:
+    '''
+    AIMD concurrency of one endpoint: one more request in flight per window
+    of successful responses, half as many when a response signals
+    congestion. Also tracks the latency and failure rate of the endpoint.
+
+    Requests hold one of `limit` permits while they are downloaded;
+    acquire() returns a Deferred to wait for when none is free.
+    '''
+
+    # weight of the latest response in the moving averages
+    alpha = 0.1
+
+    def __init__(self, name, start=4, minimum=1, maximum=32):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.concurrency = float(min(max(start, minimum), maximum))
+        self.requests = 0
+        self.failures = 0
+        self.latency = None
+        self.failure_rate = 0.0
+        self.started = time.monotonic()
+        self.in_flight = 0
+        self._waiting = deque()
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        return max(1, int(self.concurrency))
+
+    def acquire(self):
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return None
+        from twisted.internet.defer import Deferred
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiting and self.in_flight < self.limit:
+            self.in_flight += 1
+            self._waiting.popleft().callback(None)
+
+    def record(self, latency, failed, congested):
+        self.requests += 1
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                self.latency + self.alpha * (latency - self.latency)
+        self.failure_rate += self.alpha * (failed - self.failure_rate)
+        if failed:
+            self.failures += 1
+        if failed or congested:
+            # responses to requests already in flight report the same
+            # congestion, halve at most once per round trip
+            now = time.monotonic()
+            if now - self._last_decrease >= (self.latency or 0):
+                self.concurrency = max(self.minimum, self.concurrency / 2)
+                self._last_decrease = now
+        else:
+            self.concurrency = min(self.maximum, self.concurrency + 1 / self.concurrency)
+            self._wake()
+
+    def rate(self):
+        return self.requests / max(time.monotonic() - self.started, 1e-9)
+
+
 class UbereatsCrawlerDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    '''
+    Adaptive concurrency and retry backoff for each API endpoint.
+
+    Requests of an endpoint (getSeoFeedV1, getStoreV1, city pages) wait
+    for a permit of its EndpointController before they are downloaded. HTTP
+    429 and 5xx responses, download errors and API "status: failure"
+    answers are failures; responses slower than ENDPOINT_TARGET_LATENCY
+    only signal congestion. Retries, from the spider or the retry
+    middleware, wait a jittered exponential backoff before going out.
+
+    The middleware goes right before the download handler, so that it sees
+    every download and its response or error before other middlewares can
+    turn them into new requests.
+    '''
+
+    def __init__(self, crawler, start=4, minimum=1, maximum=32, target_latency=5.0,
+                 backoff_base=1.0, backoff_max=60.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.endpoints = {}
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
+        settings = crawler.settings
+        if not settings.getbool('ENDPOINT_CONCURRENCY_ENABLED', True):
+            raise NotConfigured
+        s = cls(crawler,
+                start=settings.getint('ENDPOINT_CONCURRENCY_START', 4),
+                minimum=settings.getint('ENDPOINT_CONCURRENCY_MIN', 1),
+                maximum=settings.getint('ENDPOINT_CONCURRENCY_MAX', 32),
+                target_latency=settings.getfloat('ENDPOINT_TARGET_LATENCY', 5.0),
+                backoff_base=settings.getfloat('RETRY_BACKOFF_BASE', 1.0),
+                backoff_max=settings.getfloat('RETRY_BACKOFF_MAX', 60.0))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
+    def endpoint(self, request):
+        name = endpoint_name(request)
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointController(name, self.start, self.minimum, self.maximum)
+        return self.endpoints[name]
+
+    async def process_request(self, request, spider):
+        endpoint = self.endpoint(request)
 
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        retries = request.meta.get('retry_times', 0)
+        # retries copy the meta of the request they retry
+        if retries and request.meta.get('backoff_retry_times') != retries:
+            request.meta['backoff_retry_times'] = retries
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retries - 1)))
+            self.stats.inc_value(f'endpoint/{endpoint.name}/backoffs')
+            self.stats.inc_value(f'endpoint/{endpoint.name}/backoff_seconds', delay)
+            from twisted.internet import reactor
+            from twisted.internet.task import deferLater
+            await maybe_deferred_to_future(deferLater(reactor, delay, lambda: None))
+
+        d = endpoint.acquire()
+        if d is not None:
+            await maybe_deferred_to_future(d)
+        request.meta['endpoint'] = endpoint.name
         return None
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        endpoint = self._release(request)
+        if endpoint is None:
+            return response
+        latency = request.meta.get('download_latency')
+        failed = response.status == 429 or response.status >= 500 or \
+            failure_answer(body_prefix(response))
+        congested = bool(self.target_latency) and latency is not None and latency > self.target_latency
+        self._record(endpoint, latency, failed, congested)
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
-
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+        endpoint = self._release(request)
+        if endpoint is not None:
+            self._record(endpoint, None, True, True)
+        return None
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+    def _release(self, request):
+        # retries copy the meta after the permit is returned
+        endpoint = self.endpoints.get(request.meta.pop('endpoint', None))
+        if endpoint is not None:
+            endpoint.release()
+        return endpoint
+
+    def _record(self, endpoint, latency, failed, congested):
+        endpoint.record(latency, failed, congested)
+        prefix = f'endpoint/{endpoint.name}'
+        self.stats.inc_value(f'{prefix}/responses')
+        if failed:
+            self.stats.inc_value(f'{prefix}/failures')
+        self.stats.set_value(f'{prefix}/failure_rate', endpoint.failure_rate)
+        self.stats.set_value(f'{prefix}/responses_per_second', endpoint.rate())
+        self.stats.set_value(f'{prefix}/concurrency', endpoint.limit)
+        self.stats.max_value(f'{prefix}/max_concurrency', endpoint.limit)
+        if endpoint.latency is not None:
+            self.stats.set_value(f'{prefix}/latency_seconds', endpoint.latency)
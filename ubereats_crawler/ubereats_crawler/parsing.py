@@ -0,0 +1,73 @@
+# JSON parsing of the Uber Eats API responses.
+#
+# getStoreV1 bodies run to several MB for large menus. They are parsed
+# straight from the response bytes, with orjson when it is installed, and
+# only the fields UbereatsCrawlerItem needs are kept. The embedded metaJson
+# document is only decoded once the store URL is actually needed.
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# fields of the getStoreV1 `data` object kept for the item
+STORE_INFO_FIELDS = (
+    'uuid',
+    'title',
+    'location',
+    'hours',
+    'categories',
+    'sections',
+    'storeReviews',
+    'catalogSectionsMap',
+)
+
+
+def loads(body):
+    '''
+    Parse a JSON document from bytes or str.
+    '''
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def parse_response(response, fast=True):
+    '''
+    Parse the JSON body of a Scrapy response. With `fast`, the raw body is
+    parsed without decoding it to str first.
+    '''
+    if fast:
+        return loads(response.body)
+    return json.loads(response.text)
+
+
+def extract_store_info(data):
+    '''
+    Keep the fields of a getStoreV1 `data` object that the item needs, so
+    the rest of the response can be freed right away.
+    '''
+    store = {field: data[field] for field in STORE_INFO_FIELDS}
+    store['metaJson'] = data.get('metaJson')
+    return store
+
+
+def resolve_store_url(data):
+    '''
+    Decode the pending `metaJson` of a store into its `storeURL`, and return
+    the URL.
+    '''
+    if 'metaJson' not in data:
+        return data.get('storeURL')
+    meta_json = data.pop('metaJson')
+    try:
+        meta = loads(meta_json) if meta_json else {}
+    except ValueError:
+        logging.warning(f"Failed to decode metaJson: {meta_json}")
+        meta = {}
+    data['storeURL'] = meta.get("@id")
+    return data['storeURL']
@@ -8,23 +8,52 @@ import os
 import uuid
 import pymongo
 import logging
-import requests
-import pandas as pd
-import torch
-import clip
-import pickle
-import zlib
+import threading
 import time
 
+import numpy as np
+
 from scrapy.exceptions import DropItem
 from itemadapter import ItemAdapter
+from twisted.internet import defer, threads
+
+from .batching import EmbeddingBatcher
+from .codec import DEFAULT_DTYPE, decode_embedding, decode_embeddings, encode_embedding
+from .embedding_cache import CachedEncoder, EmbeddingCache
+from .enrichment import EMBEDDING, GEOCODE
+from .eventlog import EventLogger, Lazy, count_items
+from .extensions import rss_bytes
+from .geocoding import ArzueGeoEncoder, GeocodingService
+from .incremental import catalog_changed, diff_update, reuse_embeddings
+from .inference import text_encoder_from_settings
+from .instrumentation import observe_deferred, timed
+from .parsing import resolve_store_url
+from .storage import FreshnessIndex, MongoWriteBuffer
 
 
-def compress_embedding_weights(weights):
-    return zlib.compress(pickle.dumps(weights))
+def compress_embedding_weights(weights, dtype=DEFAULT_DTYPE):
+    return encode_embedding(weights, dtype)
 
 def decompress_embedding_weights(weights):
-    return pickle.loads(zlib.decompress(weights))
+    '''
+    Decode a stored embedding into a numpy vector. Embeddings written as
+    zlib compressed pickles by older versions are still supported.
+    '''
+    return decode_embedding(weights)
+
+def item_text(name, description=None, max_words=20):
+    '''
+    Text that is embedded for a menu item: its name, followed by its
+    description if it has one, cut to the first `max_words` words.
+    '''
+    if isinstance(description, str) and description.strip():
+        words = (name + " made by " + description).split()
+    else:
+        words = name.split()
+    return ' '.join(words[:max_words])
+
+def catalog_item_text(item):
+    return item_text(item['title'], item.get('itemDescription'))
 
 class RestaurantDocumentTransformer:
 
@@ -76,6 +105,21 @@ class RestaurantItemFlattenTransformer(RestaurantDocumentTransformer):
             'item_image_url',
         ]
 
+    @staticmethod
+    def catalog_items(restaurant):
+        '''
+        Yield the catalog items of a restaurant document in menu order.
+
+        The same item may be listed in several sections; every listing is
+        yielded, so positions line up with the rows returned by the iterator.
+        '''
+        menus = restaurant.get('catalogSectionsMap', {})
+        for menu in menus.values():
+            for section in menu:
+                items = section.get("payload", {}).get(
+                    "standardItemsPayload", {}).get("catalogItems", [])
+                yield from items
+
     def __iter__(self):
         for restaurant in self.data:
             restaurant_id = restaurant.get('_id')
@@ -85,27 +129,22 @@ class RestaurantItemFlattenTransformer(RestaurantDocumentTransformer):
             restaurant_lon = restaurant.get('location', {}).get('longitude')
             restaurant_category = restaurant.get('categories')
 
-            menus = restaurant.get('catalogSectionsMap', {})
-            for menu in menus.values():
-                for section in menu:
-                    items = section.get("payload", {}).get(
-                        "standardItemsPayload", {}).get("catalogItems", [])
-                    for item in items:
-                        item_id = item['uuid']
-                        item_name = item['title']
-                        item_description = item.get('itemDescription')
-                        item_image_url = item['imageUrl']
-                        yield [
-                            restaurant_id,
-                            restaurant_name,
-                            restaurant_address,
-                            (restaurant_lat, restaurant_lon),
-                            restaurant_category,
-                            item_id,
-                            item_name,
-                            item_description,
-                            item_image_url,
-                        ]
+            for item in self.catalog_items(restaurant):
+                item_id = item['uuid']
+                item_name = item['title']
+                item_description = item.get('itemDescription')
+                item_image_url = item['imageUrl']
+                yield [
+                    restaurant_id,
+                    restaurant_name,
+                    restaurant_address,
+                    (restaurant_lat, restaurant_lon),
+                    restaurant_category,
+                    item_id,
+                    item_name,
+                    item_description,
+                    item_image_url,
+                ]
 
 
 class RestaurantDocumentToPrompt(RestaurantDocumentTransformer):
@@ -117,12 +156,35 @@ class RestaurantDocumentToPrompt(RestaurantDocumentTransformer):
         raise NotImplementedError("Not implemented yet")
 
 
+EARTH_RADIUS_METERS = 6378100
+
+# one document per embedded catalog item of the matched stores, with only
+# the store id, item uuid, title and embedding
+CATALOG_ITEM_EMBEDDINGS = [
+    {'$project': {'menus': {'$objectToArray': '$catalogSectionsMap'}}},
+    {'$unwind': '$menus'},
+    {'$unwind': '$menus.v'},
+    {'$unwind': '$menus.v.payload.standardItemsPayload.catalogItems'},
+    {'$project': {
+        'uuid': '$menus.v.payload.standardItemsPayload.catalogItems.uuid',
+        'title': '$menus.v.payload.standardItemsPayload.catalogItems.title',
+        'embedding': '$menus.v.payload.standardItemsPayload.catalogItems.text_embedding',
+    }},
+    {'$match': {'embedding': {'$exists': True}}},
+]
+
+
 class RestaurantLocator:
 
-    def __init__(self, uri, db, collection):
+    def __init__(self, uri, db, collection, encode=None, index=None):
         self._mongo = pymongo.MongoClient(uri)
         self._db = self._mongo[db]
         self._collection = self._db[collection]
+        # encoder of text queries (search.ClipTextEncoder by default), and an
+        # optional search.VectorIndex snapshot to score items from instead
+        # of reading their embeddings from Mongo
+        self._encode = encode
+        self._index = index
 
     def __call__(self, lat, lon, radius, limit=10):
         filt = {
@@ -143,31 +205,97 @@ class RestaurantLocator:
 
         return ret
 
+    def search(self, query, lat, lon, radius, limit=10, offset=0, max_stores=5000, batch_size=200):
+        '''
+        Menu items matching `query` (a text or an embedding) from the stores
+        within `radius` meters of (lat, lon), best first.
+
+        Returns up to `limit` dicts with score, store_id, store_name,
+        item_uuid and title, after skipping the `offset` best ones. At most
+        `max_stores` stores are considered.
+        '''
+        if isinstance(query, str):
+            if self._encode is None:
+                from .search import ClipTextEncoder
+                self._encode = ClipTextEncoder()
+            query = self._encode([query])[0]
+        query = np.asarray(query, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        stores = self._nearby_stores(lat, lon, radius, max_stores)
+        k = offset + limit
+        if self._index is not None:
+            scores, rows = self._index.search_vectors(query, k, rows=self._index.store_rows(stores))
+            results = self._index.describe(rows[0], scores[0])
+        else:
+            results = self._score_items(query, list(stores), k, batch_size)
+        for result in results:
+            result['store_name'] = stores.get(result['store_id'])
+        return results[offset:k]
+
+    def _nearby_stores(self, lat, lon, radius, max_stores):
+        # unsorted $geoWithin is cheaper than $near; only ids and names
+        filt = {
+            'geo': {
+                '$geoWithin': {
+                    '$centerSphere': [[lon, lat], radius / EARTH_RADIUS_METERS]
+                }
+            }
+        }
+        cursor = self._collection.find(filt, {'name': 1}).limit(max_stores)
+        return {str(doc['_id']): doc.get('name') for doc in cursor}
+
+    def _score_items(self, query, store_ids, k, batch_size):
+        # decode and score the items of `batch_size` stores at a time,
+        # keeping the k best
+        best_scores = np.empty(0, dtype=np.float32)
+        best = []
+        for start in range(0, len(store_ids), batch_size):
+            ids = store_ids[start:start + batch_size]
+            items = list(self._collection.aggregate(
+                [{'$match': {'_id': {'$in': ids}}}] + CATALOG_ITEM_EMBEDDINGS))
+            if not items:
+                continue
+            scores = decode_embeddings([item['embedding'] for item in items]) @ query
+            scores = np.concatenate([best_scores, scores])
+            candidates = best + items
+            top = np.argsort(-scores, kind='stable')[:k]
+            best_scores = scores[top]
+            best = [candidates[i] for i in top]
+        return [{'score': float(score), 'store_id': str(item['_id']),
+                 'item_uuid': item.get('uuid'), 'title': item.get('title')}
+                for score, item in zip(best_scores, best)]
+
 class EmbeddingsGenerator:
 
     def __init__(self, df, model):
+        import torch
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model = model
-        self.text_embeddings = self.get_embeddings(df)
+        self.text_embeddings = self.get_embeddings(df) if df is not None else None
         '''
         generate embeddings from text or image data
         '''
+    @staticmethod
+    def get_item_texts(df):
+        return [item_text(name, description)
+                for name, description in zip(df.item_name, df.item_description)]
+
     def get_embeddings(self, df):
-        item_names = df.item_name
-        item_descriptions = df.item_description
+        return self.get_text_embeddings(self.get_item_texts(df))
 
-        # keep only the first 20 words
-        item_texts = item_names.combine(item_descriptions, lambda a, b: (a + " made by " + b).split()[:20] if pd.notna(b) else a)
-        item_texts = item_texts.apply(lambda x: ' '.join(x)).tolist()
+    def get_text_embeddings(self, item_texts):
+        import clip
         if self.device  == "cuda":
             text_tokens = clip.tokenize(item_texts, truncate=True).cuda()
         else:
             text_tokens = clip.tokenize(item_texts, truncate=True)
         text_embeddings = self.encode(text_tokens)
         return text_embeddings
-    
+
     def encode(self, data, batch_size = 1000, is_image=False):
-        
+        import torch
+
         with torch.no_grad():
             
             sum_embeddings = []
@@ -190,41 +318,35 @@ class EmbeddingsGenerator:
         return embeddings
     
 
-class ArzueGeoEncoder:
-
-    def __init__(self):
-        self._session = requests.Session()
-        self._api_key = os.environ.get('ARZUE_MAPS_API_KEY')
-        assert self._api_key, 'ArzueGeoEncoder: No API key provided.'
-
-    def __call__(self, address, country="US"):
-        param = {
-            "api-version": "1.0",
-            "query": address,
-            "countrySet": country,
-            "subscription-key": self._api_key,
-        }
-        endpoint = "https://atlas.microsoft.com/search/address/json"
-        try:
-            response = self._session.get(endpoint, params=param)
-            response.raise_for_status()
-            data = response.json()
-            if data['summary']['totalResults'] == 0:
-                logging.warning(f'ArzueGeoEncoder: No results found for {address}')
-                return 0, 0
-            else:
-                return data['results'][0]['position']['lat'], data['results'][0]['position']['lon']
-        except Exception as e:
-            logging.error(f'ArzueGeoEncoder: {e}')
-            return 0, 0
-
-
 class UbereatsCrawlerPipeline:
 
-    def __init__(self):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
-        self.geo_encoder = ArzueGeoEncoder()
+    def __init__(self, settings, stats=None):
+        self.stats = stats
+        # per-store events, sampled and rate limited (see eventlog)
+        self.events = EventLogger.from_settings(settings, logging.getLogger(__name__), stats)
+        # "deferred": store the crawled documents as they are and leave the
+        # embeddings and geocoding to the enrichment workers
+        self._inline = settings.get('ENRICHMENT_MODE', 'inline') == 'inline'
+        # part of the text hash of every embedded item, so that items are
+        # embedded again when the model changes
+        self._clip_model_name = settings.get('CLIP_MODEL', 'ViT-B/32')
+        if self._inline:
+            self.geocoder = GeocodingService.from_settings(settings, stats=stats)
+            # one inference.TextEncoder shared by all stores, created with
+            # the model by the first batch that needs it; the batcher calls it
+            # from its worker threads with texts of many stores at once.
+            self._settings = settings
+            self._text_encoder = None
+            self._clip_warmup = settings.getbool('CLIP_WARMUP', False)
+            self._model_lock = threading.Lock()
+            encode = self._encode_texts
+            # only texts that were never encoded before reach the model
+            self._embedding_cache = EmbeddingCache.from_settings(settings)
+            if self._embedding_cache is not None:
+                encode = CachedEncoder(encode, self._embedding_cache, stats=stats)
+            self._embedding_batcher = EmbeddingBatcher.from_settings(
+                encode, settings, stats=stats)
+            self._embedding_dtype = settings.get('EMBEDDING_STORAGE_DTYPE', DEFAULT_DTYPE)
         if os.environ.get('MONGODB_URI'):
             self._dry_run = False
             self._client = pymongo.MongoClient(
@@ -232,14 +354,66 @@ class UbereatsCrawlerPipeline:
             )
             self._db = self._client[os.environ.get('MONGODB_DB')]
             self._collection = self._db[os.environ.get('MONGODB_COLLECTION')]
+            self._write_buffer = MongoWriteBuffer.from_settings(
+                self._collection, settings, stats=stats)
+            self._freshness_index = FreshnessIndex(
+                max_age=settings.getfloat('FRESHNESS_MAX_AGE', 7 * 24 * 60 * 60))
             logging.info(f'Pipeline connected to {os.environ.get("MONGODB_URI")}')
         else:
             self._dry_run = True
         logging.info(f'Pipeline dry run: {self._dry_run}')
 
-    def close_spider(self, spider):
-        self._collection.create_index([('geo', pymongo.GEOSPHERE)])
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def _load_model(self):
+        # runs in an EmbeddingBatcher worker thread, or the warmup thread
+        with self._model_lock:
+            if self._text_encoder is None:
+                load_start = time.time()
+                self._text_encoder = text_encoder_from_settings(self._settings)
+                elapsed = time.time() - load_start
+                logging.info(f'CLIP model {self._clip_model_name} loaded in {elapsed} seconds.')
+                if self.stats is not None:
+                    from twisted.internet import reactor
+                    reactor.callFromThread(self.stats.set_value, 'startup/model_load_seconds', elapsed)
+                    reactor.callFromThread(self.stats.set_value, 'startup/rss_bytes_after_model_load', rss_bytes())
+        return self._text_encoder
+
+    def _encode_texts(self, texts):
+        # runs in an EmbeddingBatcher worker thread
+        return self._load_model()(texts)
+
+    @defer.inlineCallbacks
+    def open_spider(self, spider):
+        if self._dry_run:
+            return
+        if self._inline and self._clip_warmup:
+            warmup = threads.deferToThread(self._load_model)
+            warmup.addErrback(lambda failure: logging.error(f'CLIP warmup failed: {failure.value}'))
+        load_start = time.time()
+        yield threads.deferToThread(self._freshness_index.load, self._collection)
+        logging.info(f'Freshness index of {len(self._freshness_index)} stores loaded in {time.time() - load_start} seconds.')
+        # the spider consults the index before it requests a store
+        spider.freshness_index = self._freshness_index
 
+    def close_spider(self, spider):
+        d = defer.succeed(None)
+        if self._inline:
+            d.addCallback(lambda _: self._embedding_batcher.close())
+            d.addCallback(lambda _: self._text_encoder and self._text_encoder.close())
+            if self._embedding_cache is not None:
+                d.addCallback(lambda _: self._embedding_cache.close())
+            d.addCallback(lambda _: self.geocoder.close())
+        if not self._dry_run:
+            d.addCallback(lambda _: self._write_buffer.close())
+            d.addCallback(lambda _: self._collection.create_index([('geo', pymongo.GEOSPHERE)]))
+            if not self._inline:
+                d.addCallback(lambda _: self._collection.create_index('pendingEnrichment'))
+        return d
+
+    @defer.inlineCallbacks
     def process_item(self, item, spider):
         adapter = ItemAdapter(item)
         label = adapter.get('label')
@@ -251,7 +425,8 @@ class UbereatsCrawlerPipeline:
         data['label'] = label
 
         if self._dry_run:
-            logging.info(f'Dry run: {data}')
+            self.events.info('dry_run', uuid=data.get('uuid'), name=data.get('name'),
+                             label=label, items=count_items(data))
             return
 
         # create index.
@@ -260,75 +435,107 @@ class UbereatsCrawlerPipeline:
         except KeyError:
             data['_id'] = data['uuid'] = uuid.uuid4()
 
-        logging.info(f'Processing {data["name"]} ({data["uuid"]})...')
+        self.events.info('store_processing', uuid=data['uuid'], name=data['name'], label=label)
 
-        # find item with the same uuid
-        last_item = self._collection.find_one({'_id': data['_id']})
         # condition of reindexing:
         # 1. the item is not in the collection
         # 2. It has been 7 days since the last update
         # 3. The item has the same label as the one in the collection
-        if last_item and (time.time() - last_item.get("crawlTime", 0) < 7 * 24 * 60 * 60):
-            last_item_age = time.time() - last_item.get("crawlTime", 0)
-            logging.info(f"Skipping {data['name']} ({data['uuid']}) because it is still fresh {last_item_age}...")
-            return None
         # REF: https://github.com/Blitzat/data-crawler/issues/11
-        if last_item and (last_item.get("label") != data.get("label")):
-            logging.info(f"Skipping {data['name']} ({data['uuid']}) from {label} because it has a different label...")
+        # The spider already skips most of these stores before requesting them.
+        with timed(self.stats, 'freshness'):
+            stale = self._freshness_index.check(data['_id'], label)
+        if stale == FreshnessIndex.FRESH:
+            self.events.info('store_skipped', uuid=data['uuid'], reason='fresh',
+                             age=Lazy(lambda: time.time() - self._freshness_index.get(data['_id'])[0]))
+            return None
+        if stale == FreshnessIndex.OTHER_LABEL:
+            self.events.info('store_skipped', uuid=data['uuid'], reason='other_label', label=label)
             return None
 
+        geocoded = None
+        # enrichment stages left to the enrichment workers
+        pending = []
         try:
             data['geo'] = {
                 'type': 'Point',
                 'coordinates': [data['location']['longitude'], data['location']['latitude']]
             }
         except KeyError:
-            logging.warning(f'No location found for {data["name"]} @ {data.get("location", {}).get("address")}')
-            data['geo'] = {
-                'type': 'Point',
-                'coordinates': self.geo_encoder(
-                    data.get("location", {}).get("address")
-                )
-            }
-
-        logging.info(f"{data['name']} @ {data['location']['address']} is at {data['geo']['coordinates']}")
-
-        logging.info("Creating embedding...")
-        index_start = time.time()
-        # create embbeding.
-        result = RestaurantItemFlattenTransformer([data,])
-        col_names = result.cols()
-        restaurants_df = pd.DataFrame(data=result, columns=col_names)
-        text_embeddings = EmbeddingsGenerator(restaurants_df, self.model).text_embeddings  # get the embeddings for the item
-        restaurants_df['text_embeddings'] = text_embeddings.tolist()
-        logging.info(f"Index created in {time.time() - index_start} seconds for {len(text_embeddings)} items, {len(text_embeddings) / (time.time() - index_start)} items indexed per sec.")
-
-        # assgin embedding to each corresponding item
-        menus = data.get('catalogSectionsMap', {})
-        for menu in menus.values():
-            for section in menu:
-                items = section.get("payload", {}).get(
-                    "standardItemsPayload", {}).get("catalogItems", [])
-                for item in items:
-                    item_id = item['uuid']
-                    item_embedding_series = restaurants_df.loc[restaurants_df['item_id'] == item_id, 'text_embeddings']
-                    item_embedding = list(item_embedding_series)[0]
-                    compressed_embedding = compress_embedding_weights(item_embedding)
-                    # logging.info(f"Assigning embedding to {item['title']} with length {len(compressed_embedding)}...")
-                    item['text_embedding'] = compressed_embedding
-
+            self.events.warning('store_without_location', uuid=data['uuid'],
+                                address=data.get("location", {}).get("address"))
+            if self._inline:
+                # resolved while the menu is being embedded
+                geocoded = observe_deferred(
+                    self.stats, 'geocode', self.geocoder.geocode(data.get("location", {}).get("address")))
+            else:
+                pending.append(GEOCODE)
+
+        # a stored store only needs embeddings for its new and edited items
+        previous = None
+        if data['_id'] in self._freshness_index:
+            previous = yield threads.deferToThread(self._collection.find_one, {'_id': data['_id']})
+        with timed(self.stats, 'flatten'):
+            items = list(RestaurantItemFlattenTransformer.catalog_items(data))
+            changed = reuse_embeddings(items, previous, self._clip_model_name, catalog_item_text)
+        if self.stats is not None:
+            self.stats.inc_value('embedding/items_reused', len(items) - len(changed))
+
+        if self._inline:
+            yield self._enrich(data, geocoded, changed)
+        else:
+            if changed:
+                pending.append(EMBEDDING)
+            data['pendingEnrichment'] = pending
 
-        try:
-            self._collection.update_one(
-            {'_id': data['_id']},
-            {'$set': data},
-            upsert=True
-            )
-        except Exception as e:
-            logging.error(f'Pipeline: {type(e)}: {e}')
-            logging.exception(e)
-            # raise DropItem(f'Pipeline: {type(e)}: {e}')
+        resolve_store_url(data)
+        if previous is None:
+            update = {'$set': data}
+        else:
+            update = diff_update(previous, data)
+            # search.VectorIndex only needs to resync stores whose menu changed
+            if not catalog_changed(update) and 'embeddingTime' in previous:
+                update.get('$set', {}).pop('embeddingTime', None)
+            if self._inline and 'pendingEnrichment' in previous:
+                # written in deferred mode, everything is enriched now
+                update.setdefault('$unset', {})['pendingEnrichment'] = ''
+            if self.stats is not None:
+                self.stats.inc_value('mongo/partial_updates')
+        # queued and written in bulk together with other stores
+        written = yield observe_deferred(
+            self.stats, 'mongo_write_wait', self._write_buffer.update(data['_id'], update))
+        if not written:
             return None
+        self._freshness_index.update(data['_id'], data.get('crawlTime'), label)
 
         return data["storeURL"], data["uuid"], label
 
+    @defer.inlineCallbacks
+    def _enrich(self, data, geocoded, items):
+        # create embbeding of the `items` that need one. Items are matched
+        # with their embeddings by position, so an item listed in several
+        # sections gets the embedding of its own text in each of them.
+        # The model time of the batches is timed as "encode".
+        text_embeddings = yield observe_deferred(self.stats, 'encode_wait', self._embedding_batcher.submit(
+            [catalog_item_text(item) for item in items]))
+
+        if geocoded is not None:
+            coordinates = yield geocoded
+            if coordinates is None:
+                # better no geo field than a point at (0, 0) in the geo index
+                self.events.warning('geocode_failed', uuid=data['uuid'],
+                                    address=data.get("location", {}).get("address"))
+            else:
+                lat, lon = coordinates
+                data['geo'] = {
+                    'type': 'Point',
+                    'coordinates': [lon, lat]
+                }
+        if 'geo' in data:
+            self.events.debug('store_located', uuid=data['uuid'], coordinates=data['geo']['coordinates'])
+
+        with timed(self.stats, 'compress'):
+            for item, item_embedding in zip(items, text_embeddings):
+                item['text_embedding'] = compress_embedding_weights(item_embedding, self._embedding_dtype)
+        # search.VectorIndex picks up stores embedded since its last sync
+        data['embeddingTime'] = time.time()
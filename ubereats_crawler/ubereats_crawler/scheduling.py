@@ -0,0 +1,179 @@
+# Yield-aware scheduling of cities and categories.
+#
+# Most category feeds of a crawl list stores that are already fresh in
+# Mongo or were already seen in that run. YieldTracker records, per city
+# and per category, how many stores each crawl scheduled (stores that were
+# new or due for a recrawl), and keeps an exponentially weighted average of
+# it over runs in a small SQLite file:
+#   - a category's yield is the stores scheduled from its feed
+#   - a city's yield is the stores scheduled per request spent on it
+#     (its city page and category feeds)
+#
+# The spider uses the averages to
+#   - pick the cities of a run: the highest yielding ones, plus a fraction
+#     YIELD_EXPLORATION of random others so that the averages of every city
+#     stay current (with a frontier, the order within a pass instead)
+#   - set Scrapy request priorities, so that the cities and categories that
+#     yield the most, and their stores, are requested first
+# Under a fixed request budget, e.g. CLOSESPIDER_PAGECOUNT, the requests
+# that are cut are then the ones least likely to find a fresh store.
+# Cities and categories never crawled are scored as the average of the
+# known ones of their kind.
+
+import logging
+import math
+import random
+import time
+
+from .localstore import chunked, connect_sqlite
+
+CITY = 'city'
+CATEGORY = 'category'
+
+
+def priority(score, scale=10):
+    '''
+    Scrapy request priority of an expected yield: `scale` more for every
+    doubling of 1 + yield.
+    '''
+    return int(round(scale * math.log2(1 + max(0.0, score))))
+
+
+class YieldTracker:
+    '''
+    Expected yield of cities and categories, from the stores their past
+    crawls scheduled. Updated with the observations of a run by `save`.
+    '''
+
+    def __init__(self, path, alpha=0.3, exploration=0.2, seed=None):
+        self.path = path
+        self.alpha = alpha
+        self.exploration = exploration
+        self._random = random.Random(seed)
+        self._conn = connect_sqlite(path)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS yields (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                city TEXT NOT NULL,
+                score REAL NOT NULL,
+                runs INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (kind, key));
+            CREATE INDEX IF NOT EXISTS yields_city ON yields (city);
+        ''')
+        self._cities = dict(self._conn.execute(
+            'SELECT key, score FROM yields WHERE kind = ?', (CITY,)))
+        # category scores of the cities crawled by this run, by city
+        self._categories = {}
+        # observations of this run: {city: [requests, scheduled]},
+        # {(category, city): scheduled}
+        self._city_runs = {}
+        self._category_runs = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('YIELD_PATH')
+        if not path:
+            return None
+        return cls(path,
+                   alpha=settings.getfloat('YIELD_ALPHA', 0.3),
+                   exploration=settings.getfloat('YIELD_EXPLORATION', 0.2))
+
+    def close(self):
+        self.save()
+        self._conn.close()
+
+    # expected yields
+
+    def city_score(self, city):
+        score = self._cities.get(city)
+        if score is None:
+            return sum(self._cities.values()) / len(self._cities) if self._cities else 0.0
+        return score
+
+    def category_score(self, category, city):
+        scores = self._city_categories(city)
+        score = scores.get(category)
+        if score is None:
+            return sum(scores.values()) / len(scores) if scores else self.city_score(city)
+        return score
+
+    def city_priority(self, city):
+        return priority(self.city_score(city))
+
+    def category_priority(self, category, city):
+        return priority(self.category_score(category, city))
+
+    def _city_categories(self, city):
+        scores = self._categories.get(city)
+        if scores is None:
+            scores = self._categories[city] = dict(self._conn.execute(
+                'SELECT key, score FROM yields WHERE kind = ? AND city = ?', (CATEGORY, city)))
+        return scores
+
+    def choose_cities(self, cities, limit):
+        '''
+        `limit` cities of `cities`: mostly the highest yielding ones, and a
+        fraction `exploration` drawn at random from the others.
+        '''
+        ranked = self.rank_cities(cities)
+        explore = min(len(ranked) - min(limit, len(ranked)),
+                      int(round(limit * self.exploration)))
+        chosen = ranked[:limit - explore]
+        if explore > 0:
+            chosen += self._random.sample(ranked[limit - explore:], explore)
+        return chosen
+
+    def rank_cities(self, cities):
+        '''
+        `cities` by decreasing expected yield, in their order when equal.
+        '''
+        return sorted(cities, key=self.city_score, reverse=True)
+
+    # observations
+
+    def city_requested(self, city):
+        self._city_runs.setdefault(city, [0, 0])[0] += 1
+
+    def category_crawled(self, category, city, scheduled):
+        '''
+        Record that the feed of `category` in `city` scheduled `scheduled`
+        stores.
+        '''
+        run = self._city_runs.setdefault(city, [0, 0])
+        run[0] += 1
+        run[1] += scheduled
+        key = (category, city)
+        self._category_runs[key] = self._category_runs.get(key, 0) + scheduled
+
+    def save(self):
+        '''
+        Fold the observations of this run into the averages.
+        '''
+        now = time.time()
+        rows = []
+        for (category, city), scheduled in self._category_runs.items():
+            rows.append((CATEGORY, category, city, scheduled))
+        for city, (requests, scheduled) in self._city_runs.items():
+            if requests:
+                rows.append((CITY, city, city, scheduled / requests))
+        if not rows:
+            return
+        self._conn.execute('BEGIN')
+        for chunk in chunked(rows):
+            self._conn.executemany(
+                'INSERT INTO yields (kind, key, city, score, runs, updated) VALUES (?, ?, ?, ?, 1, ?) '
+                'ON CONFLICT (kind, key) DO UPDATE SET '
+                'score = ? * excluded.score + (1 - ?) * score, runs = runs + 1, '
+                'updated = excluded.updated, city = excluded.city',
+                [(kind, key, city, value, now, self.alpha, self.alpha)
+                 for kind, key, city, value in chunk])
+        self._conn.execute('COMMIT')
+        logging.info(f'YieldTracker: yields of {len(self._city_runs)} cities and '
+                     f'{len(self._category_runs)} categories saved to {self.path}')
+        self._city_runs.clear()
+        self._category_runs.clear()
+        self._cities = dict(self._conn.execute(
+            'SELECT key, score FROM yields WHERE kind = ?', (CITY,)))
+        self._categories.clear()
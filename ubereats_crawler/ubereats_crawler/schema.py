@@ -0,0 +1,98 @@
+# Projection of store payloads onto the fields we actually use.
+#
+# getStoreV1 returns every key the Uber Eats front end needs for each menu,
+# catalog item and review. Most of it is never read, yet it used to be held
+# in memory through the whole item chain and written to Mongo. The
+# projection keeps the document layout (catalogSectionsMap ->
+# sections -> payload.standardItemsPayload.catalogItems) so the pipeline
+# and existing readers work unchanged, but each record only keeps the
+# whitelisted keys.
+
+# defaults of the ITEM_*_FIELDS settings
+MENU_FIELDS = (
+    'uuid',
+    'title',
+    'subtitle',
+    'isTop',
+    'isOnSale',
+    'subsectionUuids',
+)
+
+CATALOG_ITEM_FIELDS = (
+    'uuid',
+    'title',
+    'itemDescription',
+    'imageUrl',
+    'price',
+    'isSoldOut',
+    'isAvailable',
+    'hasCustomizations',
+    'sectionUuid',
+    'subsectionUuid',
+)
+
+REVIEW_FIELDS = (
+    'eaterName',
+    'reviewText',
+    'rating',
+    'timeSinceReview',
+)
+
+SECTION_FIELDS = ('uuid', 'type')
+
+
+def _fields(settings, name, default):
+    # an empty list in the settings keeps all fields
+    return tuple(settings.getlist(name, default)) or None
+
+
+def _pick(record, fields):
+    if fields is None or not isinstance(record, dict):
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+class ItemProjection:
+    '''
+    Strip a store (as returned by parsing.extract_store_info) down to the
+    whitelisted fields of its menus, catalog items and reviews. A whitelist
+    of None keeps those records untouched.
+    '''
+
+    def __init__(self, menu_fields=MENU_FIELDS, catalog_item_fields=CATALOG_ITEM_FIELDS,
+                 review_fields=REVIEW_FIELDS):
+        self.menu_fields = tuple(menu_fields) if menu_fields is not None else None
+        self.catalog_item_fields = tuple(catalog_item_fields) if catalog_item_fields is not None else None
+        self.review_fields = tuple(review_fields) if review_fields is not None else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.getbool('ITEM_PROJECTION_ENABLED', True):
+            return None
+        return cls(
+            menu_fields=_fields(settings, 'ITEM_MENU_FIELDS', MENU_FIELDS),
+            catalog_item_fields=_fields(settings, 'ITEM_CATALOG_ITEM_FIELDS', CATALOG_ITEM_FIELDS),
+            review_fields=_fields(settings, 'ITEM_REVIEW_FIELDS', REVIEW_FIELDS),
+        )
+
+    def __call__(self, store):
+        store['sections'] = [_pick(menu, self.menu_fields)
+                             for menu in store.get('sections') or []]
+        store['storeReviews'] = [_pick(review, self.review_fields)
+                                 for review in store.get('storeReviews') or []]
+        store['catalogSectionsMap'] = {
+            menu_uuid: [self._section(section) for section in sections]
+            for menu_uuid, sections in (store.get('catalogSectionsMap') or {}).items()
+        }
+        return store
+
+    def _section(self, section):
+        projected = _pick(section, SECTION_FIELDS)
+        payload = section.get("payload", {}).get("standardItemsPayload")
+        if payload is not None:
+            projected['payload'] = {'standardItemsPayload': {
+                'title': payload.get('title'),
+                'catalogItems': [_pick(item, self.catalog_item_fields)
+                                 for item in payload.get('catalogItems', [])],
+            }}
+        return projected
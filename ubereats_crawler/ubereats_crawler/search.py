@@ -0,0 +1,513 @@
+# Semantic search over the stored menu item embeddings.
+#
+# VectorIndex keeps a local snapshot of every item embedding in one
+# contiguous matrix file that is memory-mapped for queries, next to an SQLite
+# table mapping matrix rows to stores and items. Text queries are embedded
+# with the same CLIP model as the items and scored against the whole matrix
+# with chunked matrix products. Once trained, an inverted file index (IVF:
+# rows grouped by their nearest of ~sqrt(n) k-means centroids) limits each
+# query to the rows of the `nprobe` lists closest to it, which keeps queries
+# over millions of items in the tens of milliseconds on a CPU.
+#
+# The snapshot is updated incrementally from Mongo: `sync` reads the stores
+# embedded since the last sync, appends their items and marks the rows of
+# their previous version as deleted. `compact` drops deleted rows.
+# embeddingTime is stamped by the writer before its (bulk, buffered) write,
+# so a store stamped before the newest stamp a sync saw can still be
+# committed after that sync. Each sync therefore looks `sync_overlap`
+# seconds further back than the newest stamp it saw before, and only
+# re-reads the stores of that window whose embeddingTime it has not synced.
+#
+#   python -m ubereats_crawler.search sync [--full]
+#   python -m ubereats_crawler.search train [--lists 1024]
+#   python -m ubereats_crawler.search query "spicy ramen" -k 10
+#   python -m ubereats_crawler.search compact
+
+import argparse
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .codec import decode_embeddings
+from .localstore import chunked, connect_sqlite
+
+
+def store_item_embeddings(doc):
+    '''
+    Yield (item uuid, title, encoded embedding) of the embedded items of a
+    store document.
+    '''
+    from .pipelines import RestaurantItemFlattenTransformer
+
+    for item in RestaurantItemFlattenTransformer.catalog_items(doc):
+        blob = item.get('text_embedding')
+        if blob is not None:
+            yield item.get('uuid'), item.get('title'), blob
+
+
+class ClipTextEncoder:
+    '''
+    Embed query texts with the CLIP model used for the menu items. The model
+    is loaded on first use.
+    '''
+
+    def __init__(self, model_name='ViT-B/32'):
+        self.model_name = model_name
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('CLIP_MODEL', 'ViT-B/32'))
+
+    def __call__(self, texts):
+        with self._lock:
+            if self._encoder is None:
+                from .inference import TextEncoder, TorchTextModel
+                self._encoder = TextEncoder(TorchTextModel(self.model_name))
+        return self._encoder(list(texts))
+
+
+class VectorIndex:
+    '''
+    Memory-mapped matrix of item embeddings stored in directory `path`.
+
+    Vectors are stored as float32, or as int8 with one scale per row
+    (`dtype='int8'`, 4x smaller and somewhat slower to score). The dtype of
+    an existing snapshot is kept. Queries are exact until `train` builds the
+    inverted file index; after that rows added later are assigned to their
+    nearest list as they are appended.
+    '''
+
+    def __init__(self, path, encode=None, dtype='float32', nprobe=16, chunk_rows=1 << 16,
+                 sync_overlap=300):
+        if dtype not in ('float32', 'int8'):
+            raise ValueError(f'Unsupported index dtype {dtype!r}, expected float32 or int8.')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._encode = encode
+        self.nprobe = nprobe
+        self._chunk_rows = chunk_rows
+        self.sync_overlap = sync_overlap
+        self._conn = connect_sqlite(os.path.join(path, 'rows.sqlite3'))
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS info (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                store_id TEXT NOT NULL,
+                item_uuid TEXT,
+                title TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS rows_store ON rows (store_id);
+            CREATE TABLE IF NOT EXISTS synced (
+                store_id TEXT PRIMARY KEY,
+                embedding_time REAL NOT NULL);
+        ''')
+        info = dict(self._conn.execute('SELECT key, value FROM info'))
+        self.dtype = info.get('dtype', dtype)
+        self.dim = int(info.get('dim', 0))
+        self.synced_until = float(info.get('synced_until', 0))
+        self._rows = self._conn.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+        self._deleted = np.zeros(self._rows, dtype=bool)
+        for chunk in chunked(row for row, in self._conn.execute('SELECT row FROM rows WHERE deleted = 1')):
+            self._deleted[chunk] = True
+        self._vectors = None
+        self._scales = None
+        # inverted file index: centroids, list of every row, and the rows
+        # sorted by list with the offset of each list
+        self._centroids = None
+        self._lists = None
+        self._inverted = None
+        if os.path.exists(os.path.join(path, 'centroids.npy')):
+            self._centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self._lists = np.fromfile(self._file('lists'), dtype=np.int32)
+
+    @classmethod
+    def from_settings(cls, settings, encode=None):
+        return cls(settings.get('SEARCH_INDEX_PATH', '.cache/search'),
+                   encode=encode or ClipTextEncoder.from_settings(settings),
+                   dtype=settings.get('SEARCH_INDEX_DTYPE', 'float32'),
+                   nprobe=settings.getint('SEARCH_INDEX_NPROBE', 16),
+                   sync_overlap=settings.getfloat('SEARCH_SYNC_OVERLAP', 300))
+
+    def __len__(self):
+        return int(self._rows - self._deleted.sum())
+
+    def close(self):
+        self._vectors = self._scales = None
+        self._conn.close()
+
+    # queries
+
+    def search(self, query, k=10):
+        '''
+        Return the `k` items closest to the text `query` as dicts with
+        score, store_id, item_uuid and title, best first.
+        '''
+        scores, rows = self.search_vectors(self._encode([query]), k)
+        return self.describe(rows[0], scores[0])
+
+    def search_vectors(self, queries, k=10, rows=None, nprobe=None):
+        '''
+        Top `k` rows for each of the (m, dim) `queries`; returns (scores,
+        rows), both (m, k') sorted by decreasing score. With `rows`, only
+        those rows are scored; otherwise the `nprobe` closest lists of the
+        inverted file index, or every row if there is none (or nprobe is 0).
+        '''
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        nprobe = self.nprobe if nprobe is None else nprobe
+        if rows is None and self._centroids is not None and nprobe:
+            results = [self._score(query[None], k, self._probe(query, nprobe)) for query in queries]
+            width = min(len(result[0][0]) for result in results)
+            return (np.concatenate([scores[:, :width] for scores, _ in results]),
+                    np.concatenate([found[:, :width] for _, found in results]))
+        return self._score(queries, k, rows)
+
+    def _probe(self, query, nprobe):
+        # rows of the nprobe lists whose centroids are closest to the query
+        if self._inverted is None:
+            order = np.argsort(self._lists, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(self._lists, minlength=len(self._centroids)))])
+            self._inverted = order, offsets
+        order, offsets = self._inverted
+        closest = np.argsort(-(self._centroids @ query))[:nprobe]
+        rows = np.concatenate([order[offsets[i]:offsets[i + 1]] for i in closest])
+        # sorted rows read the memory map front to back
+        rows.sort()
+        return rows
+
+    def _score(self, queries, k, rows):
+        vectors, scales = self._matrix()
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        if rows is None:
+            blocks = ((np.arange(start, min(start + self._chunk_rows, self._rows)),
+                       slice(start, start + self._chunk_rows))
+                      for start in range(0, self._rows, self._chunk_rows))
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            rows = rows[~self._deleted[rows]]
+            blocks = ((part, part) for part in np.array_split(rows, max(1, -(-len(rows) // self._chunk_rows))))
+        for block_rows, index in blocks:
+            if not len(block_rows):
+                continue
+            block = vectors[index]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores = queries @ block.T
+            if scales is not None:
+                scores *= scales[index]
+            deleted = self._deleted[block_rows]
+            if deleted.any():
+                scores[:, deleted] = -np.inf
+            best_scores, best_rows = _merge_top_k(best_scores, best_rows, scores, block_rows, k)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        keep = np.isfinite(best_scores).all(axis=0)
+        return best_scores[:, keep], best_rows[:, keep]
+
+    def describe(self, rows, scores):
+        rows = [int(row) for row in rows]
+        meta = {}
+        for chunk in chunked(rows):
+            marks = ','.join('?' * len(chunk))
+            for row, store_id, item_uuid, title in self._conn.execute(
+                    f'SELECT row, store_id, item_uuid, title FROM rows WHERE row IN ({marks})', chunk):
+                meta[row] = (store_id, item_uuid, title)
+        return [{'score': float(score), 'store_id': meta[row][0],
+                 'item_uuid': meta[row][1], 'title': meta[row][2]}
+                for row, score in zip(rows, scores)]
+
+    def store_rows(self, store_ids):
+        '''
+        Live rows of the items of `store_ids`.
+        '''
+        rows = []
+        for chunk in chunked(str(store_id) for store_id in store_ids):
+            marks = ','.join('?' * len(chunk))
+            rows.extend(row for row, in self._conn.execute(
+                f'SELECT row FROM rows WHERE deleted = 0 AND store_id IN ({marks})', chunk))
+        return rows
+
+    def _matrix(self):
+        if self._vectors is None or len(self._vectors) != self._rows:
+            if not self._rows:
+                return np.empty((0, self.dim), dtype=np.float32), None
+            self._vectors = np.memmap(self._file('vectors'), dtype=self.dtype, mode='r',
+                                      shape=(self._rows, self.dim))
+            if self.dtype == 'int8':
+                self._scales = np.memmap(self._file('scales'), dtype=np.float32, mode='r',
+                                         shape=(self._rows,))
+        return self._vectors, self._scales
+
+    # updates
+
+    def upsert_stores(self, docs):
+        '''
+        Replace the items of the given store documents by their current
+        embedded items.
+        '''
+        docs = list(docs)
+        self._delete_rows(self.store_rows(doc['_id'] for doc in docs))
+        entries = [(str(doc['_id']), item_uuid, title, blob)
+                   for doc in docs for item_uuid, title, blob in store_item_embeddings(doc)]
+        self._append(entries)
+
+    def remove_stores(self, store_ids):
+        store_ids = [str(store_id) for store_id in store_ids]
+        self._delete_rows(self.store_rows(store_ids))
+        for chunk in chunked(store_ids):
+            marks = ','.join('?' * len(chunk))
+            self._conn.execute(f'DELETE FROM synced WHERE store_id IN ({marks})', chunk)
+
+    def sync(self, collection, full=False, batch_size=500):
+        '''
+        Bring the snapshot up to date with `collection`: every store embedded
+        since the last sync, or every store with `full`. Returns the number
+        of stores read.
+        '''
+        projection = {'catalogSectionsMap': 1, 'embeddingTime': 1}
+        if full:
+            docs = collection.find({}, projection, batch_size=batch_size)
+        else:
+            since = self.synced_until - self.sync_overlap
+            stamps = {doc['_id']: doc.get('embeddingTime') for doc in collection.find(
+                {'embeddingTime': {'$gte': since}}, {'embeddingTime': 1}, batch_size=batch_size)}
+            synced = self._synced_times(stamps)
+            ids = [doc_id for doc_id, stamp in stamps.items() if synced.get(str(doc_id)) != stamp]
+            docs = (doc for chunk in chunked(ids, batch_size)
+                    for doc in collection.find({'_id': {'$in': chunk}}, projection))
+        count = 0
+        synced_until = self.synced_until
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            synced_until = max(synced_until, doc.get('embeddingTime') or 0)
+            if len(batch) >= batch_size:
+                self._sync_batch(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._sync_batch(batch)
+            count += len(batch)
+        self.synced_until = synced_until
+        self._set_info(synced_until=synced_until)
+        logging.info(f'VectorIndex: {count} stores synced, {len(self)} items indexed')
+        return count
+
+    def _sync_batch(self, docs):
+        self.upsert_stores(docs)
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO synced (store_id, embedding_time) VALUES (?, ?)',
+            [(str(doc['_id']), doc.get('embeddingTime') or 0) for doc in docs])
+
+    def _synced_times(self, store_ids):
+        times = {}
+        for chunk in chunked(str(store_id) for store_id in store_ids):
+            marks = ','.join('?' * len(chunk))
+            times.update(self._conn.execute(
+                f'SELECT store_id, embedding_time FROM synced WHERE store_id IN ({marks})', chunk))
+        return times
+
+    def compact(self):
+        '''
+        Rewrite the snapshot without deleted rows.
+        '''
+        vectors, scales = self._matrix()
+        live = np.flatnonzero(~self._deleted)
+        tmp = {name: self._file(name) + '.tmp' for name in ('vectors', 'scales', 'lists')}
+        with open(tmp['vectors'], 'wb') as vf, open(tmp['scales'], 'wb') as sf:
+            for part in np.array_split(live, max(1, -(-len(live) // self._chunk_rows))):
+                np.ascontiguousarray(vectors[part]).tofile(vf)
+                if scales is not None:
+                    np.ascontiguousarray(scales[part]).tofile(sf)
+        if self._lists is not None:
+            self._lists = self._lists[live]
+            self._lists.tofile(tmp['lists'])
+            os.replace(tmp['lists'], self._file('lists'))
+            self._inverted = None
+        self._conn.execute('BEGIN')
+        # renumber the remaining rows in order
+        self._conn.execute('CREATE TEMP TABLE renumbered AS '
+                           'SELECT store_id, item_uuid, title FROM rows WHERE deleted = 0 ORDER BY row')
+        self._conn.execute('DELETE FROM rows')
+        self._conn.execute('INSERT INTO rows (row, store_id, item_uuid, title) '
+                           'SELECT rowid - 1, store_id, item_uuid, title FROM renumbered ORDER BY rowid')
+        self._conn.execute('DROP TABLE renumbered')
+        self._conn.execute('COMMIT')
+        self._vectors = self._scales = None
+        os.replace(tmp['vectors'], self._file('vectors'))
+        if self.dtype == 'int8':
+            os.replace(tmp['scales'], self._file('scales'))
+        else:
+            os.remove(tmp['scales'])
+        self._rows = len(live)
+        self._deleted = np.zeros(self._rows, dtype=bool)
+
+    def train(self, n_lists=None, iterations=10, seed=0):
+        '''
+        Build the inverted file index: spherical k-means with `n_lists`
+        centroids (sqrt of the number of rows by default) on a sample of the
+        live rows, then assign every row to its nearest centroid.
+        '''
+        vectors, scales = self._matrix()
+        live = np.flatnonzero(~self._deleted)
+        if not len(live):
+            return
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(live)))), len(live))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(live, min(len(live), 64 * n_lists), replace=False))
+        data = self._rows_as_float(vectors, scales, sample)
+        centroids = data[rng.choice(len(data), n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, data)
+            empty = np.bincount(assign, minlength=n_lists) == 0
+            # empty lists restart from random sample points
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        lists = np.empty(self._rows, dtype=np.int32)
+        for start in range(0, self._rows, self._chunk_rows):
+            part = np.arange(start, min(start + self._chunk_rows, self._rows))
+            lists[part] = np.argmax(self._rows_as_float(vectors, scales, part) @ centroids.T, axis=1)
+        lists.tofile(self._file('lists'))
+        np.save(os.path.join(self.path, 'centroids.npy'), centroids.astype(np.float32))
+        self._centroids = centroids.astype(np.float32)
+        self._lists = lists
+        self._inverted = None
+        logging.info(f'VectorIndex: inverted file index of {n_lists} lists trained on {len(sample)} rows')
+
+    @staticmethod
+    def _rows_as_float(vectors, scales, rows):
+        data = np.asarray(vectors[rows], dtype=np.float32)
+        if scales is not None:
+            data *= scales[rows][:, None]
+        return data
+
+    def _delete_rows(self, rows):
+        if not rows:
+            return
+        self._conn.execute('BEGIN')
+        for chunk in chunked(rows):
+            marks = ','.join('?' * len(chunk))
+            self._conn.execute(f'UPDATE rows SET deleted = 1 WHERE row IN ({marks})', chunk)
+        self._conn.execute('COMMIT')
+        self._deleted[rows] = True
+
+    def _append(self, entries):
+        if not entries:
+            return
+        matrix = decode_embeddings([blob for _, _, _, blob in entries])
+        if not self.dim:
+            self.dim = matrix.shape[1]
+            self._set_info(dim=self.dim, dtype=self.dtype)
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f'Embedding size {matrix.shape[1]} does not match the index ({self.dim}).')
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        if self.dtype == 'int8':
+            scales = (np.abs(matrix).max(axis=1) / 127).astype(np.float32)
+            scales[scales == 0] = 1
+            payload = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+            with open(self._file('scales'), 'ab') as f:
+                scales.tofile(f)
+        else:
+            payload = matrix
+        with open(self._file('vectors'), 'ab') as f:
+            payload.tofile(f)
+        if self._centroids is not None:
+            lists = np.argmax(matrix @ self._centroids.T, axis=1).astype(np.int32)
+            with open(self._file('lists'), 'ab') as f:
+                lists.tofile(f)
+            self._lists = np.concatenate([self._lists, lists])
+            self._inverted = None
+        start = self._rows
+        self._conn.execute('BEGIN')
+        self._conn.executemany(
+            'INSERT INTO rows (row, store_id, item_uuid, title) VALUES (?, ?, ?, ?)',
+            [(start + i, store_id, item_uuid, title)
+             for i, (store_id, item_uuid, title, _) in enumerate(entries)])
+        self._conn.execute('COMMIT')
+        self._rows += len(entries)
+        self._deleted = np.concatenate([self._deleted, np.zeros(len(entries), dtype=bool)])
+
+    def _file(self, name):
+        return os.path.join(self.path, f'{name}.bin')
+
+    def _set_info(self, **values):
+        self._conn.executemany('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)',
+                               [(key, str(value)) for key, value in values.items()])
+
+
+def _merge_top_k(best_scores, best_rows, scores, rows, k):
+    # keep the k best of the previous best and a new block of scores
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        block_rows = rows[part]
+    else:
+        block_rows = np.broadcast_to(rows, scores.shape)
+    scores = np.concatenate([best_scores, scores], axis=1)
+    rows = np.concatenate([best_rows, block_rows], axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    return scores, rows
+
+
+def main():
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+
+    parser = argparse.ArgumentParser(description='Semantic search over menu item embeddings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    sync = commands.add_parser('sync', help='update the local snapshot from Mongo')
+    sync.add_argument('--full', action='store_true', help='read every store, not only new ones')
+    query = commands.add_parser('query', help='search the local snapshot')
+    query.add_argument('text')
+    query.add_argument('-k', type=int, default=10)
+    query.add_argument('--near', type=float, nargs=2, metavar=('LAT', 'LON'),
+                       help='only items of stores around this point')
+    query.add_argument('--radius', type=float, default=2000, help='meters around --near')
+    query.add_argument('--offset', type=int, default=0, help='skip the best OFFSET results of --near')
+    train = commands.add_parser('train', help='build the inverted file index of the snapshot')
+    train.add_argument('--lists', type=int, help='number of lists, sqrt of the number of items by default')
+    commands.add_parser('compact', help='drop replaced items from the snapshot')
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    configure_logging(settings)
+    index = VectorIndex.from_settings(settings)
+    if args.command == 'sync':
+        import pymongo
+        collection = pymongo.MongoClient(os.environ.get('MONGODB_URI'))[
+            os.environ.get('MONGODB_DB')][os.environ.get('MONGODB_COLLECTION')]
+        index.sync(collection, full=args.full)
+    elif args.command == 'train':
+        index.train(args.lists)
+    elif args.command == 'query' and args.near:
+        from .pipelines import RestaurantLocator
+        locator = RestaurantLocator(os.environ.get('MONGODB_URI'), os.environ.get('MONGODB_DB'),
+                                    os.environ.get('MONGODB_COLLECTION'),
+                                    encode=ClipTextEncoder.from_settings(settings), index=index)
+        for result in locator.search(args.text, *args.near, args.radius, args.k, args.offset):
+            print(json.dumps(result))
+    elif args.command == 'query':
+        for result in index.search(args.text, args.k):
+            print(json.dumps(result))
+    else:
+        index.compact()
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,18 +15,88 @@ NEWSPIDER_MODULE = "ubereats_crawler.spiders"
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
 
+# Site to crawl, the list of city slugs to start from and how many of them
+# are crawled per run; overridden by the benchmarks to crawl a local mock
+# server instead.
+UBEREATS_URL_ROOT = "https://www.ubereats.com"
+CITIES_FILE = "./all-cities.json"
+CITIES_PER_RUN = 32
+
+# Crawl progress (expanded cities and categories, scheduled and completed
+# stores) is recorded here so an interrupted crawl resumes where it stopped,
+# and consecutive runs work through CITIES_FILE in order. With an empty path
+# every run crawls CITIES_PER_RUN random cities from scratch.
+FRONTIER_PATH = ".cache/frontier.sqlite3"
+
+# How many stores each city and category yielded (new or due for a
+# recrawl) is averaged over runs in YIELD_PATH, weighting the latest run by
+# YIELD_ALPHA. Runs without a frontier crawl the highest yielding cities
+# plus a fraction YIELD_EXPLORATION of random ones, runs with one go through
+# the pending cities of a pass highest yielding first. Requests of high
+# yielding cities and categories get a higher priority, so under a request
+# budget (e.g. CLOSESPIDER_PAGECOUNT) the low yielding ones are cut.
+YIELD_PATH = ".cache/yield.sqlite3"
+YIELD_ALPHA = 0.3
+YIELD_EXPLORATION = 0.2
+
+# The category paths of each city page are cached in CATEGORY_CACHE_PATH for
+# CATEGORY_LIST_TTL seconds, so city pages are not requested again every
+# run. The stores each category feed listed are kept too: a category whose
+# last known stores are all listed by larger categories of the city is not
+# requested, as long as those lists are at most CATEGORY_OVERLAP_MAX_AGE
+# seconds old. With an empty path every city page and feed is requested.
+CATEGORY_CACHE_PATH = ".cache/categories.sqlite3"
+CATEGORY_LIST_TTL = 3 * 24 * 3600
+CATEGORY_OVERLAP_MAX_AGE = 7 * 24 * 3600
+
+# Distributed crawling: cities, categories and stores become tasks of a queue
+# shared by every crawl process, which lease them for WORK_QUEUE_LEASE_TIMEOUT
+# seconds at a time and de-duplicate stores across processes. The whole
+# CITIES_FILE is crawled and CITIES_PER_RUN / FRONTIER_PATH are ignored. Use
+# MongoWorkQueue (collection WORK_QUEUE_NAME in MONGODB_DB) across nodes, or
+# SQLiteWorkQueue (WORK_QUEUE_PATH) for processes on one machine; start a new
+# crawl with a new queue name or path.
+WORK_QUEUE_BACKEND = ""
+#WORK_QUEUE_BACKEND = "ubereats_crawler.workqueue.MongoWorkQueue"
+#WORK_QUEUE_BACKEND = "ubereats_crawler.workqueue.SQLiteWorkQueue"
+WORK_QUEUE_NAME = "crawl_queue"
+WORK_QUEUE_PATH = ".cache/queue.sqlite3"
+WORK_QUEUE_LEASE_TIMEOUT = 300
+WORK_QUEUE_PREFETCH = 64
+WORK_QUEUE_POLL_INTERVAL = 1.0
+
+# Parse API responses from the raw body bytes (with orjson when available)
+# instead of decoding them to str and using the json module.
+FAST_JSON_PARSING = True
+
+# Fields kept of every menu, catalog item and review of a store; the rest of
+# the getStoreV1 payload is dropped in the spider. Set a list to [] to keep
+# all fields of those records, or ITEM_PROJECTION_ENABLED to False to keep
+# the payload as is. Defaults are in ubereats_crawler/schema.py.
+ITEM_PROJECTION_ENABLED = True
+#ITEM_MENU_FIELDS = ["uuid", "title", "subtitle", "isTop", "isOnSale", "subsectionUuids"]
+#ITEM_CATALOG_ITEM_FIELDS = ["uuid", "title", "itemDescription", "imageUrl", "price", ...]
+#ITEM_REVIEW_FIELDS = ["eaterName", "reviewText", "rating", "timeSinceReview"]
+
+# Append every raw getStoreV1 body to a gzipped JSON lines file. %(time)s is
+# replaced with the start time of the crawl. Disabled when empty.
+RAW_ARCHIVE_PATH = ""
+#RAW_ARCHIVE_PATH = "archive/stores-%(time)s.jsonl.gz"
+
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
-# Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 16
+# Configure maximum concurrent requests performed by Scrapy (default: 16).
+# Requests waiting for their endpoint or a retry backoff count too; the
+# per-endpoint limits below decide how many are actually in flight.
+CONCURRENT_REQUESTS = 64
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 #DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
-CONCURRENT_REQUESTS_PER_DOMAIN = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 64
 #CONCURRENT_REQUESTS_PER_IP = 16
 
 # Disable cookies (enabled by default)
@@ -49,15 +119,67 @@ COOKIES_ENABLED = False
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "ubereats_crawler.middlewares.UbereatsCrawlerDownloaderMiddleware": 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    "ubereats_crawler.middlewares.UbereatsCrawlerDownloaderMiddleware": 950,
+}
+
+# Each API endpoint (getSeoFeedV1, getStoreV1, city pages) gets its own
+# concurrency limit, starting at ENDPOINT_CONCURRENCY_START: one more request
+# in flight per window of successful responses, halved on failures (HTTP
+# 429/5xx, download errors, "status: failure" answers) and on responses
+# slower than ENDPOINT_TARGET_LATENCY seconds. The endpoint/* stats report
+# the rates, latency and limit of every endpoint.
+ENDPOINT_CONCURRENCY_ENABLED = True
+ENDPOINT_CONCURRENCY_START = 4
+ENDPOINT_CONCURRENCY_MIN = 1
+ENDPOINT_CONCURRENCY_MAX = 32
+ENDPOINT_TARGET_LATENCY = 5.0
+# Retries wait a random time of up to RETRY_BACKOFF_BASE * 2 ** (retries - 1)
+# seconds, at most RETRY_BACKOFF_MAX, before they are sent.
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
+    "ubereats_crawler.extensions.StartupStats": 500,
+    "ubereats_crawler.extensions.StageTimingStats": 500,
+    "ubereats_crawler.extensions.PrometheusExporter": 500,
+    "ubereats_crawler.extensions.SamplingProfiler": 500,
+    "ubereats_crawler.extensions.QueueLoggingExtension": 500,
+}
+
+# Stage timings are kept in the stats as timing/<stage>/* histograms. With
+# PROMETHEUS_PORT set, the stats are served in the Prometheus text format
+# on http://PROMETHEUS_HOST:PROMETHEUS_PORT/metrics during the crawl.
+PROMETHEUS_PORT = 0
+PROMETHEUS_HOST = "127.0.0.1"
+# With PROFILE_PATH set, all threads are sampled every PROFILE_INTERVAL
+# seconds and the collapsed stacks written there for flame graphs, e.g.
+# "profiles/crawl-%(time)s.folded".
+#PROFILE_PATH = None
+PROFILE_INTERVAL = 0.01
+
+# Per-store log events (see eventlog) are thinned out by name:
+# LOG_EVENT_SAMPLING keeps that fraction of them, LOG_EVENT_RATE_LIMITS at
+# most that many per second. The log is written by a listener thread from a
+# queue of LOG_QUEUE_SIZE records; records are dropped when it is full.
+LOG_EVENT_SAMPLING = {
+    "store_processing": 0.01,
+    "store_skipped": 0.01,
+    "store_located": 0.01,
+    "dry_run": 0.01,
+}
+LOG_EVENT_RATE_LIMITS = {
+    "store_without_location": 1,
+    "geocode_failed": 1,
+    "request_retry": 1,
+    "request_failed": 1,
+}
+LOG_QUEUE_ENABLED = True
+LOG_QUEUE_SIZE = 10000
+LOG_FORMATTER = "ubereats_crawler.eventlog.SummaryLogFormatter"
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -65,6 +187,100 @@ ITEM_PIPELINES = {
     "ubereats_crawler.pipelines.UbereatsCrawlerPipeline": 300,
 }
 
+# Embedding stage of the item pipeline. Menu items of many stores are encoded
+# together in batches of at most EMBEDDING_BATCH_SIZE texts on
+# EMBEDDING_WORKERS threads. A partial batch is sent to the workers once its
+# oldest text has been waiting for EMBEDDING_MAX_WAIT seconds.
+EMBEDDING_BATCH_SIZE = 1000
+EMBEDDING_MAX_WAIT = 0.5
+EMBEDDING_WORKERS = 2
+
+# Model inference of those batches (see inference.py). Texts are sorted by
+# token length and encoded EMBEDDING_MODEL_BATCH_SIZE at a time, cut to the
+# longest text of each batch. EMBEDDING_BACKEND is TorchTextModel, with
+# dynamic int8 quantization if EMBEDDING_QUANTIZE, or OnnxTextModel (needs
+# onnxruntime; the model is exported to EMBEDDING_ONNX_PATH on first use).
+# Quantized and ONNX models fall back to plain torch if their embeddings are
+# not within EMBEDDING_MIN_COSINE of it. With EMBEDDING_PROCESSES > 0 the
+# batches are encoded by that many worker processes, each with its own model
+# and EMBEDDING_THREADS_PER_PROCESS intra-op threads (0: torch's default).
+EMBEDDING_BACKEND = "ubereats_crawler.inference.TorchTextModel"
+#EMBEDDING_BACKEND = "ubereats_crawler.inference.OnnxTextModel"
+EMBEDDING_QUANTIZE = False
+EMBEDDING_ONNX_PATH = ".cache/clip-text.onnx"
+EMBEDDING_MIN_COSINE = 0.99
+EMBEDDING_MODEL_BATCH_SIZE = 64
+EMBEDDING_PROCESSES = 0
+EMBEDDING_THREADS_PER_PROCESS = 0
+
+# CLIP model used to embed menu items. torch and the model are loaded when
+# the first store needs embeddings, so dry runs, deferred enrichment and runs
+# where every store is fresh never load them. With CLIP_WARMUP the model is
+# loaded in a background thread as soon as the spider opens instead.
+CLIP_MODEL = "ViT-B/32"
+CLIP_WARMUP = False
+
+# Local snapshot of the item embeddings for semantic search, updated with
+# `python -m ubereats_crawler.search sync`. "int8" stores it 4x smaller than
+# "float32" at some cost in query time. After `search train`, queries only
+# score the rows of the SEARCH_INDEX_NPROBE inverted file lists closest to
+# them. Each sync also re-checks the stores embedded up to
+# SEARCH_SYNC_OVERLAP seconds before the last one it saw, for writes that
+# were committed late; keep it above MONGO_FLUSH_INTERVAL plus the longest
+# write delay and clock skew between crawl and enrichment processes.
+SEARCH_INDEX_PATH = ".cache/search"
+SEARCH_INDEX_DTYPE = "float32"
+SEARCH_INDEX_NPROBE = 16
+SEARCH_SYNC_OVERLAP = 300
+
+# On-disk cache of item text embeddings shared by all crawls. Set the path to
+# an empty string to disable it. Least recently used embeddings are evicted
+# once the cache holds more than EMBEDDING_CACHE_MAX_ITEMS of them.
+EMBEDDING_CACHE_PATH = ".cache/embeddings.sqlite3"
+EMBEDDING_CACHE_MAX_ITEMS = 500000
+
+# Storage type of the embeddings written to Mongo: "float32", "float16" or
+# "int8" (scalar quantized with a per-vector scale, half the size of float16
+# but lossy).
+EMBEDDING_STORAGE_DTYPE = "float16"
+
+# Stores are upserted into Mongo in unordered bulk writes of up to
+# MONGO_BULK_SIZE documents. A partial batch is written after
+# MONGO_FLUSH_INTERVAL seconds and at most MONGO_MAX_IN_FLIGHT bulk writes
+# run at the same time.
+MONGO_BULK_SIZE = 100
+MONGO_FLUSH_INTERVAL = 2.0
+MONGO_MAX_IN_FLIGHT = 2
+
+# "inline" embeds and geocodes every store in the item pipeline. "deferred"
+# only stores the crawled documents, marked with the stages still pending in
+# `pendingEnrichment`, for workers started with
+# `python -m ubereats_crawler.enrichment {embedding,geocode}`; the crawler
+# then does not load the CLIP model. Workers claim ENRICHMENT_BATCH_SIZE
+# stores at a time for ENRICHMENT_LEASE_TIMEOUT seconds.
+ENRICHMENT_MODE = "inline"
+ENRICHMENT_BATCH_SIZE = 32
+ENRICHMENT_LEASE_TIMEOUT = 600
+ENRICHMENT_POLL_INTERVAL = 10
+
+# Stores crawled less than FRESHNESS_MAX_AGE seconds ago are not requested
+# again.
+FRESHNESS_MAX_AGE = 7 * 24 * 60 * 60
+
+# Geocoding of stores without coordinates. Backends are classes with a
+# from_settings() constructor, a request_url(address, country) method and a
+# parse(json) method; GEOCODER_ENDPOINT overrides the backend's URL, e.g.
+# to use a local stub server. Results are cached in GEOCODER_CACHE_PATH for
+# GEOCODER_CACHE_TTL seconds, addresses without a result for
+# GEOCODER_NEGATIVE_TTL seconds.
+GEOCODER_BACKEND = "ubereats_crawler.geocoding.ArzueMapsBackend"
+GEOCODER_ENDPOINT = None
+GEOCODER_CONCURRENCY = 4
+GEOCODER_TIMEOUT = 10
+GEOCODER_CACHE_PATH = ".cache/geocodes.sqlite3"
+GEOCODER_CACHE_TTL = 180 * 24 * 60 * 60
+GEOCODER_NEGATIVE_TTL = 24 * 60 * 60
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -80,11 +296,22 @@ ITEM_PIPELINES = {
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Responses are kept in one SQLite file, keyed by endpoint and canonical
+# JSON body. HTTPCACHE_ENDPOINT_TTLS gives the expiration of each endpoint
+# in seconds, HTTPCACHE_EXPIRATION_SECS that of the others (0: never).
+# HTTPCACHE_REPLAY uses cached answers whatever their age; with
+# HTTPCACHE_IGNORE_MISSING = True it replays a recorded crawl offline.
+HTTPCACHE_ENABLED = False
+HTTPCACHE_STORAGE = "ubereats_crawler.httpcache.SQLiteCacheStorage"
+HTTPCACHE_PATH = ".cache/http.sqlite3"
+HTTPCACHE_EXPIRATION_SECS = 24 * 60 * 60
+HTTPCACHE_ENDPOINT_TTLS = {
+    "getSeoFeedV1": 6 * 60 * 60,
+    "getStoreV1": 7 * 24 * 60 * 60,
+}
+HTTPCACHE_IGNORE_HTTP_CODES = [429, 500, 502, 503, 504]
+HTTPCACHE_REPLAY = False
+#HTTPCACHE_IGNORE_MISSING = True
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
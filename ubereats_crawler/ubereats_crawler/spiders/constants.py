@@ -2,10 +2,12 @@
 URL_ROOT = "https://www.ubereats.com"
 
 # API to get store uuids by city and category
-URL_GET_SEO_FEED = "https://www.ubereats.com/api/getSeoFeedV1"
+PATH_GET_SEO_FEED = "/api/getSeoFeedV1"
+URL_GET_SEO_FEED = URL_ROOT + PATH_GET_SEO_FEED
 
 # API to get information of each store including all menus
-URL_GET_STORE_INFO = "https://www.ubereats.com/api/getStoreV1"
+PATH_GET_STORE_INFO = "/api/getStoreV1"
+URL_GET_STORE_INFO = URL_ROOT + PATH_GET_STORE_INFO
 
 ## XPath
 
@@ -6,13 +6,25 @@ import time
 import random
 
 from pathlib import Path
+from ..archive import RawArchive
+from ..categories import CategoryIndex
+from ..eventlog import EventLogger
+from ..frontier import CrawlFrontier
+from ..instrumentation import timed
 from ..items import UbereatsCrawlerItem
+from ..parsing import extract_store_info, parse_response
+from ..scheduling import YieldTracker
+from ..schema import ItemProjection
+from ..storage import uuid_key
+from ..workqueue import CATEGORY, CITY, STORE, WorkQueueClient
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.downloadermiddlewares.retry import get_retry_request
 
 # self-defined modules
 from .constants import URL_ROOT
-from .constants import URL_GET_SEO_FEED
-from .constants import URL_GET_STORE_INFO
+from .constants import PATH_GET_SEO_FEED
+from .constants import PATH_GET_STORE_INFO
 from .constants import XPATH_CATEGORIES
 from .constants import XPATH_UUID_SCRIPT
 from .constants import ALLOWED_STATES
@@ -25,7 +37,81 @@ class UbereatsSpider(scrapy.Spider):
     def __init__(self, name=None, **kwargs):
         super().__init__(name, **kwargs)
 
+        # 16 byte keys of the stores seen by this run, used when there is no
+        # frontier.CrawlFrontier to resume from
         self.__store_uuid_seen = set()
+        self.frontier = None
+        # workqueue.WorkQueueClient when crawling in distributed mode; the
+        # queue then takes the place of the frontier
+        self.work_queue = None
+        # storage.FreshnessIndex of the stores already in Mongo, set by the
+        # pipeline when the spider opens; None in dry-run mode.
+        self.freshness_index = None
+        # overridden by the UBEREATS_URL_ROOT setting, e.g. for benchmarks
+        self.url_root = URL_ROOT
+        self.cities_file = "./all-cities.json"
+        self.cities_per_run = 32
+        self.fast_json_parsing = True
+        # schema.ItemProjection applied to every store, and the optional
+        # archive.RawArchive of raw getStoreV1 bodies
+        self.item_projection = ItemProjection()
+        self.raw_archive = None
+        # scheduling.YieldTracker choosing and prioritizing cities and
+        # categories by the stores they yielded before
+        self.yield_tracker = None
+        # categories.CategoryIndex of cached city pages and of the overlap
+        # between category feeds, to skip feeds other feeds cover
+        self.category_index = None
+        # retries and failures, sampled and rate limited (see eventlog)
+        self.events = EventLogger(self.logger)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.url_root = crawler.settings.get('UBEREATS_URL_ROOT') or URL_ROOT
+        spider.cities_file = crawler.settings.get('CITIES_FILE') or spider.cities_file
+        spider.cities_per_run = crawler.settings.getint('CITIES_PER_RUN', spider.cities_per_run)
+        spider.fast_json_parsing = crawler.settings.getbool('FAST_JSON_PARSING', True)
+        spider.item_projection = ItemProjection.from_settings(crawler.settings)
+        spider.raw_archive = RawArchive.from_settings(crawler.settings)
+        spider.yield_tracker = YieldTracker.from_settings(crawler.settings)
+        spider.category_index = CategoryIndex.from_settings(crawler.settings)
+        spider.events = EventLogger.from_settings(crawler.settings, spider.logger)
+        if crawler.settings.get('WORK_QUEUE_BACKEND'):
+            spider.work_queue = WorkQueueClient.from_crawler(crawler, spider.__task_request)
+            crawler.signals.connect(spider.__idle, signal=signals.spider_idle)
+        else:
+            spider.frontier = CrawlFrontier.from_settings(crawler.settings)
+        if spider.frontier is not None or spider.work_queue is not None:
+            for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+                crawler.signals.connect(spider.__item_finished, signal=signal)
+            crawler.signals.connect(spider.__callback_failed, signal=signals.spider_error)
+        return spider
+
+    def closed(self, reason):
+        if self.raw_archive is not None:
+            self.raw_archive.close()
+        if self.frontier is not None:
+            self.frontier.close()
+        if self.yield_tracker is not None:
+            self.yield_tracker.close()
+        if self.category_index is not None:
+            self.category_index.close()
+            stats = self.crawler.stats
+            requested = stats.get_value('categories/feeds_requested', 0)
+            skipped = stats.get_value('categories/skipped_overlap', 0)
+            saved = 100 * skipped / (requested + skipped) if requested + skipped else 0
+            self.logger.info(f'Category feeds: {requested} requested, {skipped} skipped as covered '
+                             f'by other feeds ({saved:.1f}% saved); '
+                             f'{stats.get_value("categories/list_cache_hits", 0)} city pages '
+                             f'read from the cache')
+        if self.work_queue is not None:
+            return self.work_queue.close()
+
+    async def start(self):
+        # Scrapy >= 2.13 entry point; older versions call start_requests().
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
         # current dir is top level dir of the project
@@ -37,18 +123,44 @@ class UbereatsSpider(scrapy.Spider):
         #                          errback=self.__process_failed_request,
         #                          cb_kwargs={'label': f'{city}'})
 
-        with open("./all-cities.json") as f:
+        with open(self.cities_file) as f:
             cities = json.load(f)
+
+        if self.work_queue is not None:
+            # every worker adds the city list, only the first one counts;
+            # requests come from the tasks leased from the queue
+            self.work_queue.add(CITY, None, cities)
+            self.work_queue.start()
+            return
+
+        if self.frontier is None:
             random.shuffle(cities)
-            for city in cities[:32]:
-                # state = city.split("-")[-1].upper()
-                # if not state in ALLOWED_STATES:
-                #     self.logger.info(f"Skipping {city} because it is not in allowed states.")
-                #     continue
-                yield scrapy.Request(url=f'{URL_ROOT}/city/{city}',
-                                     callback=self.__get_all_menus_by_city,
-                                     errback=self.__process_failed_request,
-                                     cb_kwargs={'label': f'{city}'})
+            if self.yield_tracker is not None:
+                cities = self.yield_tracker.choose_cities(cities, self.cities_per_run)
+            cities = cities[:self.cities_per_run]
+        else:
+            # finish what an interrupted run left behind, then continue with
+            # the next cities of the list, the highest yielding first
+            self.frontier.sync_cities(cities)
+            stores = self.frontier.pending_stores()
+            categories = self.frontier.pending_categories()
+            cities = self.frontier.next_cities(
+                self.cities_per_run,
+                key=self.yield_tracker.city_score if self.yield_tracker is not None else None)
+            self.logger.info(f'Frontier pass {self.frontier.current_pass}: resuming '
+                             f'{len(stores)} stores and {len(categories)} categories, '
+                             f'starting {len(cities)} cities')
+            for uuid, label in stores:
+                yield self.__store_request(uuid, label)
+            for category, label in categories:
+                yield self.__category_request(category, label)
+
+        for city in cities:
+            # state = city.split("-")[-1].upper()
+            # if not state in ALLOWED_STATES:
+            #     self.logger.info(f"Skipping {city} because it is not in allowed states.")
+            #     continue
+            yield from self.__start_city(city)
 
     def parse(self, response):
         raise Exception(
@@ -57,24 +169,99 @@ class UbereatsSpider(scrapy.Spider):
 
     def __get_all_menus_by_city(self, response, label):
         all_category_paths = self.__get_all_category_paths(response)
+        if self.yield_tracker is not None:
+            self.yield_tracker.city_requested(label)
+        if self.category_index is not None:
+            self.category_index.put_categories(label, all_category_paths)
+        return self.__expand_city(label, all_category_paths)
+
+    def __cached_categories(self, city):
+        if self.category_index is None:
+            return None
+        paths = self.category_index.categories(city)
+        if paths is not None:
+            self.crawler.stats.inc_value('categories/list_cache_hits')
+        return paths
+
+    def __start_city(self, city):
+        # the city page is only requested when its category list isn't cached
+        paths = self.__cached_categories(city)
+        if paths is None:
+            return [self.__city_request(city)]
+        return self.__expand_city(city, paths)
+
+    def __expand_city(self, label, category_paths):
+        if self.category_index is not None:
+            category_paths, skipped = self.category_index.plan(label, category_paths)
+            self.crawler.stats.inc_value('categories/skipped_overlap', len(skipped))
+        if self.work_queue is not None:
+            self.work_queue.add(CATEGORY, label, category_paths)
+            self.work_queue.done(CITY, label)
+            return []
+        if self.frontier is not None:
+            self.frontier.city_expanded(label, category_paths)
+        return [self.__category_request(category, label) for category in category_paths]
+
+    def __task_request(self, kind, key, label):
+        if kind == CITY:
+            paths = self.__cached_categories(key)
+            if paths is None:
+                return self.__city_request(key)
+            # queues its categories and completes the task
+            self.__expand_city(key, paths)
+            return None
+        if kind == CATEGORY:
+            return self.__category_request(key, label)
+        return self.__store_request(key, label)
+
+    def __city_request(self, city):
+        priority = 0
+        if self.yield_tracker is not None:
+            priority = self.yield_tracker.city_priority(city)
+        return scrapy.Request(url=f'{self.url_root}/city/{city}',
+                              callback=self.__get_all_menus_by_city,
+                              errback=self.__process_failed_request,
+                              priority=priority,
+                              cb_kwargs={'label': f'{city}'})
+
+    def __category_request(self, category, label):
+        priority = 0
+        if self.yield_tracker is not None:
+            priority = self.yield_tracker.category_priority(category, label)
+        self.crawler.stats.inc_value('categories/feeds_requested')
+        return scrapy.Request(
+            url=self.url_root + PATH_GET_SEO_FEED,
+            callback=self.__get_all_menus_by_city_and_category,
+            errback=self.__process_failed_request,
+            method='POST',
+            priority=priority,
+            headers={
+                'content-type': 'application/json',
+                'x-csrf-token': 'x',
+            },
+            body=json.dumps({
+                'pathname': category,
+            }),
+            cb_kwargs={'label': label, 'category': category})
 
-        for category in all_category_paths:
-            yield scrapy.Request(
-                url=URL_GET_SEO_FEED,
-                callback=self.__get_all_menus_by_city_and_category,
-                errback=self.__process_failed_request,
-                method='POST',
-                headers={
-                    'content-type': 'application/json',
-                    'x-csrf-token': 'x',
-                },
-                body=json.dumps({
-                    'pathname': category,
-                }),
-                cb_kwargs={'label': label})
-
-    def __get_all_menus_by_city_and_category(self, response, label):
-        feeds = json.loads(response.text)
+    def __store_request(self, uuid, label, priority=0):
+        return scrapy.Request(url=self.url_root + PATH_GET_STORE_INFO,
+                              callback=self.__process_store_info,
+                              errback=self.__process_failed_request,
+                              method='POST',
+                              priority=priority,
+                              headers={
+                                  'content-type': 'application/json',
+                                  'x-csrf-token': 'x',
+                              },
+                              body=json.dumps({'storeUuid': uuid}),
+                              cb_kwargs={
+                                  'label': label,
+                                  'uuid': uuid
+                              })
+
+    def __get_all_menus_by_city_and_category(self, response, label, category=None):
+        feeds = parse_response(response, self.fast_json_parsing)
         if feeds['status'] == 'failure':
             new_request_or_none = get_retry_request(
                 response.request,
@@ -83,6 +270,7 @@ class UbereatsSpider(scrapy.Spider):
                 reason='Failed to get data from getSeoFeedV1 api.',
             )
             if new_request_or_none is None:
+                self.__category_finished(category, label)
                 yield {
                     'label': 'failure',
                     'data': {
@@ -91,31 +279,89 @@ class UbereatsSpider(scrapy.Spider):
                     }
                 }
             else:
-                self.log("Failed to get data from getSeoFeedV1, retrying ... ",
-                         logging.WARN)
+                self.events.warning('request_retry', endpoint='getSeoFeedV1', label=label, category=category)
                 yield new_request_or_none
             return
 
-        for item in feeds["data"]["elements"][4]["feedItems"]:
-            uuid = item["uuid"]
-            if uuid not in self.__store_uuid_seen:
-                self.__store_uuid_seen.add(uuid)
-                yield scrapy.Request(url=URL_GET_STORE_INFO,
-                                     callback=self.__process_store_info,
-                                     errback=self.__process_failed_request,
-                                     method='POST',
-                                     headers={
-                                         'content-type': 'application/json',
-                                         'x-csrf-token': 'x',
-                                     },
-                                     body=json.dumps({'storeUuid': uuid}),
-                                     cb_kwargs={
-                                         'label': label,
-                                         'uuid': uuid
-                                     })
+        listed = [item["uuid"] for item in feeds["data"]["elements"][4]["feedItems"]]
+        if self.category_index is not None and category is not None:
+            self.category_index.feed_fetched(category, label, listed)
+        uuids = self.__unseen_store_uuids(listed)
+        scheduled, skipped = [], []
+        for uuid in uuids:
+            # the pipeline would discard this store anyway, don't fetch it
+            if self.freshness_index is not None:
+                reason = self.freshness_index.check(uuid, label)
+                if reason is not None:
+                    self.crawler.stats.inc_value(f'freshness/skipped_{reason}')
+                    skipped.append(uuid)
+                    continue
+            scheduled.append(uuid)
+        self.crawler.stats.inc_value('yield/stores_scheduled', len(scheduled))
+        if self.yield_tracker is not None:
+            self.yield_tracker.category_crawled(category, label, len(scheduled))
+        if self.work_queue is not None:
+            # the queue drops stores another worker has already added
+            self.work_queue.add(STORE, label, scheduled)
+            self.__category_finished(category, label)
+            return
+        if self.frontier is not None:
+            self.frontier.add_stores(skipped, label, done=True)
+            self.frontier.add_stores(scheduled, label)
+        self.__category_finished(category, label)
+
+        # stores of the categories that yield the most come first
+        for uuid in scheduled:
+            yield self.__store_request(uuid, label, response.request.priority)
+
+    def __unseen_store_uuids(self, uuids):
+        if self.work_queue is not None:
+            return list(uuids)
+        if self.frontier is not None:
+            return self.frontier.unseen_stores(uuids)
+        unseen = []
+        for uuid in uuids:
+            key = uuid_key(uuid)
+            if key not in self.__store_uuid_seen:
+                self.__store_uuid_seen.add(key)
+                unseen.append(uuid)
+        return unseen
+
+    def __city_finished(self, city):
+        if self.work_queue is not None:
+            self.work_queue.done(CITY, city)
+        elif self.frontier is not None:
+            self.frontier.city_expanded(city, [])
+
+    def __category_finished(self, category, label):
+        if category is None:
+            return
+        if self.work_queue is not None:
+            self.work_queue.done(CATEGORY, category)
+        elif self.frontier is not None:
+            self.frontier.category_done(category, label)
+
+    def __store_finished(self, uuid):
+        if self.work_queue is not None:
+            self.work_queue.done(STORE, uuid)
+        elif self.frontier is not None:
+            self.frontier.store_done(uuid)
+
+    def __item_finished(self, response, **kwargs):
+        # item_scraped/item_dropped/item_error: the store request is done
+        request = getattr(response, 'request', None)
+        uuid = request.cb_kwargs.get('uuid') if request is not None else None
+        if uuid is not None:
+            self.__store_finished(uuid)
+
+    def __idle(self):
+        # other workers may still add tasks; wait until the queue is done
+        if not self.work_queue.is_drained():
+            raise DontCloseSpider
 
     def __process_store_info(self, response, label, uuid):
-        res = json.loads(response.text)
+        with timed(self.crawler.stats, 'parse'):
+            res = parse_response(response, self.fast_json_parsing)
 
         if res['status'] == 'failure':
             new_request_or_none = get_retry_request(
@@ -127,36 +373,54 @@ class UbereatsSpider(scrapy.Spider):
             if new_request_or_none is None:
                 yield {'label': 'failure', 'data': {'uuid': uuid}}
             else:
-                self.log("Failed to get data from getStoreV1, retrying ... ",
-                         logging.WARN)
+                self.events.warning('request_retry', endpoint='getStoreV1', uuid=uuid)
                 yield new_request_or_none
             return
         else:
-            data = res['data']
-            meta_json = data["metaJson"]
-            try:
-                meta = json.loads(meta_json)
-            except json.decoder.JSONDecodeError:
-                self.log(f"Failed to decode metaJson: {meta_json}",
-                         level=logging.WARNING)
-                meta = {}
-            storeURL = meta.get("@id")
-            item = UbereatsCrawlerItem(
-                uuid=data['uuid'],
-                name=data['title'],
-                location=data['location'],
-                hours=data['hours'],
-                categories=data['categories'],
-                sections=data['sections'],
-                reviews=data['storeReviews'],
-                catalogSectionsMap=data['catalogSectionsMap'],
-                storeURL=storeURL,
-                crawlTime=time.time())
+            if self.raw_archive is not None:
+                self.raw_archive.write(response.body)
+            with timed(self.crawler.stats, 'item_build'):
+                data = extract_store_info(res['data'])
+                # drop the rest of the response before building the item
+                del res
+                if self.item_projection is not None:
+                    data = self.item_projection(data)
+                item = UbereatsCrawlerItem(
+                    uuid=data['uuid'],
+                    name=data['title'],
+                    location=data['location'],
+                    hours=data['hours'],
+                    categories=data['categories'],
+                    sections=data['sections'],
+                    reviews=data['storeReviews'],
+                    catalogSectionsMap=data['catalogSectionsMap'],
+                    metaJson=data['metaJson'],
+                    crawlTime=time.time())
             yield {'label': label, 'data': item}
 
     def __process_failed_request(self, failure):
-        self.log(f"Fail to request {failure.request.url}",
-                 level=logging.WARNING)
+        self.events.warning('request_failed', url=failure.request.url, error=failure.getErrorMessage())
+        # the retry middleware has given up on it, don't request it again
+        self.__task_failed(failure.request)
+
+    def __callback_failed(self, failure, response, spider):
+        # spider_error: a callback raised, e.g. on a malformed answer. The
+        # task would fail the same way again; without this it would stay
+        # leased (and its lease renewed) forever
+        request = getattr(response, 'request', None)
+        if request is None:
+            return
+        self.crawler.stats.inc_value('tasks/callback_errors')
+        self.__task_failed(request)
+
+    def __task_failed(self, request):
+        kwargs = request.cb_kwargs
+        if 'uuid' in kwargs:
+            self.__store_finished(kwargs['uuid'])
+        elif 'category' in kwargs:
+            self.__category_finished(kwargs['category'], kwargs['label'])
+        else:
+            self.__city_finished(kwargs['label'])
 
     def __get_all_category_paths(self, response):
         """The method returns a list of url paths of all categories scawled
@@ -189,8 +453,8 @@ class UbereatsSpider(scrapy.Spider):
 
         uuids = []
         for uuid in unckecked_uuids:
-            if uuid not in self.__store_uuid_seen:
+            if uuid_key(uuid) not in self.__store_uuid_seen:
                 uuids.append(uuid)
-                self.__store_uuid_seen.add(uuid)
+                self.__store_uuid_seen.add(uuid_key(uuid))
 
         return uuids
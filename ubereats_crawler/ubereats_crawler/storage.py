@@ -0,0 +1,231 @@
+# Mongo side of the crawler: write-behind buffering of store upserts, and
+# an in-memory index of when each stored store was last crawled.
+#
+# Instead of one blocking round-trip per store on the reactor thread,
+# updates are collected and sent as unordered bulk writes from a small
+# thread pool. A batch is sent once it is full, once its oldest update has
+# waited long enough, or when the spider closes.
+
+import logging
+import time
+import uuid
+
+from array import array
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from .instrumentation import observe
+
+
+class MongoWriteBuffer:
+    '''
+    Group updates of `collection` into `bulk_write(ordered=False)` batches.
+
+    `update` returns a Deferred firing with True once the document is
+    written, or False if its write failed. Failures are logged per document.
+    At most `max_in_flight` batches are being written at any time.
+    '''
+
+    def __init__(self, collection, batch_size=100, flush_interval=2.0,
+                 max_in_flight=2, stats=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._collection = collection
+        self._batch_size = max(1, int(batch_size))
+        self._flush_interval = flush_interval
+        self._stats = stats
+
+        self._ops = []
+        self._timer = None
+        self._in_flight = set()
+        self._semaphore = defer.DeferredSemaphore(max(1, int(max_in_flight)))
+
+        self._pool = ThreadPool(minthreads=1, maxthreads=max(1, int(max_in_flight)),
+                                name='MongoWriteBuffer')
+        self._pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._pool.stop)
+
+    @classmethod
+    def from_settings(cls, collection, settings, stats=None):
+        return cls(
+            collection,
+            batch_size=settings.getint('MONGO_BULK_SIZE', 100),
+            flush_interval=settings.getfloat('MONGO_FLUSH_INTERVAL', 2.0),
+            max_in_flight=settings.getint('MONGO_MAX_IN_FLIGHT', 2),
+            stats=stats,
+        )
+
+    def __len__(self):
+        return len(self._ops)
+
+    def update(self, doc_id, update, upsert=True):
+        '''
+        Queue `update` of the document `doc_id`.
+        '''
+        d = defer.Deferred()
+        self._ops.append((doc_id, UpdateOne({'_id': doc_id}, update, upsert=upsert), d))
+        if len(self._ops) >= self._batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self._reactor.callLater(self._flush_interval, self._on_timeout)
+        return d
+
+    def flush(self):
+        '''
+        Send all queued updates to Mongo.
+        '''
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        while self._ops:
+            batch = self._ops[:self._batch_size]
+            del self._ops[:self._batch_size]
+            d = self._semaphore.run(
+                threads.deferToThreadPool, self._reactor, self._pool, self._write, batch)
+            self._in_flight.add(d)
+            d.addBoth(self._batch_done, d, batch)
+
+    def close(self):
+        '''
+        Flush the buffer and return a Deferred firing once everything is written.
+        '''
+        self.flush()
+        d = defer.DeferredList(list(self._in_flight), consumeErrors=True)
+
+        def _stop(_):
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._pool.stop()
+
+        d.addBoth(_stop)
+        return d
+
+    def _on_timeout(self):
+        self._timer = None
+        self.flush()
+
+    def _write(self, batch):
+        # runs in a worker thread; returns {index in batch: error} of failed updates
+        start = time.perf_counter()
+        try:
+            self._collection.bulk_write([op for _, op, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {}
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = error.get('errmsg')
+            return failed
+        finally:
+            if self._stats is not None:
+                self._reactor.callFromThread(observe, self._stats, 'mongo_write', time.perf_counter() - start)
+        return {}
+
+    def _batch_done(self, result, d, batch):
+        self._in_flight.discard(d)
+        if isinstance(result, Failure):
+            logging.error(f'MongoWriteBuffer: bulk write of {len(batch)} documents failed: {result.value}')
+            failed = {i: str(result.value) for i in range(len(batch))}
+        else:
+            failed = result
+
+        for i, (doc_id, _, deferred) in enumerate(batch):
+            if i in failed:
+                logging.error(f'MongoWriteBuffer: failed to write {doc_id}: {failed[i]}')
+            deferred.callback(i not in failed)
+
+        if self._stats is not None:
+            self._stats.inc_value('mongo/bulk_writes')
+            self._stats.inc_value('mongo/documents_written', len(batch) - len(failed))
+            if failed:
+                self._stats.inc_value('mongo/write_errors', len(failed))
+
+
+def uuid_key(value):
+    '''
+    Compact key of a store uuid: its 16 raw bytes, or the utf-8 encoded
+    string for ids that are not uuids.
+    '''
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError):
+        return str(value).encode('utf-8')
+
+
+class FreshnessIndex:
+    '''
+    Crawl time and label of every store in the collection, loaded with a
+    single projected query when the spider opens.
+
+    A store does not need to be crawled again while it is younger than
+    `max_age` seconds, nor when it is stored under a different label
+    (https://github.com/Blitzat/data-crawler/issues/11). Crawl times and
+    label ids live in flat arrays indexed through a dict of 16 byte keys.
+    '''
+
+    FRESH = 'fresh'
+    OTHER_LABEL = 'other_label'
+
+    def __init__(self, max_age=7 * 24 * 60 * 60):
+        self.max_age = max_age
+        self._rows = {}
+        self._crawl_times = array('d')
+        self._label_ids = array('I')
+        self._label_index = {}
+        self._labels = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, store_uuid):
+        return uuid_key(store_uuid) in self._rows
+
+    def load(self, collection, batch_size=10000):
+        cursor = collection.find({}, {'crawlTime': 1, 'label': 1}, batch_size=batch_size)
+        for doc in cursor:
+            self.update(doc['_id'], doc.get('crawlTime', 0), doc.get('label'))
+        return self
+
+    def update(self, store_uuid, crawl_time, label):
+        label_id = self._label_index.get(label)
+        if label_id is None:
+            label_id = self._label_index[label] = len(self._labels)
+            self._labels.append(label)
+        key = uuid_key(store_uuid)
+        row = self._rows.get(key)
+        if row is None:
+            self._rows[key] = len(self._crawl_times)
+            self._crawl_times.append(crawl_time or 0)
+            self._label_ids.append(label_id)
+        else:
+            self._crawl_times[row] = crawl_time or 0
+            self._label_ids[row] = label_id
+
+    def get(self, store_uuid):
+        '''
+        Return (crawlTime, label) of a stored store, or None.
+        '''
+        row = self._rows.get(uuid_key(store_uuid))
+        if row is None:
+            return None
+        return self._crawl_times[row], self._labels[self._label_ids[row]]
+
+    def check(self, store_uuid, label, now=None):
+        '''
+        Return why the store should not be crawled again (FRESH or
+        OTHER_LABEL), or None if it should be.
+        '''
+        entry = self.get(store_uuid)
+        if entry is None:
+            return None
+        crawl_time, stored_label = entry
+        if (now or time.time()) - crawl_time < self.max_age:
+            return self.FRESH
+        if stored_label != label:
+            return self.OTHER_LABEL
+        return None
@@ -0,0 +1,361 @@
+# Shared work queue for crawling with several Scrapy processes, on one or
+# more nodes.
+#
+# Every unit of work is a task: expanding a city into its categories,
+# fetching the store list of a category, or fetching one store. Tasks are
+# identified by their kind and key (city slug, category path, store uuid)
+# and are only ever added once, which also de-duplicates stores across all
+# workers. Workers lease batches of tasks for a limited time and keep
+# extending the leases of the tasks they are working on; tasks of a worker
+# that died become available to the others once their lease expires.
+#
+# MongoWorkQueue is the one to use across nodes. SQLiteWorkQueue shares a
+# queue between processes of the same machine.
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from twisted.internet import task, threads
+
+from .localstore import chunked, connect_sqlite
+
+CITY = 'city'
+CATEGORY = 'category'
+STORE = 'store'
+
+# tasks closer to a store are leased first, so the queue drains instead of
+# growing
+KIND_RANK = {STORE: 0, CATEGORY: 1, CITY: 2}
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+def task_id(kind, key):
+    return f'{kind}:{key}'
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class MongoWorkQueue:
+    '''
+    Work queue stored in a Mongo collection, one document per task.
+    '''
+
+    def __init__(self, collection, lease_timeout=300):
+        self._collection = collection
+        self.lease_timeout = lease_timeout
+        self._collection.create_index(
+            [('status', ASCENDING), ('rank', ASCENDING),
+             ('priority', DESCENDING), ('seq', ASCENDING)])
+        self._collection.create_index([('owner', ASCENDING), ('status', ASCENDING)])
+
+    @classmethod
+    def from_settings(cls, settings):
+        import pymongo
+        client = pymongo.MongoClient(os.environ.get('MONGODB_URI'))
+        collection = client[os.environ.get('MONGODB_DB')][settings.get('WORK_QUEUE_NAME', 'crawl_queue')]
+        return cls(collection, lease_timeout=settings.getfloat('WORK_QUEUE_LEASE_TIMEOUT', 300))
+
+    def add(self, kind, label, keys, priority=0):
+        '''
+        Add tasks that were never added before; returns their keys. Tasks
+        without a label are labelled with their key. Tasks of equal kind and
+        priority are leased in the order they were added.
+        '''
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return []
+        now = time.time()
+        ops = [UpdateOne({'_id': task_id(kind, key)},
+                         {'$setOnInsert': {'kind': kind, 'key': key, 'label': label or key,
+                                           'rank': KIND_RANK[kind], 'priority': priority,
+                                           'seq': now + i * 1e-6, 'status': PENDING}},
+                         upsert=True)
+               for i, key in enumerate(keys)]
+        try:
+            result = self._collection.bulk_write(ops, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            # concurrent inserts of the same task by two workers: one wins
+            upserted = {op['index']: op['_id'] for op in e.details.get('upserted', [])}
+        added = set(upserted.values())
+        return [key for key in keys if task_id(kind, key) in added]
+
+    def lease(self, worker, limit):
+        '''
+        Lease up to `limit` tasks to `worker`, as (kind, key, label) tuples.
+        '''
+        now = time.time()
+        available = {'$or': [{'status': PENDING},
+                             {'status': LEASED, 'lease_until': {'$lt': now}}]}
+        candidates = [doc['_id'] for doc in self._collection.find(
+            available, {'_id': 1},
+            sort=[('rank', ASCENDING), ('priority', DESCENDING), ('seq', ASCENDING)],
+            limit=limit)]
+        if not candidates:
+            return []
+        lease_id = uuid.uuid4().hex
+        self._collection.update_many(
+            {'_id': {'$in': candidates}, **available},
+            {'$set': {'status': LEASED, 'owner': worker, 'lease_id': lease_id,
+                      'lease_until': now + self.lease_timeout},
+             '$inc': {'attempts': 1}})
+        # the _id index finds them; lease_id tells which ones this worker won
+        return [(doc['kind'], doc['key'], doc['label'])
+                for doc in self._collection.find({'_id': {'$in': candidates}, 'lease_id': lease_id},
+                                                 {'kind': 1, 'key': 1, 'label': 1})]
+
+    def heartbeat(self, worker):
+        '''
+        Extend the leases of all tasks `worker` is working on.
+        '''
+        self._collection.update_many(
+            {'owner': worker, 'status': LEASED},
+            {'$set': {'lease_until': time.time() + self.lease_timeout}})
+
+    def complete(self, tasks):
+        ids = [task_id(kind, key) for kind, key in tasks]
+        if ids:
+            self._collection.update_many(
+                {'_id': {'$in': ids}},
+                {'$set': {'status': DONE, 'finished': time.time()},
+                 '$unset': {'owner': '', 'lease_id': '', 'lease_until': ''}})
+
+    def release(self, worker):
+        '''
+        Give the unfinished tasks of `worker` back to the queue.
+        '''
+        self._collection.update_many(
+            {'owner': worker, 'status': LEASED},
+            {'$set': {'status': PENDING},
+             '$unset': {'owner': '', 'lease_id': '', 'lease_until': ''}})
+
+    def remaining(self):
+        return self._collection.count_documents({'status': {'$ne': DONE}})
+
+    def close(self):
+        pass
+
+
+class SQLiteWorkQueue:
+    '''
+    Work queue in an SQLite file shared by the crawl processes of one machine.
+    Leases are taken in `BEGIN IMMEDIATE` transactions, so two processes
+    never lease the same task.
+    '''
+
+    def __init__(self, path, lease_timeout=300):
+        self.lease_timeout = lease_timeout
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        self._conn.execute('PRAGMA busy_timeout=30000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                label TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                priority REAL NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0);
+            CREATE INDEX IF NOT EXISTS tasks_order ON tasks (status, rank, priority DESC);
+            CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner);
+        ''')
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('WORK_QUEUE_PATH', '.cache/queue.sqlite3'),
+                   lease_timeout=settings.getfloat('WORK_QUEUE_LEASE_TIMEOUT', 300))
+
+    def add(self, kind, label, keys, priority=0):
+        keys = list(dict.fromkeys(keys))
+        added = []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            for key in keys:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO tasks (id, kind, key, label, rank, priority, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (task_id(kind, key), kind, key, label or key, KIND_RANK[kind], priority, PENDING))
+                if cursor.rowcount:
+                    added.append(key)
+            self._conn.execute('COMMIT')
+        return added
+
+    def lease(self, worker, limit):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            rows = self._conn.execute(
+                'SELECT id, kind, key, label FROM tasks '
+                'WHERE status = ? OR (status = ? AND lease_until < ?) '
+                'ORDER BY rank, priority DESC, rowid LIMIT ?',
+                (PENDING, LEASED, now, limit)).fetchall()
+            self._conn.executemany(
+                'UPDATE tasks SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1 '
+                'WHERE id = ?',
+                [(LEASED, worker, now + self.lease_timeout, row[0]) for row in rows])
+            self._conn.execute('COMMIT')
+        return [row[1:] for row in rows]
+
+    def heartbeat(self, worker):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE tasks SET lease_until = ? WHERE owner = ? AND status = ?',
+                (time.time() + self.lease_timeout, worker, LEASED))
+
+    def complete(self, tasks):
+        ids = [task_id(kind, key) for kind, key in tasks]
+        with self._lock:
+            for chunk in chunked(ids):
+                marks = ','.join('?' * len(chunk))
+                self._conn.execute(
+                    f'UPDATE tasks SET status = ?, owner = NULL, lease_until = NULL '
+                    f'WHERE id IN ({marks})', [DONE] + chunk)
+
+    def release(self, worker):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE tasks SET status = ?, owner = NULL, lease_until = NULL '
+                'WHERE owner = ? AND status = ?', (PENDING, worker, LEASED))
+
+    def remaining(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM tasks WHERE status != ?', (DONE,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class WorkQueueClient:
+    '''
+    Connects a spider to a work queue.
+
+    Additions and completions are buffered and sent together with lease
+    renewals and new leases from a single periodic call running in a thread,
+    so the reactor never waits on the queue. New tasks are leased whenever
+    fewer than `prefetch` leased tasks are unfinished, and turned into
+    requests with `make_request(kind, key, label)`, which returns None for
+    a task it completed without a request.
+    '''
+
+    def __init__(self, queue, make_request, crawler, prefetch=64, poll_interval=1.0):
+        self.queue = queue
+        self.worker = worker_name()
+        self._make_request = make_request
+        self._crawler = crawler
+        self._prefetch = max(1, int(prefetch))
+        self._poll_interval = poll_interval
+        self._additions = []
+        self._completions = []
+        self._outstanding = set()
+        self._last_heartbeat = 0
+        self._drained = False
+        self._loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler, make_request):
+        from scrapy.utils.misc import load_object
+        queue_cls = load_object(crawler.settings.get('WORK_QUEUE_BACKEND'))
+        return cls(queue_cls.from_settings(crawler.settings), make_request, crawler,
+                   prefetch=crawler.settings.getint('WORK_QUEUE_PREFETCH', 64),
+                   poll_interval=crawler.settings.getfloat('WORK_QUEUE_POLL_INTERVAL', 1.0))
+
+    def start(self):
+        logging.info(f'WorkQueueClient: worker {self.worker} started')
+        self._loop = task.LoopingCall(self._tick)
+        d = self._loop.start(self._poll_interval, now=True)
+        d.addErrback(lambda failure: logging.error(f'WorkQueueClient: {failure.value}'))
+
+    def add(self, kind, label, keys, priority=0):
+        self._drained = False
+        self._additions.append((kind, label, list(keys), priority))
+
+    def done(self, kind, key):
+        self._completions.append((kind, key))
+        self._outstanding.discard((kind, key))
+
+    def is_drained(self):
+        '''
+        True once the whole queue is done and nothing is left to send.
+        '''
+        return self._drained and not (self._outstanding or self._additions or self._completions)
+
+    def close(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        additions, completions = self._take_buffers()
+        return threads.deferToThread(self._shutdown, additions, completions)
+
+    def _take_buffers(self):
+        additions, self._additions = self._additions, []
+        completions, self._completions = self._completions, []
+        return additions, completions
+
+    def _tick(self):
+        additions, completions = self._take_buffers()
+        wanted = self._prefetch - len(self._outstanding)
+        d = threads.deferToThread(self._sync, additions, completions, wanted,
+                                  not self._outstanding)
+        d.addCallback(self._leased)
+        d.addErrback(self._sync_failed, additions, completions)
+        return d
+
+    def _sync(self, additions, completions, wanted, idle):
+        # runs in a thread: additions go first so a finished category never
+        # hides the stores it found
+        for kind, label, keys, priority in additions:
+            added = self.queue.add(kind, label, keys, priority)
+            if kind == STORE and len(added) < len(keys):
+                self._inc_later('workqueue/duplicate_stores', len(keys) - len(added))
+        self.queue.complete(completions)
+        now = time.time()
+        if now - self._last_heartbeat > self.queue.lease_timeout / 3:
+            self.queue.heartbeat(self.worker)
+            self._last_heartbeat = now
+        leased = self.queue.lease(self.worker, wanted) if wanted > 0 else []
+        drained = idle and not leased and self.queue.remaining() == 0
+        return leased, drained
+
+    def _leased(self, result):
+        leased, drained = result
+        self._drained = drained
+        if leased:
+            self._crawler.stats.inc_value('workqueue/leased', len(leased))
+        for kind, key, label in leased:
+            self._outstanding.add((kind, key))
+            request = self._make_request(kind, key, label)
+            if request is not None:
+                self._crawler.engine.crawl(request)
+
+    def _sync_failed(self, failure, additions, completions):
+        # keep the buffers for the next tick; the queue may be unreachable
+        logging.error(f'WorkQueueClient: {failure.value}')
+        self._additions[:0] = additions
+        self._completions[:0] = completions
+
+    def _inc_later(self, key, count):
+        from twisted.internet import reactor
+        reactor.callFromThread(self._crawler.stats.inc_value, key, count)
+
+    def _shutdown(self, additions, completions):
+        for kind, label, keys, priority in additions:
+            self.queue.add(kind, label, keys, priority)
+        self.queue.complete(completions)
+        self.queue.release(self.worker)
+        self.queue.close()